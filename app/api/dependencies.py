@@ -1,10 +1,17 @@
-from fastapi import Depends, HTTPException, status
+from fastapi import Depends, HTTPException, Request, WebSocket, WebSocketException, status
 from fastapi.security import OAuth2PasswordBearer
+from starlette.requests import HTTPConnection
 from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+from app.core.profiling import start_requested_profile
 from app.core.security import verify_token
-from app.db.session import get_db
+from app.core.tracing import span
+from app.db.admission import set_query_priority, PRIORITY_ADMIN
+from app.db.query_limits import set_query_role
+from app.db.session import get_db, SessionLocal
 from app.db.models.user import User as UserModel, UserRole
 from app.services.auth import AuthService
+from app.services.rate_limiter import rate_limiter, RateLimitExceededError
 from app.services.user_service import UserService
 
 
@@ -18,9 +25,17 @@ def get_user_service(db: Session = Depends(get_db)) -> UserService:
     return UserService(db)
 
 
+def load_user(username: str):
+    """A user looked up with a session of its own, closed right away"""
+    db = SessionLocal()
+    try:
+        return AuthService(db).get_user(username)
+    finally:
+        db.close()
+
 async def get_current_user(
-    token: str = Depends(oauth2_scheme),
-    auth_service: AuthService = Depends(get_auth_service)
+    request: Request,
+    token: str = Depends(oauth2_scheme)
 ):    
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
@@ -28,14 +43,54 @@ async def get_current_user(
         headers={"WWW-Authenticate": "Bearer"},
     )
         
-    username = verify_token(token)
+    with span("auth.jwt_decode"):
+        username = verify_token(token)
     if username is None:
         raise credentials_exception
         
-    user = auth_service.get_user(username)
+    with span("auth.db_lookup"):
+        # In a thread: waiting for a pooled connection must not block the event loop.
+        # The connection is returned before the request goes on, not held until it ends.
+        user = await run_in_threadpool(load_user, username)
     if user is None:
         raise credentials_exception
 
+    bind_user(request, user)
+    return user
+
+def bind_user(connection: HTTPConnection, user: UserModel) -> None:
+    """Makes the user available to middleware and applies its role to ClickHouse queries"""
+    connection.state.user = user
+    set_query_role(user.role.value)
+    if user.role == UserRole.ADMIN:
+        set_query_priority(PRIORITY_ADMIN)
+        if connection.scope["type"] == "http":
+            start_requested_profile(connection.scope["state"], connection.scope["method"], connection.url.path)
+
+async def get_websocket_user(websocket: WebSocket):
+    """
+    Active user of a WebSocket handshake, admitted by the rate limiter.
+    Browsers can't set headers on WebSockets, so the token may also be
+    passed as the token query parameter. The db session is closed before
+    the connection is accepted instead of being held while it is open.
+    """
+    authorization = websocket.headers.get("Authorization", "")
+    scheme, _, token = authorization.partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        token = websocket.query_params.get("token")
+    username = verify_token(token) if token else None
+    if username is None:
+        raise WebSocketException(status.WS_1008_POLICY_VIOLATION, reason="Could not validate credentials")
+
+    user = await run_in_threadpool(load_user, username)
+    if user is None or not user.is_active:
+        raise WebSocketException(status.WS_1008_POLICY_VIOLATION, reason="Could not validate credentials")
+
+    bind_user(websocket, user)
+    try:
+        await admit(websocket, user)
+    except RateLimitExceededError as e:
+        raise WebSocketException(status.WS_1013_TRY_AGAIN_LATER, reason=str(e))
     return user
 
 async def get_current_active_user(current_user = Depends(get_current_user)):    
@@ -53,3 +108,17 @@ async def get_current_admin_user(current_user = Depends(get_current_active_user)
             detail="Not enough permissions"
         )
     return current_user
+
+async def enforce_rate_limit(request: Request, current_user = Depends(get_current_active_user)):
+    """
+    Takes a request token of the user, 429 when a limit is exhausted.
+    Rows and bytes are charged by RateLimitMiddleware when the response is sent.
+    """
+    await admit(request, current_user)
+
+async def admit(connection: HTTPConnection, user) -> None:
+    if not rate_limiter.enabled:
+        return
+    if rate_limiter.needs_reload():
+        await run_in_threadpool(rate_limiter.reload)
+    connection.state.rate_limit = rate_limiter.check(user.id, user.role.value)
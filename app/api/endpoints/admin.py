@@ -1,14 +1,26 @@
+from datetime import datetime
 from fastapi import APIRouter, Depends, Query, HTTPException
-from typing import List, Optional
+from fastapi.responses import StreamingResponse
+from typing import List, Optional, Literal
 from sqlalchemy.orm import Session
 from pydantic import BaseModel
 from app.models.user import User
 from app.models.roles import UserRole
 from app.api.dependencies import get_current_admin_user, get_user_service, get_current_active_user
 from app.services.user_service import UserService
-from app.db.session import get_db
-from app.db.models.api_log import ApiLog
+from app.services.usage_service import UsageService
+from app.services.api_log_service import ApiLogService, InvalidCursorError
+from app.models.api_log import ApiLog as ApiLogSchema, ApiLogPage
+from app.models.rate_limit import RateLimits, RateLimitEntry, RateLimitOverview, UserRateLimitStatus
+from app.services.rate_limit_service import RateLimitService
+from app.services.rate_limiter import rate_limiter
+from app.core.config import settings
+from app.core.profiling import profile_store
+from starlette.concurrency import run_in_threadpool
+from app.db.session import get_db, SessionLocal
 
+# Endpoints using the db session are plain functions: FastAPI runs them in the
+# thread pool, so waiting for a pooled connection never blocks the event loop
 router = APIRouter()
 
 class RoleUpdate(BaseModel):
@@ -16,7 +28,7 @@ class RoleUpdate(BaseModel):
 
 
 @router.get("/users", response_model=List[User])
-async def get_all_users(
+def get_all_users(
     skip: int = Query(0, ge=0, description="Number of users to skip"),
     limit: int = Query(100, ge=1, le=1000, description="Number of users to return"),
     user_service: UserService = Depends(get_user_service),
@@ -26,7 +38,7 @@ async def get_all_users(
     return users
 
 @router.get("/users/{user_id}", response_model=User)
-async def get_user_by_id(
+def get_user_by_id(
     user_id: int,
     user_service: UserService = Depends(get_user_service),
     current_user = Depends(get_current_admin_user)
@@ -37,7 +49,7 @@ async def get_user_by_id(
     return user
 
 @router.put("/users/{user_id}/role")
-async def update_user_role(
+def update_user_role(
     user_id: int,
     role_update: RoleUpdate,
     user_service: UserService = Depends(get_user_service),
@@ -55,49 +67,111 @@ async def update_user_role(
         role=updated_user.role
     )
 
-@router.get("/logs")
-async def get_api_logs(
-    user_id: Optional[int] = Query(None, description="Filter by user ID"),
-    skip: int = Query(0, ge=0, description="Number of logs to skip"),
+class LogFilters:
+    def __init__(
+        self,
+        user_id: Optional[int] = Query(None, description="Filter by user ID"),
+        endpoint: Optional[str] = Query(None, description="Filter by endpoint path"),
+        status_code: Optional[int] = Query(None, ge=100, le=599, description="Filter by status code"),
+        since: Optional[datetime] = Query(None, description="Only logs created at or after this time"),
+        until: Optional[datetime] = Query(None, description="Only logs created before this time")
+    ):
+        self.user_id = user_id
+        self.endpoint = endpoint
+        self.status_code = status_code
+        self.since = since
+        self.until = until
+
+    def as_dict(self) -> dict:
+        return dict(vars(self))
+
+
+@router.get("/logs", response_model=ApiLogPage)
+def get_api_logs(
+    filters: LogFilters = Depends(),
+    cursor: Optional[str] = Query(None, description="Cursor from the previous page (next_cursor)"),
+    skip: int = Query(0, ge=0, deprecated=True, description="Number of logs to skip, ignored with cursor"),
     limit: int = Query(100, ge=1, le=1000, description="Number of logs to return"),
+    total: Literal["none", "estimate", "exact"] = Query("estimate", description="How to compute the total count"),
     db: Session = Depends(get_db),
     current_user = Depends(get_current_admin_user)
 ):    
-    query = db.query(ApiLog)
-    
-    if user_id is not None:
-        query = query.filter(ApiLog.user_id == user_id)
-    
-    logs = query.order_by(ApiLog.created_at.desc())\
-               .offset(skip)\
-               .limit(limit)\
-               .all()
+    log_service = ApiLogService(db)
+    query = log_service.filtered_query(**filters.as_dict())
+
+    try:
+        logs, next_cursor = log_service.get_page(query, limit, cursor=cursor, skip=skip)
+    except InvalidCursorError:
+        raise HTTPException(400, detail="Invalid cursor")
+
+    total_count = None
+    if total == "exact":
+        total_count = log_service.count_exact(query)
+    elif total == "estimate":
+        total_count = log_service.count_estimate(**filters.as_dict())
     
-    return {
-        "logs": logs,
-        "total": query.count(),
-        "skip": skip,
-        "limit": limit
-    }
+    return ApiLogPage(
+        logs=logs,
+        next_cursor=next_cursor,
+        limit=limit,
+        total=total_count,
+        total_is_estimate=total == "estimate" and total_count is not None
+    )
+
+@router.get("/logs/export")
+async def export_api_logs(
+    filters: LogFilters = Depends(),
+    current_user = Depends(get_current_admin_user)
+):
+    """
+    Streams all logs matching the filters as NDJSON, newest first
+    """
+    def generate():
+        # Own session: the request one is closed before streaming starts
+        db = SessionLocal()
+        try:
+            log_service = ApiLogService(db)
+            query = log_service.filtered_query(**filters.as_dict())
+            for log in log_service.iter_logs(query):
+                yield ApiLogSchema.model_validate(log).model_dump_json() + "\n"
+        finally:
+            db.close()
+
+    return StreamingResponse(generate(), media_type="application/x-ndjson")
+
+@router.post("/logs/compact")
+def compact_api_logs(
+    retention_days: Optional[int] = Query(
+        None, ge=1, description="Days of raw logs to keep, API_LOG_RETENTION_DAYS by default"
+    ),
+    db: Session = Depends(get_db),
+    current_user = Depends(get_current_admin_user)
+):
+    if retention_days is None:
+        retention_days = settings.API_LOG_RETENTION_DAYS
+    # API_LOG_RETENTION_DAYS=0 keeps all logs, compacting needs an explicit retention
+    if retention_days < 1:
+        raise HTTPException(400, detail="Log retention is disabled, pass retention_days to compact")
+    deleted = UsageService(db).compact_logs(retention_days)
+    return {"deleted": deleted, "retention_days": retention_days}
 
 @router.get("/stats")
-async def get_admin_stats(
+def get_admin_stats(
     db: Session = Depends(get_db),
     current_user = Depends(get_current_admin_user)
 ):    
-    from sqlalchemy import func
+    from sqlalchemy import func, case
     from app.db.models.user import User
     
-    # User's stats
-    total_users = db.query(User).count()
-    active_users = db.query(User).filter(User.is_active == True).count()
-    admin_users = db.query(User).filter(User.role == UserRole.ADMIN).count()
+    # User's stats in a single query
+    total_users, active_users, admin_users = db.query(
+        func.count(User.id),
+        func.coalesce(func.sum(case((User.is_active == True, 1), else_=0)), 0),
+        func.coalesce(func.sum(case((User.role == UserRole.ADMIN, 1), else_=0)), 0)
+    ).one()
     
-    # Log stats
-    total_logs = db.query(ApiLog).count()
-    today_logs = db.query(ApiLog).filter(
-        func.date(ApiLog.created_at) == func.current_date()
-    ).count()
+    # Log stats from the incrementally maintained counters
+    log_stats = UsageService(db).get_log_stats()
     
     return {
         "users": {
@@ -105,12 +179,132 @@ async def get_admin_stats(
             "active": active_users,
             "admins": admin_users
         },
-        "logs": {
-            "total": total_logs,
-            "today": today_logs
-        }
+        "logs": log_stats
     }
 
+@router.get("/users/{user_id}/usage")
+def get_user_usage(
+    user_id: int,
+    days: int = Query(30, ge=1, le=366, description="Number of days to include"),
+    user_service: UserService = Depends(get_user_service),
+    db: Session = Depends(get_db),
+    current_user = Depends(get_current_admin_user)
+):
+    if not user_service.get_user_by_id(user_id):
+        raise HTTPException(404, detail="User not found")
+    return UsageService(db).get_user_usage(user_id, days)
+
+@router.get("/profiles")
+async def get_profiles(
+    limit: int = Query(50, ge=1, le=500, description="Number of profiles to return"),
+    current_user = Depends(get_current_admin_user)
+):
+    """Stored request profiles, newest first, without the profiler output"""
+    return await run_in_threadpool(profile_store.list, limit)
+
+@router.get("/profiles/{profile_id}")
+async def get_profile(
+    profile_id: str,
+    current_user = Depends(get_current_admin_user)
+):
+    profile = await run_in_threadpool(profile_store.get, profile_id)
+    if profile is None:
+        raise HTTPException(404, detail="Profile not found")
+    return profile
+
+@router.get("/rate-limits", response_model=RateLimitOverview)
+def get_rate_limits(
+    db: Session = Depends(get_db),
+    current_user = Depends(get_current_admin_user)
+):
+    """RATE_LIMIT_ROLES defaults and the role and user overrides"""
+    return RateLimitOverview(
+        defaults=rate_limiter.role_defaults,
+        overrides=RateLimitService(db).get_all()
+    )
+
+@router.put("/rate-limits/roles/{role}", response_model=RateLimitEntry)
+def set_role_rate_limits(
+    role: UserRole,
+    limits: RateLimits,
+    db: Session = Depends(get_db),
+    current_user = Depends(get_current_admin_user)
+):
+    entry = RateLimitService(db).set_for_role(role.value, limits)
+    rate_limiter.limits_changed()
+    return entry
+
+@router.delete("/rate-limits/roles/{role}")
+def delete_role_rate_limits(
+    role: UserRole,
+    db: Session = Depends(get_db),
+    current_user = Depends(get_current_admin_user)
+):
+    rate_limit_service = RateLimitService(db)
+    entry = rate_limit_service.get_for_role(role.value)
+    if not entry:
+        raise HTTPException(404, detail="No rate limits set for this role")
+    rate_limit_service.delete(entry)
+    rate_limiter.limits_changed()
+    return {"deleted": True}
+
+@router.get("/rate-limits/users/{user_id}", response_model=UserRateLimitStatus)
+def get_user_rate_limits(
+    user_id: int,
+    user_service: UserService = Depends(get_user_service),
+    current_user = Depends(get_current_admin_user)
+):
+    """Effective limits of a user and the tokens left in each bucket"""
+    user = user_service.get_user_by_id(user_id)
+    if not user:
+        raise HTTPException(404, detail="User not found")
+    if rate_limiter.needs_reload():
+        rate_limiter.reload()
+    role = user.role.value
+    return UserRateLimitStatus(
+        user_id=user_id,
+        role=role,
+        limits=rate_limiter.limits_for(user_id, role).limits,
+        remaining=rate_limiter.status(user_id, role)
+    )
+
+@router.put("/rate-limits/users/{user_id}", response_model=RateLimitEntry)
+def set_user_rate_limits(
+    user_id: int,
+    limits: RateLimits,
+    user_service: UserService = Depends(get_user_service),
+    db: Session = Depends(get_db),
+    current_user = Depends(get_current_admin_user)
+):
+    if not user_service.get_user_by_id(user_id):
+        raise HTTPException(404, detail="User not found")
+    entry = RateLimitService(db).set_for_user(user_id, limits)
+    rate_limiter.limits_changed()
+    return entry
+
+@router.delete("/rate-limits/users/{user_id}")
+def delete_user_rate_limits(
+    user_id: int,
+    db: Session = Depends(get_db),
+    current_user = Depends(get_current_admin_user)
+):
+    rate_limit_service = RateLimitService(db)
+    entry = rate_limit_service.get_for_user(user_id)
+    if not entry:
+        raise HTTPException(404, detail="No rate limits set for this user")
+    rate_limit_service.delete(entry)
+    rate_limiter.limits_changed()
+    return {"deleted": True}
+
+@router.post("/rate-limits/users/{user_id}/reset")
+async def reset_user_rate_limits(
+    user_id: int,
+    current_user = Depends(get_current_admin_user)
+):
+    """Refills all buckets of a user"""
+    rate_limiter.reset(user_id)
+    return {"reset": True}
+
 @router.get("/my-role")
 async def get_my_role(current_user = Depends(get_current_active_user)):
     return {
@@ -11,10 +11,11 @@ from app.db.session import get_db
 from app.services.auth import AuthService
 
 
+# Endpoints using the db session are plain functions, run in the thread pool
 router = APIRouter()
 
 @router.post("/token", response_model=Token)
-async def login_for_access_token(
+def login_for_access_token(
     form_data: OAuth2PasswordRequestForm = Depends(),
     auth_service: AuthService = Depends(get_auth_service)
 ):
@@ -51,7 +52,7 @@ async def login_for_access_token(
     }
 
 @router.post("/register", response_model=User)
-async def register_user(
+def register_user(
     user_data: UserCreate,
     x_registration_secret: str = Header(None),  # Secret key to create user
     x_admin_secret: str = Header(None),         # Secret key to create admin
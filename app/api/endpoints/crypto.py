@@ -1,14 +1,33 @@
-from fastapi import APIRouter, Depends, Query, HTTPException
-from typing import List
-from pydantic import BaseModel
+from fastapi import APIRouter, Depends, Query, HTTPException, Request, Response, WebSocket, WebSocketDisconnect, WebSocketException, status
+from fastapi.responses import JSONResponse, StreamingResponse
+from typing import Any, Dict, List, Optional
+from pydantic import BaseModel, Field
 from app.services.crypto_service import CryptoService
-from app.api.dependencies import get_current_active_user
+from app.services.replay import ReplaySession
+from app.services.sync import SyncService
+from app.api.dependencies import get_current_active_user, get_websocket_user, enforce_rate_limit
+from app.core.config import settings
+from app.core.tracing import span
+from app.core.compression import cached_response
+from app.db.clickhouse import ClickHouseQueryError
+from app.db.symbol_index import symbol_index
+from app.services.rate_limiter import rate_limiter, record_rows
+import json
 import logging
+import re
 
 
 logger = logging.getLogger(__name__)
 
-router = APIRouter()
+# Every data endpoint is metered per user
+router = APIRouter(dependencies=[Depends(enforce_rate_limit)])
+# WebSocket endpoints authenticate and are metered by get_websocket_user
+websocket_router = APIRouter()
+
+# Set when ClickHouse failed and the last known good data is returned
+STALE_DATA_HEADER = "X-Data-Stale-Seconds"
+
+_COLUMN_RE = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
 
 
 class SymbolDataResponse(BaseModel):
@@ -17,12 +36,74 @@ class SymbolDataResponse(BaseModel):
     data_points: int
 
 
+class SymbolDayRows(BaseModel):
+    day: int
+    rows: int
+
+
+class SymbolMetaResponse(BaseModel):
+    symbol: str
+    first_event_time: int
+    last_event_time: int
+    rows: int
+    days: List[SymbolDayRows]
+    # Rows before this event_time were complete when the index was refreshed
+    complete_until: int
+    indexed_at: float
+
+
+class SyncRequest(BaseModel):
+    # Symbol -> last event_time the client has, null for the latest rows
+    watermarks: Dict[str, Optional[int]]
+    limit: int = Field(1000, ge=1, description="Rows per symbol, at most SYNC_MAX_ROWS_PER_SYMBOL")
+    columns: Optional[str] = Field(None, description="Comma-separated columns to return, all by default")
+
+
+class SymbolDelta(BaseModel):
+    rows: int
+    # False when more rows follow the new watermark
+    complete: bool
+    # Column -> {"delta": [...], "scale": n} or {"values": [...]}, see app.services.sync
+    columns: Dict[str, Dict[str, Any]]
+
+
+class SyncResponse(BaseModel):
+    watermarks: Dict[str, Optional[int]]
+    # Only symbols with new rows
+    symbols: Dict[str, SymbolDelta]
+
+
 async def get_crypto_service() -> CryptoService:
     return CryptoService()
 
 
+def parse_columns(columns: Optional[str]) -> Optional[List[str]]:
+    """Column names of a comma-separated list, ValueError for invalid names"""
+    if not columns:
+        return None
+    column_list = list(dict.fromkeys(column.strip() for column in columns.split(",") if column.strip()))
+    invalid = [column for column in column_list if not _COLUMN_RE.match(column)]
+    if invalid:
+        raise ValueError(f"Invalid column names: {', '.join(invalid)}")
+    return column_list
+
+
+def parse_replay(symbols: str, start: int, end: int, speed: float, columns: Optional[str]) -> ReplaySession:
+    """Replay of a request, ValueError for invalid parameters"""
+    symbol_list = list(dict.fromkeys(symbol.strip().upper() for symbol in symbols.split(",") if symbol.strip()))
+    if not symbol_list:
+        raise ValueError("No symbols given")
+    if len(symbol_list) > settings.REPLAY_MAX_SYMBOLS:
+        raise ValueError(f"At most {settings.REPLAY_MAX_SYMBOLS} symbols can be replayed at once")
+    if start >= end:
+        raise ValueError("start must be less than end")
+    return ReplaySession(symbol_list, start, end, speed, columns=parse_columns(columns))
+
+
 @router.get("/symbols", response_model=List[str])
 async def get_available_symbols(
+    request: Request,
+    response: Response,
     crypto_service: CryptoService = Depends(get_crypto_service),
     current_user = Depends(get_current_active_user)
 ):
@@ -33,19 +114,63 @@ async def get_available_symbols(
         logger.warning("No symbols found in database")
         raise HTTPException(404, detail="No symbols found in the database")
 
+    if crypto_service.stale_seconds is not None:
+        response.headers[STALE_DATA_HEADER] = str(int(crypto_service.stale_seconds))
     logger.debug(f"Returning {len(symbols)} symbols to user")
+    if crypto_service.cache_key is not None:
+        # Serialized and compressed once per cached version
+        return await cached_response(
+            request, crypto_service.cache_key, lambda: JSONResponse(symbols).body, route=request.scope["route"].path
+        )
     return symbols
 
+@router.get("/symbols/{symbol}/meta", response_model=SymbolMetaResponse)
+async def get_symbol_meta(
+    symbol: str,
+    crypto_service: CryptoService = Depends(get_crypto_service),
+    current_user = Depends(get_current_active_user)
+):
+    """
+    First and last event_time, rows and rows per UTC day (epoch ms day starts) of a symbol,
+    from the symbol index
+    """
+    logger.info(f"User {current_user.username} requested metadata of {symbol}")
+
+    meta = await crypto_service.get_symbol_meta(symbol)
+    if meta is None:
+        raise HTTPException(404, detail=f"No data found for symbol {symbol} or symbol doesn't exist")
+
+    return SymbolMetaResponse(
+        symbol=symbol.upper(),
+        first_event_time=meta.first_time,
+        last_event_time=meta.last_time,
+        rows=meta.rows,
+        days=[SymbolDayRows(day=day, rows=meta.days[day]) for day in meta.day_starts],
+        complete_until=symbol_index.known_until,
+        indexed_at=symbol_index.refreshed_at
+    )
+
 @router.get("/data/{symbol}", response_model=SymbolDataResponse)
 async def get_symbol_data(
+    request: Request,
     symbol: str,
     limit: int = Query(100, ge=1, le=1000, description="Number of records to return"),
+    start: Optional[int] = Query(None, ge=0, description="Range start, event_time epoch ms (inclusive)"),
+    end: Optional[int] = Query(None, ge=0, description="Range end, event_time epoch ms (exclusive)"),
+    columns: Optional[str] = Query(None, description="Comma-separated columns to return, all by default"),
     crypto_service: CryptoService = Depends(get_crypto_service),
     current_user = Depends(get_current_active_user)
 ):
     logger.info(f"User {current_user.username} requested data for {symbol}, limit: {limit}")
 
-    result = await crypto_service.get_symbol_data(symbol, limit)
+    if start is not None and end is not None and start >= end:
+        raise HTTPException(400, detail="start must be less than end")
+    try:
+        column_list = parse_columns(columns)
+    except ValueError as e:
+        raise HTTPException(400, detail=str(e))
+
+    result = await crypto_service.get_symbol_data(symbol, limit, start=start, end=end, columns=column_list)
 
     if not result['data']:
         logger.warning(f"No data found for symbol {symbol}")
@@ -55,4 +180,136 @@ async def get_symbol_data(
         )
 
     logger.debug(f"Returning {result['data_points']} data points for {symbol}")
-    return result
+    record_rows(request, result['data_points'])
+    if crypto_service.cache_key is not None:
+        with span("serialize"):
+            return await cached_response(
+                request, crypto_service.cache_key,
+                lambda: JSONResponse(SymbolDataResponse(**result).model_dump()).body,
+                route=request.scope["route"].path
+            )
+    with span("serialize"):
+        response = JSONResponse(SymbolDataResponse(**result).model_dump())
+    if crypto_service.stale_seconds is not None:
+        response.headers[STALE_DATA_HEADER] = str(int(crypto_service.stale_seconds))
+    return response
+
+@router.post("/sync", response_model=SyncResponse)
+async def sync(
+    request: Request,
+    body: SyncRequest,
+    current_user = Depends(get_current_active_user)
+):
+    """
+    Rows newer than the watermark of every symbol, delta-encoded column by
+    column, and the new watermarks to send with the next poll
+    """
+    logger.info(f"User {current_user.username} synced {len(body.watermarks)} symbols")
+
+    watermarks = {symbol.strip().upper(): watermark for symbol, watermark in body.watermarks.items() if symbol.strip()}
+    if not watermarks:
+        raise HTTPException(400, detail="No symbols given")
+    if len(watermarks) > settings.SYNC_MAX_SYMBOLS:
+        raise HTTPException(400, detail=f"At most {settings.SYNC_MAX_SYMBOLS} symbols can be synced at once")
+    if body.limit > settings.SYNC_MAX_ROWS_PER_SYMBOL:
+        raise HTTPException(400, detail=f"limit must be at most {settings.SYNC_MAX_ROWS_PER_SYMBOL}")
+    if any(watermark is not None and watermark < 0 for watermark in watermarks.values()):
+        raise HTTPException(400, detail="Watermarks must be epoch ms or null")
+    try:
+        column_list = parse_columns(body.columns)
+    except ValueError as e:
+        raise HTTPException(400, detail=str(e))
+
+    service = SyncService(body.limit, column_list)
+    result = await service.sync(watermarks)
+    record_rows(request, service.rows)
+    with span("serialize"):
+        return JSONResponse(result)
+
+@router.get("/replay")
+async def replay(
+    request: Request,
+    symbols: str = Query(..., description="Comma-separated symbols, merged in event time order"),
+    start: int = Query(..., ge=0, description="Range start, event_time epoch ms (inclusive)"),
+    end: int = Query(..., ge=0, description="Range end, event_time epoch ms (exclusive)"),
+    speed: float = Query(1.0, ge=0, description="Event time speed multiplier, 0 = as fast as possible"),
+    columns: Optional[str] = Query(None, description="Comma-separated columns to return, all by default"),
+    current_user = Depends(get_current_active_user)
+):
+    """
+    Streams the rows of the symbols in [start, end) as NDJSON, paced by
+    their event time. The WebSocket variant is /crypto/replay/ws.
+    """
+    logger.info(f"User {current_user.username} started a replay of {symbols} [{start}, {end}) at speed {speed}")
+    try:
+        session = parse_replay(symbols, start, end, speed, columns)
+    except ValueError as e:
+        raise HTTPException(400, detail=str(e))
+
+    # The first batch is fetched before the response starts, so errors get their status code
+    batches = session.batches()
+    first = await anext(batches, None)
+    if first is None:
+        await batches.aclose()
+        raise HTTPException(404, detail=f"No data found for {symbols} in the range")
+
+    async def generate():
+        batch = first
+        try:
+            while batch is not None:
+                record_rows(request, session.rows_sent)
+                yield "".join(json.dumps(row, separators=(",", ":")) + "\n" for row in batch)
+                batch = await anext(batches, None)
+        except Exception as e:
+            # The status is sent already: the stream ends without its last chunk
+            logger.error(f"Replay of {symbols} failed after {session.rows_sent} rows: {e}")
+            raise
+        finally:
+            await batches.aclose()
+
+    return StreamingResponse(generate(), media_type="application/x-ndjson")
+
+@websocket_router.websocket("/replay/ws")
+async def replay_websocket(
+    websocket: WebSocket,
+    symbols: str = Query(..., description="Comma-separated symbols, merged in event time order"),
+    start: int = Query(..., ge=0, description="Range start, event_time epoch ms (inclusive)"),
+    end: int = Query(..., ge=0, description="Range end, event_time epoch ms (exclusive)"),
+    speed: float = Query(1.0, ge=0, description="Event time speed multiplier, 0 = as fast as possible"),
+    columns: Optional[str] = Query(None, description="Comma-separated columns to return, all by default"),
+    current_user = Depends(get_websocket_user)
+):
+    """
+    Sends {"type": "rows", "rows": [...]} messages, then {"type": "end", "rows": total},
+    or {"type": "error", "detail": ...} before closing with code 1011
+    """
+    logger.info(f"User {current_user.username} started a WebSocket replay of {symbols} [{start}, {end}) at speed {speed}")
+    try:
+        session = parse_replay(symbols, start, end, speed, columns)
+    except ValueError as e:
+        raise WebSocketException(status.WS_1008_POLICY_VIOLATION, reason=str(e))
+
+    await websocket.accept()
+    sent_bytes = 0
+    batches = session.batches()
+    try:
+        async for batch in batches:
+            message = json.dumps({"type": "rows", "rows": batch}, separators=(",", ":"))
+            sent_bytes += len(message)
+            await websocket.send_text(message)
+        await websocket.send_text(json.dumps({"type": "end", "rows": session.rows_sent}))
+        await websocket.close()
+    except WebSocketDisconnect:
+        logger.info(f"Replay client of {symbols} left after {session.rows_sent} rows")
+    except Exception as e:
+        logger.error(f"Replay of {symbols} failed after {session.rows_sent} rows: {e}")
+        detail = str(e) if isinstance(e, ClickHouseQueryError) and e.status < 500 else "Replay failed"
+        await websocket.send_text(json.dumps({"type": "error", "detail": detail}))
+        await websocket.close(status.WS_1011_INTERNAL_ERROR)
+    finally:
+        await batches.aclose()
+        # RateLimitMiddleware only sees HTTP responses
+        ticket = getattr(websocket.state, "rate_limit", None)
+        if ticket is not None:
+            ticket.rows = session.rows_sent
+            rate_limiter.charge(ticket, sent_bytes)
@@ -0,0 +1,102 @@
+"""
+Small in-process caches.
+
+Caches live in the memory of a worker process.
+"""
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional, Tuple
+from app.core.metrics import record_cache_access
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+class TTLCache:
+    """
+    LRU cache whose entries expire after ttl_seconds. ttl_seconds <= 0 disables it.
+    Used from the event loop thread only, so it has no locking.
+    """
+    def __init__(self, name: str, ttl_seconds: float, max_size: int = 1024):
+        self.name = name
+        self.ttl_seconds = ttl_seconds
+        self.max_size = max_size
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            self._entries.move_to_end(key)
+            record_cache_access(self.name, True)
+            return entry[1]
+        if entry is not None:
+            del self._entries[key]
+        record_cache_access(self.name, False)
+        return None
+
+    def set(self, key: Hashable, value: Any) -> None:
+        if self.ttl_seconds <= 0:
+            return
+        self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key: Hashable) -> None:
+        self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class LastGoodCache:
+    """
+    Keeps the last successful result per key to serve when the source fails.
+    Entries never expire by time here, callers decide what age is acceptable.
+    The LRU size budget is a total weight (e.g. rows) instead of an entry count.
+    """
+    def __init__(self, name: str, max_weight: int):
+        self.name = name
+        self.max_weight = max_weight
+        self.weight = 0
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+
+    def get(self, key: Hashable, max_age: Optional[float] = None) -> Optional[Tuple[Any, float]]:
+        """
+        Returns:
+            (value, age in seconds) or None
+        """
+        entry = self._entries.get(key)
+        age = time.time() - entry[0] if entry is not None else None
+        if entry is None or (max_age is not None and age > max_age):
+            record_cache_access(self.name, False)
+            return None
+        self._entries.move_to_end(key)
+        record_cache_access(self.name, True)
+        return entry[1], age
+
+    def set(self, key: Hashable, value: Any, weight: int = 1) -> None:
+        if weight > self.max_weight:
+            return
+        self.invalidate(key)
+        self._entries[key] = (time.time(), value, weight)
+        self.weight += weight
+        while self.weight > self.max_weight:
+            _, (_, _, evicted_weight) = self._entries.popitem(last=False)
+            self.weight -= evicted_weight
+
+    def invalidate(self, key: Hashable) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.weight -= entry[2]
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self.weight = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
@@ -0,0 +1,218 @@
+"""
+Compact columnar file format for immutable result sets.
+
+Layout (little-endian):
+
+    magic "LOBC", version u16, column count u16, row count u32
+    per column: name (u16 length + utf-8), kind u8, flags u8, offset u64, size u64
+    column data blocks, each aligned to 8 bytes
+
+Column kinds:
+    numeric: packed fixed-width array (array/struct type code)
+    string:  u32 offsets array (rows + 1) followed by the utf-8 data
+    json:    like string, every value JSON encoded (any other ClickHouse type)
+
+Encoded data is read in place (a mmap'ed file or shared memory): numeric
+columns are used through memoryview casts, only the selected rows are
+converted to Python values.
+"""
+import json
+import mmap
+import os
+import struct
+from array import array
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+
+MAGIC = b"LOBC"
+VERSION = 1
+
+KIND_NUMERIC = 0
+KIND_STRING = 1
+KIND_JSON = 2
+
+# The column's 64-bit integers are quoted in ClickHouse JSON output
+FLAG_QUOTED = 1
+
+_HEADER = struct.Struct("<4sHHI")
+_COLUMN = struct.Struct("<BBQQ")
+
+NUMERIC_TYPES = {
+    "UInt8": "B", "UInt16": "H", "UInt32": "I", "UInt64": "Q",
+    "Int8": "b", "Int16": "h", "Int32": "i", "Int64": "q",
+    "Float32": "f", "Float64": "d",
+}
+
+
+class ColumnarFormatError(Exception):
+    pass
+
+
+def _align(size: int) -> int:
+    return (size + 7) & ~7
+
+
+def _encode_strings(values: Sequence[str]) -> bytes:
+    data = bytearray()
+    offsets = array("I", [0])
+    for value in values:
+        data += value.encode()
+        offsets.append(len(data))
+    return offsets.tobytes() + bytes(data)
+
+
+def encode_columns(meta: Sequence[Dict[str, str]], rows: Sequence[Dict[str, Any]]) -> bytes:
+    """
+    Encodes rows of a ClickHouse FORMAT JSON result
+
+    Args:
+        meta: Column names and types, as in the "meta" part of the response
+        rows: Row dicts, as in the "data" part
+    """
+    blocks: List[Tuple[str, int, int, bytes]] = []
+    for column in meta:
+        name, type_ = column["name"], column["type"]
+        values = [row[name] for row in rows]
+        code = NUMERIC_TYPES.get(type_)
+        if code is not None and all(value is not None for value in values):
+            flags = FLAG_QUOTED if values and isinstance(values[0], str) else 0
+            if flags:
+                values = [int(value) for value in values]
+            blocks.append((name, KIND_NUMERIC, flags, code.encode() + array(code, values).tobytes()))
+        elif type_ == "String":
+            blocks.append((name, KIND_STRING, 0, _encode_strings(values)))
+        else:
+            blocks.append((name, KIND_JSON, 0, _encode_strings([json.dumps(value) for value in values])))
+
+    header_size = _HEADER.size + sum(2 + len(name.encode()) + _COLUMN.size for name, _, _, _ in blocks)
+    out = bytearray(_HEADER.pack(MAGIC, VERSION, len(blocks), len(rows)))
+    offset = _align(header_size)
+    layout = []
+    for name, kind, flags, data in blocks:
+        encoded_name = name.encode()
+        out += struct.pack("<H", len(encoded_name)) + encoded_name
+        out += _COLUMN.pack(kind, flags, offset, len(data))
+        layout.append((offset, data))
+        offset = _align(offset + len(data))
+
+    for offset, data in layout:
+        out += b"\0" * (offset - len(out))
+        out += data
+    return bytes(out)
+
+
+def write_file(path: str, meta: Sequence[Dict[str, str]], rows: Sequence[Dict[str, Any]]) -> int:
+    """Writes atomically, so readers never see a partial file. Returns the file size."""
+    data = encode_columns(meta, rows)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    return len(data)
+
+
+class ColumnarReader:
+    """Reads an encoded result in place from any buffer, e.g. a slice of shared memory"""
+    def __init__(self, buf):
+        self._buf = memoryview(buf)
+        self._views: List[memoryview] = [self._buf]
+        self.rows = 0
+        self.columns: Dict[str, Tuple[int, int, int, int]] = {}
+        self._read_header()
+
+    def release(self) -> None:
+        """Releases the views into the buffer, so it can be closed"""
+        for view in self._views:
+            view.release()
+        self._views = []
+
+    def _read_header(self) -> None:
+        buf = self._buf
+        if len(buf) < _HEADER.size:
+            raise ColumnarFormatError("Buffer is too small for a columnar header")
+        magic, version, column_count, self.rows = _HEADER.unpack_from(buf, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ColumnarFormatError(f"Not a columnar buffer of version {VERSION}")
+        position = _HEADER.size
+        for _ in range(column_count):
+            (name_length,) = struct.unpack_from("<H", buf, position)
+            name = bytes(buf[position + 2:position + 2 + name_length]).decode()
+            position += 2 + name_length
+            kind, flags, offset, size = _COLUMN.unpack_from(buf, position)
+            position += _COLUMN.size
+            self.columns[name] = (kind, flags, offset, size)
+
+    def _view(self, offset: int, size: int) -> memoryview:
+        view = self._buf[offset:offset + size]
+        self._views.append(view)
+        return view
+
+    def numeric(self, name: str) -> memoryview:
+        """Zero-copy view of a numeric column"""
+        kind, _, offset, size = self.columns[name]
+        if kind != KIND_NUMERIC:
+            raise ColumnarFormatError(f"Column {name} is not numeric")
+        code = chr(self._buf[offset])
+        # Type code takes 1 byte, the array starts right after it
+        view = self._view(offset + 1, size - 1).cast(code)
+        self._views.append(view)
+        return view
+
+    def values(self, name: str, start: int, stop: int) -> List[Any]:
+        """Python values of rows [start, stop) as ClickHouse JSON would return them"""
+        kind, flags, offset, size = self.columns[name]
+        if kind == KIND_NUMERIC:
+            values = self.numeric(name)[start:stop].tolist()
+            return [str(value) for value in values] if flags & FLAG_QUOTED else values
+
+        offsets = self._view(offset, (self.rows + 1) * 4).cast("I")
+        self._views.append(offsets)
+        data_start = offset + (self.rows + 1) * 4
+        buf = self._buf
+        strings = [
+            bytes(buf[data_start + offsets[i]:data_start + offsets[i + 1]]).decode()
+            for i in range(start, stop)
+        ]
+        if kind == KIND_JSON:
+            return [json.loads(value) for value in strings]
+        return strings
+
+    def rows_between(self, start: int, stop: int, names: Optional[Sequence[str]] = None) -> List[Dict[str, Any]]:
+        names = list(names) if names is not None else list(self.columns)
+        columns = [self.values(name, start, stop) for name in names]
+        return [dict(zip(names, values)) for values in zip(*columns)] if columns else []
+
+
+class ColumnarFile(ColumnarReader):
+    """Memory-mapped columnar file. Use as a context manager."""
+    def __init__(self, path: str):
+        self.path = path
+        self._file = None
+        self._mmap: Optional[mmap.mmap] = None
+        self._views = []
+
+    def __enter__(self):
+        self._file = open(self.path, "rb")
+        try:
+            size = os.fstat(self._file.fileno()).st_size
+            if size == 0:
+                raise ColumnarFormatError(f"{self.path} is empty")
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            super().__init__(self._mmap)
+        except Exception:
+            self.close()
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+    def close(self) -> None:
+        self.release()
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -0,0 +1,304 @@
+"""
+HTTP response compression: content negotiation, encoders and a cache of
+compressed bodies.
+
+gzip is always available; br and zstd are used when the brotli and
+zstandard packages are installed. The same encoders (plus lz4 with the
+lz4 package) compress and decompress the ClickHouse transport. The server prefers encodings in the order
+of COMPRESSION_ENCODINGS among those the client accepts with the highest q.
+
+Responses built from cached data (same data version -> same body) go
+through `cached_response`, which keeps the serialized body and its
+compressed variants, so each variant is compressed once per data version
+instead of once per request.
+"""
+import gzip
+import time
+import zlib
+from collections import OrderedDict
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Callable, Dict, Hashable, List, Optional
+from fastapi import Request
+from fastapi.responses import Response
+from starlette.concurrency import run_in_threadpool
+from app.core.config import settings
+from app.core.metrics import http_compression_seconds, record_cache_access
+import logging
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+
+logger = logging.getLogger(__name__)
+
+GZIP = "gzip"
+DEFLATE = "deflate"
+BROTLI = "br"
+ZSTD = "zstd"
+LZ4 = "lz4"
+
+# Encodings of our responses, negotiated with clients
+AVAILABLE_ENCODINGS = [GZIP] + ([BROTLI] if brotli else []) + ([ZSTD] if zstandard else [])
+# Encodings we can decode, e.g. of ClickHouse responses
+DECODABLE_ENCODINGS = [GZIP, DEFLATE] + ([BROTLI] if brotli else []) + ([ZSTD] if zstandard else []) + ([LZ4] if lz4 else [])
+
+COMPRESSIBLE_TYPES = ("application/json", "application/x-ndjson", "text/", "application/javascript")
+
+
+@dataclass(frozen=True)
+class CompressionPolicy:
+    min_size: int
+    levels: Dict[str, int]
+
+    @property
+    def enabled(self) -> bool:
+        return self.min_size >= 0
+
+
+def default_policy() -> CompressionPolicy:
+    return CompressionPolicy(
+        min_size=settings.COMPRESSION_MIN_SIZE,
+        levels={
+            GZIP: settings.COMPRESSION_GZIP_LEVEL,
+            BROTLI: settings.COMPRESSION_BROTLI_LEVEL,
+            ZSTD: settings.COMPRESSION_ZSTD_LEVEL,
+        }
+    )
+
+
+@lru_cache(maxsize=1)
+def route_policies() -> Dict[str, CompressionPolicy]:
+    """COMPRESSION_ROUTES overrides by route template"""
+    default = default_policy()
+    policies = {}
+    for route, overrides in settings.COMPRESSION_ROUTES.items():
+        policies[route] = CompressionPolicy(
+            min_size=overrides.get("min_size", default.min_size),
+            levels={
+                GZIP: overrides.get("gzip_level", default.levels[GZIP]),
+                BROTLI: overrides.get("brotli_level", default.levels[BROTLI]),
+                ZSTD: overrides.get("zstd_level", default.levels[ZSTD]),
+            }
+        )
+    return policies
+
+
+@lru_cache(maxsize=1)
+def server_preference() -> List[str]:
+    preferred = [encoding.strip() for encoding in settings.COMPRESSION_ENCODINGS.split(",")]
+    return [encoding for encoding in preferred if encoding in AVAILABLE_ENCODINGS]
+
+
+def negotiate(accept_encoding: str, preference: List[str]) -> Optional[str]:
+    """Encoding to use for an Accept-Encoding header, None for identity"""
+    if not accept_encoding:
+        return None
+    weights: Dict[str, float] = {}
+    for part in accept_encoding.lower().split(","):
+        name, _, params = part.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        weights[name.strip()] = quality
+
+    best, best_quality = None, 0.0
+    for encoding in preference:
+        quality = weights.get(encoding, weights.get("*", 0.0))
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def is_compressible(content_type: str) -> bool:
+    return content_type.startswith(COMPRESSIBLE_TYPES)
+
+
+def compress(encoding: str, data: bytes, level: int) -> bytes:
+    if encoding == GZIP:
+        return gzip.compress(data, compresslevel=level, mtime=0)
+    if encoding == BROTLI:
+        return brotli.compress(data, quality=level)
+    if encoding == ZSTD:
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    if encoding == LZ4:
+        return lz4.frame.compress(data, compression_level=level)
+    if encoding == DEFLATE:
+        return zlib.compress(data, level)
+    raise ValueError(f"Unsupported encoding {encoding}")
+
+
+async def compress_body(encoding: str, data: bytes, level: int) -> bytes:
+    """Compresses in a worker thread when the body is large, the libraries release the GIL"""
+    started = time.perf_counter()
+    if len(data) >= settings.COMPRESSION_THREAD_MIN_SIZE:
+        result = await run_in_threadpool(compress, encoding, data, level)
+    else:
+        result = compress(encoding, data, level)
+    http_compression_seconds.observe(time.perf_counter() - started, encoding)
+    return result
+
+
+class StreamCompressor:
+    """Compresses a streamed body chunk by chunk, each chunk is flushed to the client"""
+    def __init__(self, encoding: str, level: int):
+        self.encoding = encoding
+        if encoding == GZIP:
+            self._compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        elif encoding == BROTLI:
+            self._compressor = brotli.Compressor(quality=level)
+        elif encoding == ZSTD:
+            self._compressor = zstandard.ZstdCompressor(level=level).compressobj()
+        else:
+            raise ValueError(f"Unsupported encoding {encoding}")
+
+    def compress(self, chunk: bytes) -> bytes:
+        if self.encoding == GZIP:
+            return self._compressor.compress(chunk) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        if self.encoding == BROTLI:
+            return self._compressor.process(chunk) + self._compressor.flush()
+        return self._compressor.compress(chunk) + self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self) -> bytes:
+        if self.encoding == BROTLI:
+            return self._compressor.finish()
+        return self._compressor.flush()
+
+
+class StreamDecompressor:
+    """
+    Decompresses a body chunk by chunk as it arrives, so decompression
+    overlaps the transfer. Concatenated frames (gzip members, zstd and lz4
+    frames) are decoded one after another.
+    """
+    def __init__(self, encoding: str):
+        if encoding not in DECODABLE_ENCODINGS:
+            raise ValueError(f"Unsupported encoding {encoding}")
+        self.encoding = encoding
+        self._decoder = self._new_decoder()
+
+    def _new_decoder(self):
+        if self.encoding == GZIP:
+            return zlib.decompressobj(16 + zlib.MAX_WBITS)
+        if self.encoding == DEFLATE:
+            return zlib.decompressobj()
+        if self.encoding == BROTLI:
+            return brotli.Decompressor()
+        if self.encoding == ZSTD:
+            return zstandard.ZstdDecompressor().decompressobj()
+        return lz4.frame.LZ4FrameDecompressor()
+
+    def decompress(self, chunk: bytes) -> bytes:
+        if self.encoding == BROTLI:
+            return self._decoder.process(chunk)
+        parts = []
+        while chunk:
+            if self._decoder.eof:
+                # The next frame starts
+                self._decoder = self._new_decoder()
+            parts.append(self._decoder.decompress(chunk))
+            chunk = (self._decoder.unused_data or b"") if self._decoder.eof else b""
+        return b"".join(parts)
+
+    def finish(self) -> bytes:
+        if self.encoding in (GZIP, DEFLATE):
+            return self._decoder.flush()
+        return b""
+
+
+class CompressedBodyCache:
+    """
+    LRU of serialized response bodies and their compressed variants, limited by total bytes.
+    Keys must identify an immutable version of the data.
+    """
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        # key -> {encoding or "identity": body}
+        self._entries: "OrderedDict[Hashable, Dict[str, bytes]]" = OrderedDict()
+        self.total_bytes = 0
+
+    def get(self, key: Hashable, encoding: str) -> Optional[bytes]:
+        variants = self._entries.get(key)
+        if variants is None or encoding not in variants:
+            return None
+        self._entries.move_to_end(key)
+        return variants[encoding]
+
+    def set(self, key: Hashable, encoding: str, body: bytes) -> None:
+        if self.max_bytes <= 0 or len(body) > self.max_bytes:
+            return
+        variants = self._entries.setdefault(key, {})
+        self._entries.move_to_end(key)
+        previous = variants.get(encoding)
+        if previous is not None:
+            self.total_bytes -= len(previous)
+        variants[encoding] = body
+        self.total_bytes += len(body)
+        while self.total_bytes > self.max_bytes and self._entries:
+            _, evicted = self._entries.popitem(last=False)
+            self.total_bytes -= sum(len(value) for value in evicted.values())
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self.total_bytes = 0
+
+
+compressed_body_cache = CompressedBodyCache(settings.COMPRESSED_CACHE_MAX_BYTES)
+
+IDENTITY = "identity"
+
+
+async def cached_response(
+    request: Request,
+    key: Hashable,
+    render: Callable[[], bytes],
+    media_type: str = "application/json",
+    route: Optional[str] = None
+) -> Response:
+    """
+    Response for a body that depends only on `key`, with the serialized body and
+    its compressed variants kept in compressed_body_cache
+
+    Args:
+        key: Identifies the cached data version the body is built from
+        render: Serializes the body, called on a miss only
+        route: Route template selecting the compression policy
+    """
+    body = compressed_body_cache.get(key, IDENTITY)
+    record_cache_access("compressed_body", body is not None)
+    if body is None:
+        body = render()
+        compressed_body_cache.set(key, IDENTITY, body)
+
+    headers = {"Vary": "Accept-Encoding"}
+    policy = route_policies().get(route) or default_policy()
+    encoding = None
+    if settings.COMPRESSION_ENABLED and policy.enabled and len(body) >= policy.min_size:
+        encoding = negotiate(request.headers.get("accept-encoding", ""), server_preference())
+    if encoding is None:
+        return Response(body, media_type=media_type, headers=headers)
+
+    compressed = compressed_body_cache.get(key, encoding)
+    if compressed is None:
+        compressed = await compress_body(encoding, body, policy.levels[encoding])
+        compressed_body_cache.set(key, encoding, compressed)
+    headers["Content-Encoding"] = encoding
+    # Quotas and size metrics count the body before compression, as for bodies compressed by the middleware
+    request.state.uncompressed_bytes = len(body)
+    return Response(compressed, media_type=media_type, headers=headers)
@@ -1,5 +1,5 @@
 from pydantic_settings import BaseSettings
-from typing import Optional
+from typing import Dict, Optional
 
 class Settings(BaseSettings):
     REGISTRATION_ENABLED: bool = False        # Registration is disabled by default
@@ -18,6 +18,134 @@ class Settings(BaseSettings):
     CLICKHOUSE_USER: str
     CLICKHOUSE_PASSWORD: str
     CLICKHOUSE_DATABASE: str
+    CLICKHOUSE_QUERY_CACHE_TTL: Dict[str, int] = {}  # Per query name: seconds ClickHouse reuses results, e.g. {"available_symbols": 60}
+    CLICKHOUSE_COMPRESSION: str = "none"                  # Transport compression: none, lz4, zstd, gzip, br
+    CLICKHOUSE_COMPRESSION_LEVEL: Optional[int] = None    # http_zlib_compression_level for gzip/deflate, server default if unset
+    CLICKHOUSE_REQUEST_COMPRESSION_MIN_SIZE: int = -1     # Compress query bodies from this size in bytes, -1 never
+
+    # Clickhouse admission control (per worker)
+    CLICKHOUSE_MAX_CONCURRENT_QUERIES: int = 32                 # Upper bound of the adaptive concurrency cap
+    CLICKHOUSE_MIN_CONCURRENT_QUERIES: int = 4                  # Lower bound of the adaptive concurrency cap
+    CLICKHOUSE_ADMISSION_ADAPTIVE: bool = True                  # Adjust the cap from observed query latency
+    CLICKHOUSE_ADMISSION_TARGET_LATENCY_SECONDS: float = 1.0    # Slower queries shrink the cap
+    CLICKHOUSE_ADMISSION_QUEUE_SIZE: int = 200                  # Waiting queries above this are rejected
+    CLICKHOUSE_ADMISSION_WAIT_ADMIN_SECONDS: float = 5.0        # Max wait for a slot per priority class,
+    CLICKHOUSE_ADMISSION_WAIT_INTERACTIVE_SECONDS: float = 2.0  # then 503 with Retry-After
+    CLICKHOUSE_ADMISSION_WAIT_BULK_SECONDS: float = 0.5
+
+    # Clickhouse cost limits per role, sent as query settings; "system" applies to background queries
+    CLICKHOUSE_ROLE_LIMITS: Dict[str, Dict[str, int]] = {
+        "user": {
+            "max_rows_to_read": 100_000_000, "max_bytes_to_read": 10 * 1024 ** 3, "max_result_rows": 1_000_000,
+            "max_execution_time": 20, "priority": 2, "preflight_max_rows": 50_000_000
+        },
+        "admin": {"max_execution_time": 120, "priority": 1},
+    }
+    CLICKHOUSE_PREFLIGHT_ENABLED: bool = False                  # EXPLAIN ESTIMATE large queries, reject above preflight_max_rows
+
+    # Clickhouse circuit breaker and stale data fallback
+    CLICKHOUSE_BREAKER_FAILURE_THRESHOLD: int = 5               # Consecutive failures that open the circuit
+    CLICKHOUSE_BREAKER_RECOVERY_SECONDS: float = 10.0           # Open time before a probe query is let through
+    STALE_DATA_MAX_AGE_SECONDS: float = 3600.0                  # Older last known good results are not served
+    STALE_DATA_MAX_ROWS: int = 200000                           # Rows kept for stale fallback per worker
+
+    # API logs
+    API_LOG_BATCH_SIZE: int = 500                       # Log entries written per transaction
+    API_LOG_FLUSH_INTERVAL_SECONDS: float = 1.0         # Max delay before buffered logs are written
+    API_LOG_QUEUE_MAX_SIZE: int = 10000                 # Entries above this are dropped
+    API_LOG_RETENTION_DAYS: int = 30                    # Raw logs older than this are compacted, 0 = keep all
+    API_LOG_RETENTION_INTERVAL_SECONDS: int = 3600      # How often the retention job runs
+
+    # Metrics
+    METRICS_MULTIPROCESS_DIR: Optional[str] = None      # Shared dir to aggregate metrics of several workers
+    METRICS_FLUSH_INTERVAL_SECONDS: float = 5.0         # How often a worker publishes its metrics there
+
+    # Per-request profiling for admins (X-Profile: 1 header or ?profile=1)
+    PROFILING_ENABLED: bool = False
+    PROFILING_SAMPLE_RATE: float = 1.0                  # Share of flagged requests that are profiled
+    PROFILING_DETERMINISTIC: bool = True                # cProfile the request, False = phase timings only
+    PROFILING_TOP_FUNCTIONS: int = 40                   # Functions kept in the stored profile
+    PROFILING_DIR: str = "logs/profiles"
+    PROFILING_MAX_STORED: int = 100
+
+    # Tracing: Server-Timing header and trace export for sampled requests
+    TRACING_SAMPLE_RATE: float = 0.0                    # Share of requests traced, 0 = off
+    TRACING_EXPORT: Optional[str] = None                # "stdout" or a file path, {pid} is replaced
+
+    # Startup
+    RUN_MIGRATIONS_ON_STARTUP: bool = False             # Apply migrations in the app process, run.py does it before starting
+    WARMUP_DB_CONNECTIONS: int = 4                      # Pooled db connections opened during warmup
+    WARMUP_CLICKHOUSE_CONNECTIONS: int = 4              # ClickHouse keep-alive connections opened during warmup
+    WARMUP_RETRY_SECONDS: float = 1.0                   # First retry delay of a failed warmup step, doubles up to 30s
+
+    # Response compression
+    COMPRESSION_ENABLED: bool = True
+    COMPRESSION_ENCODINGS: str = "zstd,br,gzip"         # Server preference, br and zstd need the brotli and zstandard packages
+    COMPRESSION_MIN_SIZE: int = 1024                    # Smaller bodies are sent uncompressed, -1 = never compress
+    COMPRESSION_GZIP_LEVEL: int = 6
+    COMPRESSION_BROTLI_LEVEL: int = 4
+    COMPRESSION_ZSTD_LEVEL: int = 3
+    COMPRESSION_THREAD_MIN_SIZE: int = 256 * 1024       # Larger bodies are compressed off the event loop
+    COMPRESSION_ROUTES: Dict[str, Dict[str, int]] = {}  # Per route template: min_size, gzip_level, brotli_level, zstd_level
+    COMPRESSED_CACHE_MAX_BYTES: int = 16 * 1024 * 1024  # Serialized and compressed bodies of cached responses
+
+    # Per-user rate limits and quotas (token buckets), admins can override them per role and user
+    RATE_LIMIT_ENABLED: bool = True
+    RATE_LIMIT_ROLES: Dict[str, Dict[str, float]] = {   # Defaults per role, 0 or missing = unlimited
+        "user": {"requests_per_minute": 600, "request_burst": 60, "rows_per_minute": 600000, "rows_burst": 100000}
+    }
+    RATE_LIMIT_STATE_PATH: Optional[str] = None         # Bucket table shared by workers, run.py --prod creates one per server
+    RATE_LIMIT_SLOTS: int = 65536                       # Users tracked at once, 40 bytes each
+
+    # Replay of historical rows (/crypto/replay)
+    REPLAY_MAX_SYMBOLS: int = 10                        # Symbols merged by one replay
+    REPLAY_CHUNK_ROWS: int = 2000                       # Rows per symbol and query, a replay holds two chunks per symbol
+    REPLAY_BATCH_ROWS: int = 1000                       # Rows per streamed batch (NDJSON chunk or WebSocket message)
+
+    # Incremental sync of polling clients (/crypto/sync)
+    SYNC_MAX_SYMBOLS: int = 100                         # Symbols (watermarks) per sync request
+    SYNC_MAX_ROWS_PER_SYMBOL: int = 1000                # Largest limit, rows newer than the watermark per symbol
+    SYNC_MAX_DECIMALS: int = 8                          # Floats with more decimals are sent as plain values
+
+    # Caches (per worker process)
+    SYMBOLS_CACHE_TTL_SECONDS: float = 60.0             # Active symbols list, 0 = no caching
+
+    # Cache shared by all workers in memory, refreshed by one of them
+    SHARED_CACHE_ENABLED: bool = False
+    SHARED_CACHE_PATH: Optional[str] = None             # Segment file, run.py --prod creates one per server
+    SHARED_CACHE_SIZE_BYTES: int = 32 * 1024 * 1024     # Each of the two buffers of the segment
+    SHARED_CACHE_REFRESH_SECONDS: float = 1.0
+    SHARED_CACHE_ROWS_PER_SYMBOL: int = 1000            # Latest rows kept per symbol, larger limits query ClickHouse
+    SHARED_CACHE_MAX_AGE_SECONDS: float = 10.0          # Older content is ignored, e.g. if the writer hangs
+
+    # Per-symbol first/last event_time and rows per day, used to prune range queries (per worker)
+    SYMBOL_INDEX_ENABLED: bool = True
+    SYMBOL_INDEX_REFRESH_SECONDS: float = 60.0          # Recounts the days that may have changed
+    SYMBOL_INDEX_REBUILD_SECONDS: float = 6 * 3600      # Counts the whole table again
+    SYMBOL_INDEX_MAX_AGE_SECONDS: float = 300.0         # Older index (failing refresh) is not used for pruning
+    SYMBOL_INDEX_PATH: Optional[str] = None             # Segment file shared by the workers, run.py --prod creates one per server
+    SYMBOL_INDEX_SIZE_BYTES: int = 16 * 1024 * 1024     # Each of the two buffers of the segment
+
+    # On-disk cache of closed historical time buckets (requests with start/end)
+    HISTORY_CACHE_ENABLED: bool = True
+    HISTORY_CACHE_DIR: str = "data/history_cache"
+    HISTORY_CACHE_MAX_BYTES: int = 1024 * 1024 * 1024   # LRU size budget of the cache files
+    HISTORY_CACHE_BUCKET_SECONDS: int = 3600            # Time bucket of one cache file
+    HISTORY_CACHE_IMMUTABLE_AFTER_SECONDS: int = 300    # Data older than this never changes
+    HISTORY_CACHE_MAX_BUCKETS_PER_QUERY: int = 24       # Missing buckets fetched by one ClickHouse query
+
+    # Server (python run.py --prod)
+    SERVER_HOST: str = "0.0.0.0"
+    SERVER_PORT: int = 8000
+    SERVER_WORKERS: int = 1                             # Worker processes, 0 = one per CPU core
+    SERVER_LOOP: str = "auto"                           # auto (uvloop if installed), uvloop or asyncio
+    SERVER_HTTP: str = "auto"                           # auto (httptools if installed), httptools or h11
+    SERVER_BACKLOG: int = 2048                          # Pending connections queue of the listening socket
+    SERVER_KEEPALIVE_SECONDS: int = 5                   # Idle keep-alive connections are closed after this
+    SERVER_LIMIT_MAX_REQUESTS: Optional[int] = None     # Recycle a worker after this many requests
+    SERVER_LIMIT_MAX_REQUESTS_JITTER: int = 0           # Random extra requests per worker, so they don't restart together
+    SERVER_GRACEFUL_SHUTDOWN_SECONDS: int = 30          # Time for in-flight requests when a worker stops
+    SERVER_ACCESS_LOG: bool = False                     # uvicorn access log, requests are logged to the db anyway
     
     class Config:
         env_file = ".env"
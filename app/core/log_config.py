@@ -0,0 +1,43 @@
+import logging
+import os
+from logging.handlers import RotatingFileHandler
+
+
+_configured = False
+
+
+def setup_logging():
+    """Configures app logging once per process (file and console handlers)"""
+    global _configured
+    if _configured:
+        return
+    _configured = True
+
+    log_dir = "logs"
+    if not os.path.exists(log_dir):
+        os.makedirs(log_dir)    
+    
+    formatter = logging.Formatter(
+        '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )    
+    
+    file_handler = RotatingFileHandler(
+        f'{log_dir}/app.log',
+        maxBytes=5242880,  # 5 MB
+        backupCount=2
+    )
+    file_handler.setFormatter(formatter)
+    file_handler.setLevel(logging.INFO)    
+    
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(formatter)
+    console_handler.setLevel(logging.DEBUG)    
+    
+    root_logger = logging.getLogger()
+    root_logger.setLevel(logging.INFO)
+    root_logger.addHandler(file_handler)
+    root_logger.addHandler(console_handler)    
+    
+    logging.getLogger('app').setLevel(logging.DEBUG)
+    logging.getLogger('sqlalchemy.engine').setLevel(logging.WARNING)
+    logging.getLogger('aiohttp').setLevel(logging.WARNING)
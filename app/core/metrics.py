@@ -0,0 +1,478 @@
+"""
+In-process metrics registry with Prometheus text exposition.
+
+Metrics are plain dicts updated from the event loop thread, so recording is
+lock-free. With several uvicorn workers each process periodically dumps a
+snapshot to METRICS_MULTIPROCESS_DIR and /metrics merges the snapshots of all
+workers. Counters and histograms of dead workers are folded into an archive
+file so totals stay monotonic across worker restarts.
+"""
+import fcntl
+import json
+import os
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+# Latency buckets in seconds
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+LabelValues = Tuple[str, ...]
+
+
+class _Metric(ABC):
+    type_name = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    @abstractmethod
+    def snapshot(self) -> list:
+        """[[label values, value], ...] as written to the multiprocess files"""
+
+
+class Counter(_Metric):
+    type_name = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {} if self.labelnames else {(): 0}
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        values = self._values
+        values[labels] = values.get(labels, 0) + amount
+
+    def snapshot(self) -> list:
+        return [[list(labels), value] for labels, value in self._values.items()]
+
+
+class Gauge(_Metric):
+    """
+    Gauge set directly or computed at collection time by a callback.
+    Values of live workers are summed across processes, or their maximum
+    is taken with multiprocess_mode="max" (e.g. for configuration values).
+    """
+    type_name = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        callback: Optional[Callable[[], Dict[LabelValues, float]]] = None,
+        multiprocess_mode: str = "sum"
+    ):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+        self._callback = callback
+        self.multiprocess_mode = multiprocess_mode
+
+    def set(self, *labels: str, value: float) -> None:
+        self._values[labels] = value
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        values = self._values
+        values[labels] = values.get(labels, 0) + amount
+
+    def dec(self, *labels: str, amount: float = 1) -> None:
+        self.inc(*labels, amount=-amount)
+
+    def set_callback(self, callback: Callable[[], Dict[LabelValues, float]]) -> None:
+        self._callback = callback
+
+    def snapshot(self) -> list:
+        values = dict(self._values)
+        if self._callback is not None:
+            try:
+                values.update(self._callback())
+            except Exception as e:
+                logger.debug(f"Gauge {self.name} callback failed: {e}")
+        return [[list(labels), value] for labels, value in values.items()]
+
+
+class Histogram(_Metric):
+    type_name = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # labels -> [count per bucket..., count above last bucket, sum]
+        self._values: Dict[LabelValues, List[float]] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        state = self._values.get(labels)
+        if state is None:
+            state = self._values[labels] = [0] * (len(self.buckets) + 2)
+        state[bisect_left(self.buckets, value)] += 1
+        state[-1] += value
+
+    def snapshot(self) -> list:
+        return [[list(labels), list(state)] for labels, state in self._values.items()]
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        callback=None,
+        multiprocess_mode: str = "sum"
+    ) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames, callback, multiprocess_mode))
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS
+    ) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def snapshot(self) -> Dict[str, list]:
+        return {name: metric.snapshot() for name, metric in self._metrics.items()}
+
+    def render(self, snapshots: Optional[List[Dict[str, list]]] = None) -> str:
+        """
+        Renders metrics in Prometheus text format
+
+        Args:
+            snapshots: Snapshots of all processes. Defaults to this process only.
+        """
+        if snapshots is None:
+            snapshots = [self.snapshot()]
+
+        lines = []
+        for name, metric in self._metrics.items():
+            merged: Dict[LabelValues, object] = {}
+            for snapshot in snapshots:
+                for labels, value in snapshot.get(name, ()):
+                    key = tuple(labels)
+                    if isinstance(metric, Histogram):
+                        current = merged.get(key)
+                        merged[key] = value if current is None else [a + b for a, b in zip(current, value)]
+                    elif isinstance(metric, Gauge) and metric.multiprocess_mode == "max":
+                        merged[key] = max(merged.get(key, value), value)
+                    else:
+                        merged[key] = merged.get(key, 0) + value
+
+            lines.append(f"# HELP {name} {metric.documentation}")
+            lines.append(f"# TYPE {name} {metric.type_name}")
+            for labels, value in sorted(merged.items()):
+                if isinstance(metric, Histogram):
+                    lines.extend(_render_histogram(metric, labels, value))
+                else:
+                    lines.append(f"{name}{_format_labels(metric.labelnames, labels)} {_format_value(value)}")
+
+        return "\n".join(lines) + "\n"
+
+
+def _render_histogram(metric: Histogram, labels: LabelValues, state: List[float]) -> List[str]:
+    lines = []
+    cumulative = 0
+    for bound, count in zip(metric.buckets, state):
+        cumulative += count
+        label_str = _format_labels(metric.labelnames + ("le",), labels + (_format_value(bound),))
+        lines.append(f"{metric.name}_bucket{label_str} {_format_value(cumulative)}")
+    cumulative += state[len(metric.buckets)]
+    label_str = _format_labels(metric.labelnames + ("le",), labels + ("+Inf",))
+    lines.append(f"{metric.name}_bucket{label_str} {_format_value(cumulative)}")
+    label_str = _format_labels(metric.labelnames, labels)
+    lines.append(f"{metric.name}_sum{label_str} {_format_value(state[-1])}")
+    lines.append(f"{metric.name}_count{label_str} {_format_value(cumulative)}")
+    return lines
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        pairs.append(f"{name}=\"{value}\"")
+    return "{" + ",".join(pairs) + "}"
+
+
+def _format_value(value: float) -> str:
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class MultiProcessCollector:
+    """
+    Shares metric snapshots between worker processes through a directory.
+    """
+    ARCHIVE_FILE = "archive.json"
+    LOCK_FILE = ".lock"
+
+    def __init__(self, registry: MetricsRegistry, directory: str):
+        self.registry = registry
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, pid: int) -> str:
+        return os.path.join(self.directory, f"worker_{pid}.json")
+
+    def write_snapshot(self) -> None:
+        path = self._path(os.getpid())
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.registry.snapshot(), f)
+        os.replace(tmp_path, path)
+
+    def collect(self) -> List[Dict[str, list]]:
+        """
+        Writes this worker's snapshot and returns snapshots of all workers
+        """
+        self.write_snapshot()
+
+        with open(os.path.join(self.directory, self.LOCK_FILE), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            archive_path = os.path.join(self.directory, self.ARCHIVE_FILE)
+            archive = self._load(archive_path) or {}
+            archive_changed = False
+            snapshots = []
+
+            for filename in os.listdir(self.directory):
+                if not (filename.startswith("worker_") and filename.endswith(".json")):
+                    continue
+                pid = int(filename[len("worker_"):-len(".json")])
+                path = os.path.join(self.directory, filename)
+                snapshot = self._load(path)
+                if snapshot is None:
+                    continue
+
+                if _pid_alive(pid):
+                    snapshots.append(snapshot)
+                else:
+                    # Keep counters and histograms of dead workers, drop their gauges
+                    self._merge_into_archive(archive, snapshot)
+                    archive_changed = True
+                    os.remove(path)
+
+            if archive_changed:
+                with open(f"{archive_path}.tmp", "w") as f:
+                    json.dump(archive, f)
+                os.replace(f"{archive_path}.tmp", archive_path)
+
+        snapshots.append(archive)
+        return snapshots
+
+    def _merge_into_archive(self, archive: Dict[str, list], snapshot: Dict[str, list]) -> None:
+        for name, metric in self.registry._metrics.items():
+            if isinstance(metric, Gauge) or name not in snapshot:
+                continue
+            merged = {tuple(labels): value for labels, value in archive.get(name, [])}
+            for labels, value in snapshot[name]:
+                key = tuple(labels)
+                current = merged.get(key)
+                if current is None:
+                    merged[key] = value
+                elif isinstance(metric, Histogram):
+                    merged[key] = [a + b for a, b in zip(current, value)]
+                else:
+                    merged[key] = current + value
+            archive[name] = [[list(labels), value] for labels, value in merged.items()]
+
+    @staticmethod
+    def _load(path: str) -> Optional[Dict[str, list]]:
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+registry = MetricsRegistry()
+
+# HTTP
+http_requests_total = registry.counter(
+    "http_requests_total", "HTTP requests by route template and status code",
+    ("method", "route", "status")
+)
+http_request_duration_seconds = registry.histogram(
+    "http_request_duration_seconds", "HTTP request latency by route template",
+    ("method", "route")
+)
+http_response_bytes_total = registry.counter(
+    "http_response_bytes_total", "Response body bytes by route template, before compression",
+    ("method", "route")
+)
+http_requests_in_flight = registry.gauge(
+    "http_requests_in_flight", "HTTP requests currently being processed"
+)
+http_compressed_responses_total = registry.counter(
+    "http_compressed_responses_total", "Responses compressed by the compression middleware by encoding",
+    ("encoding",)
+)
+http_compression_seconds = registry.histogram(
+    "http_compression_seconds", "Time spent compressing complete response bodies by encoding",
+    ("encoding",)
+)
+
+# ClickHouse
+clickhouse_query_duration_seconds = registry.histogram(
+    "clickhouse_query_duration_seconds", "ClickHouse query latency including response decoding",
+    ("outcome",)
+)
+clickhouse_queries_in_flight = registry.gauge(
+    "clickhouse_queries_in_flight", "ClickHouse queries currently running"
+)
+clickhouse_pool_connections = registry.gauge(
+    "clickhouse_pool_connections", "ClickHouse HTTP connection pool usage",
+    ("state",)
+)
+clickhouse_admission_limit = registry.gauge(
+    "clickhouse_admission_limit", "Current adaptive cap of concurrent ClickHouse queries"
+)
+clickhouse_admission_queue_depth = registry.gauge(
+    "clickhouse_admission_queue_depth", "ClickHouse queries waiting for admission by priority",
+    ("priority",)
+)
+clickhouse_admission_wait_seconds = registry.histogram(
+    "clickhouse_admission_wait_seconds", "Time ClickHouse queries waited for admission by priority",
+    ("priority",)
+)
+clickhouse_admission_rejected_total = registry.counter(
+    "clickhouse_admission_rejected_total", "ClickHouse queries rejected by admission control",
+    ("priority", "reason")
+)
+clickhouse_read_rows_total = registry.counter(
+    "clickhouse_read_rows_total", "Rows read by ClickHouse by query name, from the response summary",
+    ("query",)
+)
+clickhouse_read_bytes_total = registry.counter(
+    "clickhouse_read_bytes_total", "Bytes read by ClickHouse by query name, from the response summary",
+    ("query",)
+)
+clickhouse_query_cache_requests_total = registry.counter(
+    "clickhouse_query_cache_requests_total", "Queries sent with use_query_cache by query name and result (hit/miss)",
+    ("query", "result")
+)
+clickhouse_role_limit = registry.gauge(
+    "clickhouse_role_limit", "Configured ClickHouse cost limits by role and setting",
+    ("role", "setting"), multiprocess_mode="max"
+)
+clickhouse_cost_rejected_total = registry.counter(
+    "clickhouse_cost_rejected_total",
+    "Queries rejected as too expensive by role and reason (preflight estimate or ClickHouse limit)",
+    ("role", "reason")
+)
+clickhouse_preflight_estimated_rows = registry.histogram(
+    "clickhouse_preflight_estimated_rows", "Rows EXPLAIN ESTIMATE expects pre-flighted queries to read",
+    ("query",), buckets=(1e3, 1e4, 1e5, 1e6, 1e7, 1e8, 1e9)
+)
+clickhouse_wire_bytes_total = registry.counter(
+    "clickhouse_wire_bytes_total", "Bytes exchanged with ClickHouse as sent on the wire, by query name and direction (sent/received)",
+    ("query", "direction")
+)
+clickhouse_response_bytes_total = registry.counter(
+    "clickhouse_response_bytes_total", "ClickHouse response bytes after decompression by query name",
+    ("query",)
+)
+clickhouse_decompression_seconds = registry.histogram(
+    "clickhouse_decompression_seconds", "Time spent decompressing a ClickHouse response by query name",
+    ("query",), buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5)
+)
+replay_sessions = registry.gauge(
+    "replay_sessions", "Replays currently streaming"
+)
+replay_stall_seconds = registry.histogram(
+    "replay_stall_seconds", "Time a replay waited for the prefetched next chunk of a symbol",
+    buckets=(0.0001, 0.001, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+)
+sync_symbols_total = registry.counter(
+    "sync_symbols_total", "Symbols of sync requests by where their new rows came from (shared/clickhouse)",
+    ("source",)
+)
+clickhouse_circuit_state = registry.gauge(
+    "clickhouse_circuit_state", "ClickHouse circuit breaker state: 0 closed, 1 half-open, 2 open; the most open worker",
+    multiprocess_mode="max"
+)
+clickhouse_circuit_rejected_total = registry.counter(
+    "clickhouse_circuit_rejected_total", "ClickHouse queries failed fast by the open circuit breaker"
+)
+
+# Caches
+cache_requests_total = registry.counter(
+    "cache_requests_total", "Cache lookups by cache name and result (hit/miss)",
+    ("cache", "result")
+)
+history_cache_bytes = registry.gauge(
+    "history_cache_bytes", "Size of the on-disk history cache files, as of the last directory scan of a worker",
+    multiprocess_mode="max"
+)
+history_cache_evictions_total = registry.counter(
+    "history_cache_evictions_total", "History cache files removed to stay within the size budget"
+)
+symbol_index_age_seconds = registry.gauge(
+    "symbol_index_age_seconds", "Age of the symbol metadata index, the oldest of the workers",
+    multiprocess_mode="max"
+)
+symbol_index_pruned_total = registry.counter(
+    "symbol_index_pruned_total", "Range queries narrowed or answered empty (no query) by the symbol index",
+    ("result",)
+)
+shared_cache_age_seconds = registry.gauge(
+    "shared_cache_age_seconds", "Age of the content of the cache shared by the workers",
+    multiprocess_mode="max"
+)
+shared_cache_writer = registry.gauge(
+    "shared_cache_writer", "1 in the worker that refreshes the shared cache"
+)
+stale_responses_total = registry.counter(
+    "stale_responses_total", "Responses served from last known good data because ClickHouse failed",
+    ("endpoint",)
+)
+
+# Rate limits
+rate_limit_rejected_total = registry.counter(
+    "rate_limit_rejected_total", "Requests rejected with 429 by role and exhausted limit",
+    ("role", "limit")
+)
+
+# API log writer
+api_log_queue_depth = registry.gauge(
+    "api_log_queue_depth", "API log entries waiting to be written"
+)
+api_log_dropped_total = registry.counter(
+    "api_log_dropped_total", "API log entries dropped because the queue was full"
+)
+
+
+def record_cache_access(cache: str, hit: bool) -> None:
+    cache_requests_total.inc(cache, "hit" if hit else "miss")
@@ -0,0 +1,174 @@
+"""
+Opt-in per-request profiling.
+
+A request is profiled when profiling is enabled in settings, the client asks
+for it (X-Profile header or ?profile=1) and the request wins the sampling
+draw. The request is traced from the start, but cProfile, which slows down
+every request of the worker while it runs, is only started once the auth
+dependency has resolved an admin user (start_requested_profile). Phase
+timings come from the request's trace spans (see app.core.tracing).
+"""
+import cProfile
+import io
+import json
+import os
+import pstats
+import random
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+from app.core.config import settings
+from app.core.tracing import Trace
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+PROFILE_HEADER = "x-profile"
+PROFILE_QUERY_PARAM = "profile"
+# Request state keys: the trace of a request asking for a profile, the started profile
+PROFILE_TRACE_STATE = "profile_trace"
+PROFILE_STATE = "profile"
+
+
+class RequestProfile:
+    def __init__(self, method: str, path: str, trace: Trace, deterministic: bool = True):
+        self.method = method
+        self.path = path
+        self.trace = trace
+        self.started_at = datetime.now(timezone.utc)
+        self.profiler = cProfile.Profile() if deterministic else None
+
+    @property
+    def id(self) -> str:
+        return self.trace.id
+
+    def start_profiler(self) -> None:
+        if self.profiler is not None:
+            self.profiler.enable()
+
+    def stop(self) -> None:
+        if self.profiler is not None:
+            self.profiler.disable()
+
+    def to_dict(self, username: Optional[str] = None, status_code: Optional[int] = None) -> Dict[str, Any]:
+        stats_text = None
+        if self.profiler is not None:
+            stream = io.StringIO()
+            stats = pstats.Stats(self.profiler, stream=stream)
+            stats.sort_stats("cumulative").print_stats(settings.PROFILING_TOP_FUNCTIONS)
+            stats_text = stream.getvalue()
+
+        return {
+            "id": self.id,
+            "method": self.method,
+            "path": self.path,
+            "username": username,
+            "status_code": status_code,
+            "started_at": self.started_at.isoformat(),
+            "duration_ms": round((self.trace.end - self.trace.start) * 1000, 3),
+            "phases": self.trace.span_dicts(),
+            "profile": stats_text
+        }
+
+
+# cProfile can profile only one request at a time per thread
+_profiler_busy = False
+
+
+def profiling_requested(headers, query_params) -> bool:
+    flag = headers.get(PROFILE_HEADER) or query_params.get(PROFILE_QUERY_PARAM)
+    if flag not in ("1", "true", "yes"):
+        return False
+    # Only authenticated requests can belong to an admin
+    if not headers.get("authorization"):
+        return False
+    return random.random() < settings.PROFILING_SAMPLE_RATE
+
+
+def start_profile(method: str, path: str, trace: Trace) -> RequestProfile:
+    global _profiler_busy
+    deterministic = settings.PROFILING_DETERMINISTIC and not _profiler_busy
+
+    profile = RequestProfile(method, path, trace, deterministic=deterministic)
+    if deterministic:
+        _profiler_busy = True
+        profile.start_profiler()
+    return profile
+
+
+def start_requested_profile(state: Dict[str, Any], method: str, path: str) -> None:
+    """
+    Starts the profile a request asked for; called by the auth dependency
+    for admin users. The middleware leaves the trace of flagged requests
+    in the request state and finishes the profile.
+    """
+    trace = state.pop(PROFILE_TRACE_STATE, None)
+    if trace is not None:
+        state[PROFILE_STATE] = start_profile(method, path, trace)
+
+
+def finish_profile(profile: RequestProfile) -> None:
+    global _profiler_busy
+    if profile.profiler is not None:
+        profile.stop()
+        _profiler_busy = False
+
+
+class ProfileStore:
+    """
+    Stores profiles as JSON files, so any worker can serve them.
+    Keeps at most max_profiles newest files.
+    """
+    def __init__(self, directory: str, max_profiles: int):
+        self.directory = directory
+        self.max_profiles = max_profiles
+
+    def _path(self, profile_id: str) -> str:
+        return os.path.join(self.directory, f"{profile_id}.json")
+
+    def save(self, data: Dict[str, Any]) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self._path(data["id"]), "w") as f:
+            json.dump(data, f)
+        self._prune()
+
+    def get(self, profile_id: str) -> Optional[Dict[str, Any]]:
+        # Ids are trace ids (hex), anything else can't be a stored profile
+        if len(profile_id) != 16 or not all(c in "0123456789abcdef" for c in profile_id):
+            return None
+        try:
+            with open(self._path(profile_id)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def list(self, limit: int = 50) -> List[Dict[str, Any]]:
+        summaries = []
+        for path in self._files()[:limit]:
+            try:
+                with open(path) as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue
+            data.pop("profile", None)
+            summaries.append(data)
+        return summaries
+
+    def _files(self) -> List[str]:
+        if not os.path.isdir(self.directory):
+            return []
+        paths = [
+            os.path.join(self.directory, name)
+            for name in os.listdir(self.directory) if name.endswith(".json")
+        ]
+        return sorted(paths, key=os.path.getmtime, reverse=True)
+
+    def _prune(self) -> None:
+        for path in self._files()[self.max_profiles:]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+profile_store = ProfileStore(settings.PROFILING_DIR, settings.PROFILING_MAX_STORED)
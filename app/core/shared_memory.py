@@ -0,0 +1,204 @@
+"""
+Memory segment shared by the worker processes of one server.
+
+The segment is a file (on /dev/shm when available) mapped by every worker.
+Exactly one worker, the one holding an exclusive flock on "<path>.lock",
+writes it; the others only read. When the writer exits the lock is released
+by the OS and another worker takes over.
+
+Layout:
+
+    header:   magic "LOBS", version u32, buffer size u64, sequence u64
+    buffer 0: content length u64, published at f64, content
+    buffer 1: same
+
+Publishing is a seqlock over two buffers. The sequence is even while no
+write is in progress; version k = sequence // 2 lives in buffer k % 2. The
+writer sets the sequence odd, fills the other buffer and sets it even
+again, so the published buffer is never written and reads never wait.
+A reader remembers the sequence, reads the buffer of its version in place
+and checks afterwards that the writer has not started to overwrite it,
+i.e. that the sequence is still below 2 * k + 3, otherwise it retries.
+"""
+import mmap
+import os
+import struct
+import tempfile
+import time
+from typing import Any, Callable, Optional, Tuple
+import logging
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"LOBS"
+VERSION = 1
+
+_HEADER = struct.Struct("<4sIQQ")
+_SEQUENCE_OFFSET = 16
+_BUFFER_HEADER = struct.Struct("<Qd")
+# Buffers start page aligned
+_BUFFERS_OFFSET = 4096
+
+
+class SegmentFullError(Exception):
+    pass
+
+
+def default_segment_path(name: str) -> str:
+    """A segment of this process only; run.py passes one path to all workers of a server"""
+    directory = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+    return os.path.join(directory, f"lob-api-{name}-{os.getpid()}")
+
+
+class SharedSegment:
+    def __init__(self, path: str, buffer_size: int):
+        self.path = path
+        self.buffer_size = buffer_size
+        self._file = None
+        self._mmap: Optional[mmap.mmap] = None
+        self._lock_file = None
+
+    @property
+    def is_writer(self) -> bool:
+        return self._lock_file is not None
+
+    @property
+    def can_elect_writer(self) -> bool:
+        """False where file locks are unavailable (Windows): nobody becomes the writer"""
+        return fcntl is not None
+
+    @property
+    def capacity(self) -> int:
+        return self.buffer_size - _BUFFER_HEADER.size
+
+    def open(self) -> None:
+        if self._mmap is not None:
+            return
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        self._file = os.fdopen(fd, "r+b")
+        size = os.fstat(fd).st_size
+        # The first worker sizes the file, the others map what is there
+        if size == 0:
+            os.ftruncate(fd, _BUFFERS_OFFSET + 2 * self.buffer_size)
+        else:
+            (_, _, buffer_size, _) = _HEADER.unpack(os.pread(fd, _HEADER.size, 0))
+            if buffer_size:
+                self.buffer_size = buffer_size
+        self._mmap = mmap.mmap(fd, 0)
+
+    def close(self) -> None:
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def try_become_writer(self) -> bool:
+        """Takes the writer lock if no other process holds it"""
+        if self.is_writer:
+            return True
+        if fcntl is None:
+            return False
+        lock_file = open(f"{self.path}.lock", "a+b")
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+        self._resize()
+        return True
+
+    def _resize(self) -> None:
+        """The writer owns the layout: applies the configured buffer size"""
+        required = _BUFFERS_OFFSET + 2 * self.buffer_size
+        self._mmap.close()
+        os.ftruncate(self._file.fileno(), max(required, os.fstat(self._file.fileno()).st_size))
+        self._mmap = mmap.mmap(self._file.fileno(), 0)
+        (magic, _, buffer_size, _) = _HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC or buffer_size != self.buffer_size:
+            # Sequence 1: nothing published yet, readers fall back until the first publish
+            _HEADER.pack_into(self._mmap, 0, MAGIC, VERSION, self.buffer_size, 1)
+
+    def _sequence(self) -> int:
+        return struct.unpack_from("<Q", self._mmap, _SEQUENCE_OFFSET)[0]
+
+    def _set_sequence(self, sequence: int) -> None:
+        struct.pack_into("<Q", self._mmap, _SEQUENCE_OFFSET, sequence)
+
+    def _buffer_offset(self, version: int) -> int:
+        return _BUFFERS_OFFSET + (version % 2) * self.buffer_size
+
+    def publish(self, content: bytes) -> int:
+        """Writes a new version. Only the writer may call it. Returns the version."""
+        if not self.is_writer:
+            raise RuntimeError("Only the writer process can publish")
+        if len(content) > self.capacity:
+            raise SegmentFullError(f"Content of {len(content)} bytes exceeds the buffer of {self.capacity} bytes")
+        sequence = self._sequence()
+        version = sequence // 2 + 1
+        offset = self._buffer_offset(version)
+        self._set_sequence(2 * version - 1)
+        _BUFFER_HEADER.pack_into(self._mmap, offset, len(content), time.time())
+        start = offset + _BUFFER_HEADER.size
+        self._mmap[start:start + len(content)] = content
+        self._set_sequence(2 * version)
+        return version
+
+    def read(self, reader: Callable[[int, float, memoryview], Any], retries: int = 3) -> Optional[Tuple[int, Any]]:
+        """
+        Calls reader(version, published_at, content) on the published content in place
+
+        The content view is only valid during the call, the reader must copy
+        what it keeps. Its result is discarded when the content changed while
+        it ran. Returns (version, result), or None when nothing is published
+        or every attempt raced with the writer.
+        """
+        if self._mmap is None:
+            return None
+        (magic, _, buffer_size, _) = _HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC:
+            return None
+        if buffer_size != self.buffer_size:
+            # A new writer changed the layout
+            self.buffer_size = buffer_size
+            self._mmap.close()
+            self._mmap = mmap.mmap(self._file.fileno(), 0)
+            if len(self._mmap) < _BUFFERS_OFFSET + 2 * buffer_size:
+                return None
+        for _ in range(retries):
+            sequence = self._sequence()
+            version = sequence // 2
+            if version == 0:
+                return None
+            offset = self._buffer_offset(version)
+            length, published_at = _BUFFER_HEADER.unpack_from(self._mmap, offset)
+            start = offset + _BUFFER_HEADER.size
+            result = None
+            valid = length <= self.capacity
+            if valid:
+                with memoryview(self._mmap)[start:start + length] as content:
+                    try:
+                        result = reader(version, published_at, content)
+                    except Exception:
+                        # A torn read can fail to decode, the check below decides
+                        valid = False
+            if self._sequence() < 2 * version + 3:
+                if valid:
+                    return version, result
+                logger.warning(f"Shared segment {self.path} version {version} is unreadable")
+                return None
+        return None
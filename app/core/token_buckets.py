@@ -0,0 +1,201 @@
+"""
+Token buckets kept in a memory mapped table, shared by the worker processes
+of one server when it is backed by a file.
+
+Each key (a user id) owns one slot holding up to BUCKETS token buckets that
+are refilled together. A slot is found by hashing the key and probing at
+most MAX_PROBES neighbours, so every operation is O(1). When all probed
+slots are taken, the one idle for the longest time is reused: its buckets
+have refilled by then anyway, unless the table is far too small.
+
+Layout:
+
+    header: magic "LOBR", version u32, slots u64, config generation u64
+    slot:   key i64 (0 = empty), updated at f64, tokens f64 * BUCKETS
+
+Updates take an exclusive flock on the file, held only for the slot
+update. Without a path, or without fcntl (Windows), the table lives in
+process memory and limits apply per process.
+
+The config generation is a counter that processes bump when the limits
+change, so the others know to reload them.
+"""
+import math
+import mmap
+import os
+import struct
+import time
+from typing import List, Optional, Sequence, Tuple
+import logging
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"LOBR"
+VERSION = 1
+BUCKETS = 3
+MAX_PROBES = 8
+
+_HEADER = struct.Struct("<4sIQQ")
+_GENERATION_OFFSET = 16
+_SLOTS_OFFSET = 64
+_SLOT = struct.Struct(f"<qd{BUCKETS}d")
+
+# (refill rate in tokens per second, capacity), rate 0 = unlimited
+Bucket = Tuple[float, float]
+
+
+class TokenBucketTable:
+    def __init__(self, path: Optional[str], slots: int):
+        self.path = path if fcntl is not None else None
+        self.slots = max(slots, MAX_PROBES)
+        self._file = None
+        self._mmap: Optional[mmap.mmap] = None
+
+    @property
+    def shared(self) -> bool:
+        return self.path is not None
+
+    def open(self) -> None:
+        if self._mmap is not None:
+            return
+        size = _SLOTS_OFFSET + self.slots * _SLOT.size
+        if self.path is None:
+            self._mmap = mmap.mmap(-1, size)
+            _HEADER.pack_into(self._mmap, 0, MAGIC, VERSION, self.slots, 0)
+            return
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        self._file = os.fdopen(fd, "r+b")
+        with self._locked():
+            current = os.fstat(fd).st_size
+            if current >= _HEADER.size:
+                (magic, _, slots, _) = _HEADER.unpack(os.pread(fd, _HEADER.size, 0))
+                if magic == MAGIC and slots and current >= _SLOTS_OFFSET + slots * _SLOT.size:
+                    # The first process sized the table, the others use it as is
+                    self.slots = slots
+                    self._mmap = mmap.mmap(fd, 0)
+                    return
+            os.ftruncate(fd, size)
+            self._mmap = mmap.mmap(fd, 0)
+            _HEADER.pack_into(self._mmap, 0, MAGIC, VERSION, self.slots, 0)
+
+    def close(self) -> None:
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _locked(self):
+        return _FileLock(self._file)
+
+    def _find_slot(self, key: int) -> Tuple[int, bool]:
+        """(slot offset, whether it already belongs to key); claims a free or the idlest slot"""
+        start = hash(key) % self.slots
+        idlest, idlest_updated = None, math.inf
+        for probe in range(MAX_PROBES):
+            offset = _SLOTS_OFFSET + ((start + probe) % self.slots) * _SLOT.size
+            slot_key, updated = struct.unpack_from("<qd", self._mmap, offset)
+            if slot_key == key:
+                return offset, True
+            if slot_key == 0:
+                return offset, False
+            if updated < idlest_updated:
+                idlest, idlest_updated = offset, updated
+        return idlest, False
+
+    def acquire(
+        self,
+        key: int,
+        buckets: Sequence[Bucket],
+        cost: Sequence[float],
+        required: Optional[Sequence[float]] = None
+    ) -> Tuple[bool, List[float]]:
+        """
+        Refills the buckets of a key and takes `cost` tokens from them
+
+        Args:
+            buckets: (rate, capacity) per bucket, unlimited buckets are left alone
+            cost: Tokens to take from each bucket, a bucket can go into debt
+            required: Tokens each limited bucket must hold for the cost to be
+                taken, None to always take it
+
+        Returns:
+            (whether the cost was taken, tokens left in each bucket)
+        """
+        self.open()
+        now = time.time()
+        with self._locked():
+            offset, existing = self._find_slot(key)
+            tokens = [capacity for _, capacity in buckets] + [0.0] * (BUCKETS - len(buckets))
+            if existing:
+                values = _SLOT.unpack_from(self._mmap, offset)
+                elapsed = max(0.0, now - values[1])
+                for index, (rate, capacity) in enumerate(buckets):
+                    tokens[index] = min(capacity, values[2 + index] + rate * elapsed)
+
+            allowed = required is None or all(
+                tokens[index] >= required[index]
+                for index, (rate, _) in enumerate(buckets) if rate > 0
+            )
+            if allowed:
+                for index, (rate, _) in enumerate(buckets):
+                    if rate > 0:
+                        tokens[index] -= cost[index]
+            _SLOT.pack_into(self._mmap, offset, key, now, *tokens)
+        return allowed, tokens[:len(buckets)]
+
+    def peek(self, key: int, buckets: Sequence[Bucket]) -> List[float]:
+        """Current tokens of a key without changing them"""
+        self.open()
+        now = time.time()
+        with self._locked():
+            offset, existing = self._find_slot(key)
+            if not existing:
+                return [capacity for _, capacity in buckets]
+            values = _SLOT.unpack_from(self._mmap, offset)
+        elapsed = max(0.0, now - values[1])
+        return [min(capacity, values[2 + index] + rate * elapsed) for index, (rate, capacity) in enumerate(buckets)]
+
+    def reset(self, key: int) -> None:
+        """Refills the buckets of a key: the slot is marked as never used"""
+        self.open()
+        with self._locked():
+            offset, existing = self._find_slot(key)
+            if existing:
+                # Keep the key so probing past this slot still finds other keys
+                _SLOT.pack_into(self._mmap, offset, key, 0.0, *([math.inf] * BUCKETS))
+
+    def generation(self) -> int:
+        self.open()
+        return struct.unpack_from("<Q", self._mmap, _GENERATION_OFFSET)[0]
+
+    def bump_generation(self) -> int:
+        self.open()
+        with self._locked():
+            generation = struct.unpack_from("<Q", self._mmap, _GENERATION_OFFSET)[0] + 1
+            struct.pack_into("<Q", self._mmap, _GENERATION_OFFSET, generation)
+        return generation
+
+
+class _FileLock:
+    """Exclusive flock on the table file, a no-op for a table in process memory"""
+    def __init__(self, file):
+        self.file = file
+
+    def __enter__(self):
+        if self.file is not None:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+
+    def __exit__(self, *exc):
+        if self.file is not None:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
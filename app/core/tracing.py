@@ -0,0 +1,206 @@
+"""
+Lightweight request tracing.
+
+A trace is started by the request middleware for sampled requests and
+kept in a contextvar. Code on the hot path wraps its phases in span():
+when the request is not traced this is a single contextvar lookup that
+returns a shared no-op context manager.
+
+Finished traces are summarized in the Server-Timing response header and
+optionally exported in Chrome Trace Event format (viewable in Perfetto
+or chrome://tracing).
+"""
+import itertools
+import json
+import os
+import random
+import sys
+import time
+import uuid
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional
+from app.core.config import settings
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+class Span:
+    __slots__ = ("name", "start", "end", "parent", "attrs", "_token")
+
+    def __init__(self, name: str, parent: Optional["Span"], attrs: Dict[str, Any]):
+        self.name = name
+        self.parent = parent
+        self.attrs = attrs
+        self.start = 0.0
+        self.end = 0.0
+
+    @property
+    def duration(self) -> float:
+        return self.end - self.start
+
+    def __enter__(self):
+        self._token = _current_span.set(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.end = time.perf_counter()
+        _current_span.reset(self._token)
+        if exc_type is not None:
+            self.attrs["error"] = exc_type.__name__
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.spans.append(self)
+        return False
+
+    def set(self, key: str, value: Any) -> None:
+        self.attrs[key] = value
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+    def set(self, key: str, value: Any) -> None:
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+_trace_seq = itertools.count(1)
+
+
+class Trace:
+    def __init__(self, name: str):
+        self.id = uuid.uuid4().hex[:16]
+        self.seq = next(_trace_seq)
+        self.name = name
+        self.spans: List[Span] = []
+        self.start = time.perf_counter()
+        self.wall_start = time.time()
+        self.end = 0.0
+
+    def finish(self) -> None:
+        self.end = time.perf_counter()
+
+    def span_dicts(self) -> List[Dict[str, Any]]:
+        """Spans ordered by start time, with times in ms relative to the trace start"""
+        return [
+            {
+                "name": span.name,
+                "parent": span.parent.name if span.parent else None,
+                "start_ms": round((span.start - self.start) * 1000, 3),
+                "duration_ms": round(span.duration * 1000, 3),
+                **({"attrs": span.attrs} if span.attrs else {})
+            }
+            for span in sorted(self.spans, key=lambda s: s.start)
+        ]
+
+    def server_timing(self) -> str:
+        """Server-Timing header value: total duration per span name"""
+        totals: Dict[str, float] = {}
+        for span in self.spans:
+            totals[span.name] = totals.get(span.name, 0.0) + span.duration
+        metrics = [f"{name};dur={duration * 1000:.3f}" for name, duration in totals.items()]
+        metrics.append(f"total;dur={(self.end - self.start) * 1000:.3f}")
+        return ", ".join(metrics)
+
+    def chrome_events(self) -> List[Dict[str, Any]]:
+        pid = os.getpid()
+        events = [{
+            "name": self.name, "cat": "request", "ph": "X", "pid": pid, "tid": self.seq,
+            "ts": int(self.wall_start * 1e6), "dur": int((self.end - self.start) * 1e6),
+            "args": {"trace_id": self.id}
+        }]
+        for span in self.spans:
+            events.append({
+                "name": span.name, "cat": span.name.split(".", 1)[0], "ph": "X", "pid": pid, "tid": self.seq,
+                "ts": int((self.wall_start + span.start - self.start) * 1e6),
+                "dur": int(span.duration * 1e6),
+                "args": {"trace_id": self.id, **span.attrs}
+            })
+        return events
+
+
+_current_trace: ContextVar[Optional[Trace]] = ContextVar("current_trace", default=None)
+_current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+
+def span(name: str, **attrs: Any):
+    """
+    Context manager timing a phase of the current request
+
+    Args:
+        name: Span name, dotted by component, e.g. "clickhouse.network"
+        attrs: Extra attributes exported with the span
+    """
+    if _current_trace.get() is None:
+        return _NOOP_SPAN
+    return Span(name, _current_span.get(), attrs)
+
+
+def current_trace() -> Optional[Trace]:
+    return _current_trace.get()
+
+
+def should_sample() -> bool:
+    rate = settings.TRACING_SAMPLE_RATE
+    return rate > 0 and (rate >= 1 or random.random() < rate)
+
+
+def start_trace(name: str) -> Trace:
+    trace = Trace(name)
+    _current_trace.set(trace)
+    _current_span.set(None)
+    return trace
+
+
+def end_trace(trace: Trace) -> None:
+    trace.finish()
+    _current_trace.set(None)
+    if trace_exporter is not None:
+        try:
+            trace_exporter.export(trace)
+        except Exception as e:
+            logger.error(f"Failed to export trace: {e}")
+
+
+class ChromeTraceExporter:
+    """
+    Appends trace events to a JSON array file, or writes them to stdout one per line.
+    The trace event format allows the closing bracket of the array to be omitted.
+    """
+    def __init__(self, target: str):
+        self.target = target
+        self._file = None
+
+    def _open(self):
+        if self.target == "stdout":
+            return sys.stdout
+        if self._file is None:
+            path = self.target.format(pid=os.getpid())
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._file = open(path, "a")
+            if self._file.tell() == 0:
+                self._file.write("[\n")
+        return self._file
+
+    def export(self, trace: Trace) -> None:
+        out = self._open()
+        lines = "".join(json.dumps(event) + ",\n" for event in trace.chrome_events())
+        if self.target == "stdout":
+            lines = lines.replace(",\n", "\n")
+        out.write(lines)
+        out.flush()
+
+
+trace_exporter = ChromeTraceExporter(settings.TRACING_EXPORT) if settings.TRACING_EXPORT else None
@@ -0,0 +1,228 @@
+"""
+Admission control for ClickHouse queries.
+
+Caps the number of concurrent queries of a worker. Queries above the cap
+wait in a priority queue for a bounded time per priority class and are
+rejected fast (ClickHouseOverloadedError -> 503 with Retry-After) when the
+queue is full or the wait runs out, instead of piling up on the connection
+pool until the HTTP timeout.
+
+The cap adapts to observed query latency (AIMD): it grows by one query per
+round trip while queries are fast and the cap is reached, and shrinks by
+a factor when latency exceeds the target or queries fail with timeouts.
+
+The priority of a query comes from a contextvar: the auth dependency sets
+it for admins, replay chunk fetches and the background refreshes of the
+symbol index and the shared cache run under `query_priority(PRIORITY_BULK)`.
+Everything else is interactive.
+"""
+import asyncio
+import heapq
+import itertools
+import math
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Tuple
+from app.core.config import settings
+from app.core.metrics import (
+    clickhouse_admission_limit, clickhouse_admission_queue_depth,
+    clickhouse_admission_rejected_total, clickhouse_admission_wait_seconds
+)
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_ADMIN = "admin"
+PRIORITY_INTERACTIVE = "interactive"
+PRIORITY_BULK = "bulk"
+
+# Lower value is served first
+PRIORITY_ORDER = {PRIORITY_ADMIN: 0, PRIORITY_INTERACTIVE: 1, PRIORITY_BULK: 2}
+
+_query_priority: ContextVar[str] = ContextVar("clickhouse_query_priority", default=PRIORITY_INTERACTIVE)
+
+
+class ClickHouseOverloadedError(Exception):
+    """Query rejected by admission control"""
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def set_query_priority(priority: str) -> None:
+    """Sets the priority of ClickHouse queries made by the current request"""
+    _query_priority.set(priority)
+
+
+@contextmanager
+def query_priority(priority: str):
+    token = _query_priority.set(priority)
+    try:
+        yield
+    finally:
+        _query_priority.reset(token)
+
+
+class AdmissionController:
+    def __init__(
+        self,
+        max_limit: int,
+        min_limit: int,
+        initial_limit: Optional[int] = None,
+        target_latency: float = 1.0,
+        adaptive: bool = True,
+        max_queue_size: int = 200,
+        max_wait: Optional[Dict[str, float]] = None,
+        decrease_factor: float = 0.9
+    ):
+        self.max_limit = max_limit
+        self.min_limit = max(1, min(min_limit, max_limit))
+        self.limit = float(initial_limit or max_limit)
+        self.target_latency = target_latency
+        self.adaptive = adaptive
+        self.max_queue_size = max_queue_size
+        self.max_wait = max_wait or {}
+        self.decrease_factor = decrease_factor
+        self.in_flight = 0
+        self.latency_ewma: Optional[float] = None
+        # (priority order, seq, priority, future)
+        self._queue: List[Tuple[int, int, str, asyncio.Future]] = []
+        # Queued futures not granted, timed out or cancelled yet; the heap
+        # also holds abandoned ones until they are popped
+        self._waiting = 0
+        self._seq = itertools.count()
+        self._last_decrease = 0.0
+
+    @property
+    def queue_depth(self) -> int:
+        return self._waiting
+
+    def queue_depths(self) -> Dict[tuple, int]:
+        depths = {(priority,): 0 for priority in PRIORITY_ORDER}
+        for _, _, priority, future in self._queue:
+            if not future.done():
+                depths[(priority,)] += 1
+        return depths
+
+    def retry_after(self) -> int:
+        """Seconds until the current queue is likely drained, as a Retry-After hint"""
+        latency = self.latency_ewma or self.target_latency
+        seconds = (self._waiting + 1) * latency / max(1.0, self.limit)
+        return max(1, min(30, math.ceil(seconds)))
+
+    def _reject(self, priority: str, reason: str) -> ClickHouseOverloadedError:
+        clickhouse_admission_rejected_total.inc(priority, reason)
+        return ClickHouseOverloadedError(
+            f"ClickHouse is overloaded ({reason}), try again later", self.retry_after()
+        )
+
+    async def acquire(self, priority: Optional[str] = None) -> None:
+        priority = priority or _query_priority.get()
+        if priority not in PRIORITY_ORDER:
+            priority = PRIORITY_INTERACTIVE
+
+        # Drops abandoned waiters and serves queued ones first
+        self._grant_waiters()
+        if self.in_flight < int(self.limit):
+            self.in_flight += 1
+            clickhouse_admission_wait_seconds.observe(0.0, priority)
+            return
+
+        max_wait = self.max_wait.get(priority, 0.0)
+        if max_wait <= 0:
+            raise self._reject(priority, "limit")
+        if self._waiting >= self.max_queue_size:
+            raise self._reject(priority, "queue_full")
+
+        started = time.perf_counter()
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (PRIORITY_ORDER[priority], next(self._seq), priority, future))
+        self._waiting += 1
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout=max_wait)
+        except asyncio.TimeoutError:
+            if future.done() and not future.cancelled():
+                # Granted at the same moment the wait ran out, hand the slot on
+                self._release_slot()
+            else:
+                self._abandon(future)
+            raise self._reject(priority, "timeout")
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self._release_slot()
+            else:
+                self._abandon(future)
+            raise
+        clickhouse_admission_wait_seconds.observe(time.perf_counter() - started, priority)
+
+    def release(self, latency: Optional[float] = None, overloaded: bool = False) -> None:
+        """
+        Args:
+            latency: Duration of the finished query, None if it didn't reach ClickHouse
+            overloaded: The query failed in a way that signals overload (timeout, connection error)
+        """
+        if self.adaptive:
+            self._adapt(latency, overloaded)
+        self._release_slot()
+
+    def _release_slot(self) -> None:
+        self.in_flight -= 1
+        self._grant_waiters()
+
+    def _abandon(self, future: asyncio.Future) -> None:
+        """Takes a timed out or cancelled waiter out of the queue"""
+        future.cancel()
+        self._waiting -= 1
+        # Abandoned entries are skipped when popped; drop them once they outnumber
+        # the live ones, so a queue that is never granted doesn't keep growing
+        if len(self._queue) > 2 * self._waiting + 16:
+            self._queue = [entry for entry in self._queue if not entry[3].done()]
+            heapq.heapify(self._queue)
+
+    def _grant_waiters(self) -> None:
+        while self._queue and self.in_flight < int(self.limit):
+            _, _, _, future = heapq.heappop(self._queue)
+            if future.done():
+                continue  # timed out or cancelled
+            self._waiting -= 1
+            self.in_flight += 1
+            future.set_result(None)
+
+    def _adapt(self, latency: Optional[float], overloaded: bool) -> None:
+        if latency is not None:
+            self.latency_ewma = latency if self.latency_ewma is None else 0.8 * self.latency_ewma + 0.2 * latency
+
+        now = time.monotonic()
+        too_slow = overloaded or (latency is not None and latency > self.target_latency)
+        if too_slow:
+            # At most once per target latency, queries started before a decrease
+            # would otherwise shrink the limit again for the same congestion
+            if now - self._last_decrease >= self.target_latency:
+                previous = int(self.limit)
+                self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+                self._last_decrease = now
+                if int(self.limit) != previous:
+                    logger.warning(f"ClickHouse admission limit decreased to {int(self.limit)}")
+        elif latency is not None and self.in_flight >= int(self.limit):
+            # Additive increase: about one extra slot per round trip of all slots
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self._grant_waiters()
+        clickhouse_admission_limit.set(value=int(self.limit))
+
+
+admission_controller = AdmissionController(
+    max_limit=settings.CLICKHOUSE_MAX_CONCURRENT_QUERIES,
+    min_limit=settings.CLICKHOUSE_MIN_CONCURRENT_QUERIES,
+    target_latency=settings.CLICKHOUSE_ADMISSION_TARGET_LATENCY_SECONDS,
+    adaptive=settings.CLICKHOUSE_ADMISSION_ADAPTIVE,
+    max_queue_size=settings.CLICKHOUSE_ADMISSION_QUEUE_SIZE,
+    max_wait={
+        PRIORITY_ADMIN: settings.CLICKHOUSE_ADMISSION_WAIT_ADMIN_SECONDS,
+        PRIORITY_INTERACTIVE: settings.CLICKHOUSE_ADMISSION_WAIT_INTERACTIVE_SECONDS,
+        PRIORITY_BULK: settings.CLICKHOUSE_ADMISSION_WAIT_BULK_SECONDS,
+    }
+)
+clickhouse_admission_limit.set(value=int(admission_controller.limit))
+clickhouse_admission_queue_depth.set_callback(admission_controller.queue_depths)
@@ -0,0 +1,94 @@
+"""
+Circuit breaker for ClickHouse.
+
+After failure_threshold consecutive failed queries the circuit opens and
+queries fail immediately with ClickHouseUnavailableError instead of waiting
+for timeouts. After recovery_timeout one probe query is let through
+(half-open): its success closes the circuit, its failure opens it again.
+"""
+import math
+import time
+from app.core.config import settings
+from app.core.metrics import clickhouse_circuit_state, clickhouse_circuit_rejected_total
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+STATE_CLOSED = "closed"
+STATE_HALF_OPEN = "half_open"
+STATE_OPEN = "open"
+
+STATE_VALUES = {STATE_CLOSED: 0, STATE_HALF_OPEN: 1, STATE_OPEN: 2}
+
+
+class ClickHouseUnavailableError(Exception):
+    """ClickHouse is failing, the query was not sent"""
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold: int, recovery_timeout: float):
+        self.failure_threshold = max(1, failure_threshold)
+        self.recovery_timeout = recovery_timeout
+        self.state = STATE_CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+
+    def retry_after(self) -> int:
+        remaining = self.opened_at + self.recovery_timeout - time.monotonic()
+        return max(1, math.ceil(remaining))
+
+    def before_call(self) -> bool:
+        """
+        Raises ClickHouseUnavailableError if the query must not be sent
+
+        Returns:
+            True if the query is the half-open probe
+        """
+        if self.state == STATE_CLOSED:
+            return False
+        if self.state == STATE_OPEN and time.monotonic() - self.opened_at >= self.recovery_timeout:
+            self._set_state(STATE_HALF_OPEN)
+        if self.state == STATE_HALF_OPEN and not self._probe_in_flight:
+            self._probe_in_flight = True
+            return True
+        clickhouse_circuit_rejected_total.inc()
+        raise ClickHouseUnavailableError("ClickHouse is unavailable, try again later", self.retry_after())
+
+    def record_success(self, probe: bool = False) -> None:
+        if probe:
+            self._probe_in_flight = False
+        self.failures = 0
+        if self.state != STATE_CLOSED:
+            logger.info("ClickHouse circuit closed")
+            self._set_state(STATE_CLOSED)
+
+    def record_failure(self, probe: bool = False) -> None:
+        if probe:
+            self._probe_in_flight = False
+        self.failures += 1
+        if self.state == STATE_HALF_OPEN or (
+            self.state == STATE_CLOSED and self.failures >= self.failure_threshold
+        ):
+            logger.warning(f"ClickHouse circuit opened after {self.failures} failures")
+            self.opened_at = time.monotonic()
+            self._set_state(STATE_OPEN)
+
+    def release_probe(self) -> None:
+        """The probe ended without telling anything about ClickHouse health"""
+        self._probe_in_flight = False
+
+    def _set_state(self, state: str) -> None:
+        self.state = state
+        clickhouse_circuit_state.set(value=STATE_VALUES[state])
+
+
+circuit_breaker = CircuitBreaker(
+    failure_threshold=settings.CLICKHOUSE_BREAKER_FAILURE_THRESHOLD,
+    recovery_timeout=settings.CLICKHOUSE_BREAKER_RECOVERY_SECONDS
+)
+clickhouse_circuit_state.set(value=STATE_VALUES[STATE_CLOSED])
@@ -1,12 +1,69 @@
+import asyncio
 import aiohttp
 from app.core.config import settings
+from app.db.admission import admission_controller, ClickHouseOverloadedError
+from app.db.circuit_breaker import circuit_breaker
+from app.db.query_limits import current_role, limit_settings, preflight_max_rows
+from app.core.tracing import span
+from app.core.compression import DECODABLE_ENCODINGS, DEFLATE, GZIP, BROTLI, ZSTD, LZ4, StreamDecompressor, compress
+from app.core.metrics import (
+    clickhouse_query_duration_seconds, clickhouse_queries_in_flight, clickhouse_pool_connections,
+    clickhouse_read_rows_total, clickhouse_read_bytes_total, clickhouse_query_cache_requests_total,
+    clickhouse_cost_rejected_total, clickhouse_preflight_estimated_rows,
+    clickhouse_wire_bytes_total, clickhouse_response_bytes_total, clickhouse_decompression_seconds
+)
+import json
 import logging
-from typing import List, Dict, Any, Optional
+import re
+import time
+from typing import List, Dict, Any, Optional, Tuple
 
 
 logger = logging.getLogger(__name__)
 
 
+class ClickHouseQueryError(Exception):
+    """ClickHouse answered with an error status"""
+    def __init__(self, message: str, status: int):
+        super().__init__(message)
+        self.status = status
+
+
+class QueryTooExpensiveError(ClickHouseQueryError):
+    """The query exceeds the cost limits of the role, by its estimate or while running"""
+    def __init__(self, message: str):
+        super().__init__(message, 400)
+
+
+# Query bodies are small and latency sensitive: fastest levels
+_REQUEST_COMPRESSION_LEVELS = {GZIP: 1, DEFLATE: 1, BROTLI: 1, ZSTD: 1, LZ4: 0}
+
+# ClickHouse errors of queries stopped by their own limits
+# (TOO_MANY_ROWS, TIMEOUT_EXCEEDED, TOO_MANY_BYTES, TOO_MANY_ROWS_OR_BYTES)
+LIMIT_ERROR_CODES = {158, 159, 307, 396}
+_ERROR_CODE_RE = re.compile(r"Code:\s*(\d+)")
+
+
+def query_cache_settings(name: str, nondeterministic: bool = False) -> Dict[str, Any]:
+    """
+    Settings to serve a query from the ClickHouse query cache, empty unless
+    CLICKHOUSE_QUERY_CACHE_TTL opts the query in
+
+    Args:
+        name: Query name, the key in CLICKHOUSE_QUERY_CACHE_TTL
+        nondeterministic: The query uses now() or similar, ClickHouse only
+            caches it when told to keep the result for the TTL anyway
+    """
+    ttl = settings.CLICKHOUSE_QUERY_CACHE_TTL.get(name)
+    if not ttl:
+        return {}
+    # The summary header must describe the finished query to tell hits from misses
+    query_settings = {"use_query_cache": 1, "query_cache_ttl": ttl, "wait_end_of_query": 1}
+    if nondeterministic:
+        query_settings["query_cache_nondeterministic_function_handling"] = "save"
+    return query_settings
+
+
 class AsyncClickHouseClient:
     def __init__(self):
         self.base_url = f"http://{settings.CLICKHOUSE_HOST}:{settings.CLICKHOUSE_PORT}"
@@ -15,9 +72,37 @@ class AsyncClickHouseClient:
             settings.CLICKHOUSE_PASSWORD
         )
         self.database = settings.CLICKHOUSE_DATABASE
+        # Transport compression: responses (enable_http_compression) and optionally query bodies
+        self.compression = self.resolve_compression(settings.CLICKHOUSE_COMPRESSION)
+        self.compression_params: Dict[str, str] = {}
+        if self.compression:
+            self.compression_params["enable_http_compression"] = "1"
+            if settings.CLICKHOUSE_COMPRESSION_LEVEL is not None:
+                self.compression_params["http_zlib_compression_level"] = str(settings.CLICKHOUSE_COMPRESSION_LEVEL)
         self.session: Optional[aiohttp.ClientSession] = None
+        clickhouse_pool_connections.set_callback(self.pool_usage)
         logger.debug("ClickHouse client initialized")
 
+    @staticmethod
+    def resolve_compression(name: str) -> Optional[str]:
+        """Encoding to request, None for uncompressed transport"""
+        name = (name or "none").strip().lower()
+        if name == "none":
+            return None
+        if name not in DECODABLE_ENCODINGS:
+            logger.warning(f"ClickHouse transport compression {name} is not available (missing package?), using none")
+            return None
+        return name
+
+    def pool_usage(self) -> Dict[tuple, int]:
+        if self.session is None or self.session.closed:
+            return {}
+        connector = self.session.connector
+        # aiohttp doesn't expose pool stats publicly
+        acquired = len(getattr(connector, "_acquired", ()))
+        idle = sum(len(conns) for conns in getattr(connector, "_conns", {}).values())
+        return {("acquired",): acquired, ("idle",): idle, ("limit",): connector.limit}
+
     async def connect(self):
         if self.session is None or self.session.closed:
             try:
@@ -31,11 +116,13 @@ class AsyncClickHouseClient:
                     base_url=self.base_url,
                     auth=self.auth,
                     connector=connector,
-                    timeout=aiohttp.ClientTimeout(total=30.0)
+                    timeout=aiohttp.ClientTimeout(total=30.0),
+                    # Bodies are decompressed by read_body, which measures it
+                    auto_decompress=False
                 )
 
                 # Connection check
-                result = await self.execute("SELECT 1 as test")
+                result = await self.execute("SELECT 1 as test", name="connection_check")
                 logger.info("Successfully connected to ClickHouse")
 
             except Exception as e:
@@ -49,66 +136,268 @@ class AsyncClickHouseClient:
             self.session = None
             logger.debug("ClickHouse connection closed")
 
+    @staticmethod
+    def build_query(query: str) -> str:
+        """Adds the output format, params are bound by ClickHouse"""
+        if "FORMAT" not in query.upper():
+            query = f"{query} FORMAT JSON"
+        return query
+
+    @staticmethod
+    def format_param(value: Any) -> str:
+        """
+        Value of a param_<name> URL parameter: ClickHouse parses it as the type
+        of the {name:Type} placeholder, in its escaped text format
+        """
+        if isinstance(value, bool):
+            return "true" if value else "false"
+        if isinstance(value, str):
+            return value.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n")
+        if isinstance(value, (list, tuple)):
+            items = [
+                "'" + item.replace("\\", "\\\\").replace("'", "\\'") + "'" if isinstance(item, str) else str(item)
+                for item in value
+            ]
+            return "[" + ",".join(items) + "]"
+        return str(value)
+
+    @classmethod
+    def build_params(cls, params: Dict[str, Any] = None, query_settings: Dict[str, Any] = None) -> Dict[str, str]:
+        """
+        URL parameters of a query: param_<name> for every placeholder and the query settings
+
+        Args:
+            params: Values of the {name:Type} placeholders in the query
+            query_settings: ClickHouse settings for this query only, e.g. use_query_cache
+        """
+        url_params = {f"param_{key}": cls.format_param(value) for key, value in (params or {}).items()}
+        for key, value in (query_settings or {}).items():
+            url_params[key] = cls.format_param(value)
+        return url_params
+
+    @staticmethod
+    def decode_response(body: bytes) -> List[Dict[str, Any]]:
+        """Rows of a FORMAT JSON response"""
+        return json.loads(body).get('data', [])
+
+    @staticmethod
+    def decode_response_with_meta(body: bytes) -> Tuple[List[Dict[str, str]], List[Dict[str, Any]]]:
+        """Column names and types, and rows of a FORMAT JSON response"""
+        result = json.loads(body)
+        return result.get('meta', []), result.get('data', [])
+
     async def execute(
         self, 
         query: str, 
-        params: Dict[str, Any] = None
+        params: Dict[str, Any] = None,
+        query_settings: Dict[str, Any] = None,
+        name: str = "other",
+        preflight: bool = False
     ) -> List[Dict[str, Any]]:
         """
         Execute SQL query
         
         Args:
-            query: SQL query with placeholders {name}
-            params: Dict of parameters for query
+            query: SQL query with placeholders {name:Type}, constant for a given use
+            params: Dict of parameters for query, sent separately as param_<name>
+            query_settings: ClickHouse settings for this query only
+            name: Query name for metrics and system.query_log (log_comment)
+            preflight: Estimate the rows the query reads first and reject it
+                above the role's preflight_max_rows (CLICKHOUSE_PREFLIGHT_ENABLED)
             
         Returns:
             List of dicts with query results
         """
+        _, rows = await self.execute_with_meta(query, params, query_settings, name, preflight)
+        return rows
+
+    async def execute_with_meta(
+        self,
+        query: str,
+        params: Dict[str, Any] = None,
+        query_settings: Dict[str, Any] = None,
+        name: str = "other",
+        preflight: bool = False
+    ) -> Tuple[List[Dict[str, str]], List[Dict[str, Any]]]:
+        """
+        Execute SQL query, also returning the result columns
+
+        Returns:
+            List of {"name", "type"} dicts of the columns and list of dicts with query results
+        """
         if self.session is None or self.session.closed:
             await self.connect()
 
+        role = current_role()
+        max_rows = preflight_max_rows(role) if preflight else None
+        if max_rows:
+            await self.check_estimate(query, params, name, role, max_rows)
+        # The role's cost limits, explicit settings of the query win
+        query_settings = {**limit_settings(role), **(query_settings or {})}
+
+        # Fails fast while the circuit is open
+        probe = circuit_breaker.before_call()
+        start_time = time.perf_counter()
+        outcome = "error"
+        clickhouse_queries_in_flight.inc()
         try:
-            if "FORMAT" not in query.upper():
-                query = f"{query} FORMAT JSON"
-
-            if params:
-                # ClickHouse uses the {name:DataType} for params
-                formatted_params = {}
-                for key, value in params.items():
-                    if isinstance(value, str):
-                        formatted_params[key] = f"'{value}'"
-                    else:
-                        formatted_params[key] = str(value)
-                
-                # Replacing placeholders in a query
-                for key, value in formatted_params.items():
-                    placeholder = "{" + key + "}"
-                    if placeholder in query:
-                        query = query.replace(placeholder, value)
-            
-            logger.debug(f"Executing ClickHouse query: {query[:200]}...")
-            
-            async with self.session.post(
-                "/",
-                data=query,
-                params={"database": self.database}
-            ) as response:
-
-                if response.status != 200:
-                    error_text = await response.text()
-                    logger.error(f"ClickHouse error {response.status}: {error_text}")
-                    raise Exception(f"ClickHouse error: {error_text}")
-                
-                data = await response.json()
-                logger.debug(f"Query executed successfully, returned {len(data.get('data', []))} rows")
-                return data.get('data', [])
+            with span("clickhouse.execute") as execute_span:
+                query = self.build_query(query)
+                url_params = self.build_params(params, query_settings)
+                url_params["database"] = self.database
+                url_params["log_comment"] = name
+                url_params.update(self.compression_params)
+                data, headers = self.build_body(query)
+                clickhouse_wire_bytes_total.inc(name, "sent", amount=len(data))
+                logger.debug(f"Executing ClickHouse query {name}: {query[:200]}...")
+
+                with span("clickhouse.admission"):
+                    await admission_controller.acquire()
+
+                with span("clickhouse.network"):
+                    network_started = time.perf_counter()
+                    latency = None
+                    overloaded = False
+                    try:
+                        async with self.session.post(
+                            "/",
+                            data=data,
+                            params=url_params,
+                            headers=headers
+                        ) as response:
+
+                            if response.status != 200:
+                                error_body, _ = await self.read_body(response, name)
+                                error_text = error_body.decode(errors="replace")
+                                code = _ERROR_CODE_RE.search(error_text)
+                                if code and int(code.group(1)) in LIMIT_ERROR_CODES:
+                                    logger.warning(f"ClickHouse query {name} stopped by the {role} limits: {error_text}")
+                                    clickhouse_cost_rejected_total.inc(role, "limit")
+                                    raise QueryTooExpensiveError(
+                                        "The query exceeds the ClickHouse resource limits, "
+                                        "narrow the time range or lower the limit"
+                                    )
+                                logger.error(f"ClickHouse error {response.status}: {error_text}")
+                                raise ClickHouseQueryError(f"ClickHouse error: {error_text}", response.status)
+
+                            body, wire_bytes = await self.read_body(response, name)
+                            summary = response.headers.get("X-ClickHouse-Summary")
+                        execute_span.set("wire_bytes", wire_bytes)
+                        execute_span.set("bytes", len(body))
+                        latency = time.perf_counter() - network_started
+                    except (aiohttp.ClientError, asyncio.TimeoutError):
+                        overloaded = True
+                        raise
+                    finally:
+                        # The slot covers the ClickHouse round trip, not decoding
+                        admission_controller.release(latency, overloaded)
+                    circuit_breaker.record_success(probe)
+
+                with span("clickhouse.decode"):
+                    meta, rows = self.decode_response_with_meta(body)
 
+                execute_span.set("rows", len(rows))
+                self.record_summary(name, summary, query_settings)
+                logger.debug(f"Query executed successfully, returned {len(rows)} rows")
+                outcome = "ok"
+                return meta, rows
+
+        except ClickHouseOverloadedError:
+            outcome = "rejected"
+            raise
+        except ClickHouseQueryError as e:
+            # 4xx: the query is wrong, ClickHouse itself is fine
+            if e.status >= 500:
+                circuit_breaker.record_failure(probe)
+            else:
+                circuit_breaker.record_success(probe)
+            raise
         except aiohttp.ClientError as e:
             logger.error(f"ClickHouse HTTP client error: {e}")
+            circuit_breaker.record_failure(probe)
             raise
         except Exception as e:
             logger.error(f"ClickHouse query error: {e}")
+            circuit_breaker.record_failure(probe)
             raise
+        finally:
+            if probe:
+                circuit_breaker.release_probe()
+            clickhouse_queries_in_flight.dec()
+            clickhouse_query_duration_seconds.observe(time.perf_counter() - start_time, outcome)
+
+    def build_body(self, query: str) -> Tuple[bytes, Dict[str, str]]:
+        """Query body and headers, the body compressed when CLICKHOUSE_REQUEST_COMPRESSION_MIN_SIZE allows"""
+        data = query.encode()
+        headers = {"Accept-Encoding": self.compression or "identity"}
+        min_size = settings.CLICKHOUSE_REQUEST_COMPRESSION_MIN_SIZE
+        if self.compression and 0 <= min_size <= len(data):
+            data = compress(self.compression, data, _REQUEST_COMPRESSION_LEVELS[self.compression])
+            headers["Content-Encoding"] = self.compression
+        return data, headers
+
+    @staticmethod
+    async def read_body(response: aiohttp.ClientResponse, name: str) -> Tuple[bytes, int]:
+        """
+        Reads a response chunk by chunk as it arrives, decompressing each
+        chunk right away so decompression overlaps the transfer
+
+        Returns:
+            Decompressed body and its size on the wire
+        """
+        encoding = response.headers.get("Content-Encoding", "identity").strip().lower()
+        decompressor = StreamDecompressor(encoding) if encoding != "identity" else None
+        parts = []
+        wire_bytes = 0
+        decompress_seconds = 0.0
+        async for chunk in response.content.iter_any():
+            wire_bytes += len(chunk)
+            if decompressor is None:
+                parts.append(chunk)
+                continue
+            started = time.perf_counter()
+            parts.append(decompressor.decompress(chunk))
+            decompress_seconds += time.perf_counter() - started
+        if decompressor is not None:
+            started = time.perf_counter()
+            parts.append(decompressor.finish())
+            decompress_seconds += time.perf_counter() - started
+            clickhouse_decompression_seconds.observe(decompress_seconds, name)
+        body = b"".join(parts)
+        clickhouse_wire_bytes_total.inc(name, "received", amount=wire_bytes)
+        clickhouse_response_bytes_total.inc(name, amount=len(body))
+        return body, wire_bytes
+
+    async def check_estimate(self, query: str, params: Optional[Dict[str, Any]], name: str, role: str, max_rows: int) -> None:
+        """Raises QueryTooExpensiveError when EXPLAIN ESTIMATE expects more than max_rows rows to be read"""
+        with span("clickhouse.preflight"):
+            estimate = await self.execute(f"EXPLAIN ESTIMATE {query}", params, name=f"{name}.estimate")
+        rows = sum(int(part.get("rows", 0)) for part in estimate)
+        clickhouse_preflight_estimated_rows.observe(rows, name)
+        if rows > max_rows:
+            clickhouse_cost_rejected_total.inc(role, "preflight")
+            logger.warning(f"Query {name} rejected for role {role}: estimated {rows} rows to read, limit {max_rows}")
+            raise QueryTooExpensiveError(
+                f"The query would read about {rows} rows, more than the {max_rows} allowed, "
+                "narrow the time range"
+            )
+
+    @staticmethod
+    def record_summary(name: str, summary: Optional[str], query_settings: Optional[Dict[str, Any]]) -> None:
+        """Rows and bytes ClickHouse read, from the X-ClickHouse-Summary header"""
+        if not summary:
+            return
+        try:
+            stats = json.loads(summary)
+            read_rows = int(stats.get("read_rows", 0))
+            read_bytes = int(stats.get("read_bytes", 0))
+        except (ValueError, TypeError):
+            return
+        clickhouse_read_rows_total.inc(name, amount=read_rows)
+        clickhouse_read_bytes_total.inc(name, amount=read_bytes)
+        if query_settings and query_settings.get("use_query_cache"):
+            # A result served from the query cache reads nothing
+            clickhouse_query_cache_requests_total.inc(name, "hit" if read_rows == 0 else "miss")
 
     async def __aenter__(self):
         await self.connect()
@@ -0,0 +1,54 @@
+"""
+Schema management, run outside the request-serving processes:
+
+    python -m app.db.migrations
+
+run.py calls it before starting the server. Set RUN_MIGRATIONS_ON_STARTUP
+to apply migrations from the app process instead (e.g. `uvicorn app.main:app`).
+"""
+import os
+from app.db.base import Base
+from app.db.session import engine, SessionLocal
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def get_alembic_config():
+    # alembic is only needed here, keep it out of the app's import time
+    from alembic.config import Config
+
+    config = Config(os.path.join(PROJECT_ROOT, "alembic.ini"))
+    config.set_main_option("script_location", os.path.join(PROJECT_ROOT, "migrations"))
+    # Keep the application's logging configuration
+    config.attributes["configure_logger"] = False
+    return config
+
+
+def run_migrations():
+    """
+    Creates missing tables, applies pending migrations and backfills usage rollups
+    """
+    from alembic import command
+    from app.db.models import user, api_log, api_usage, rate_limit  # noqa: F401 - register models
+    from app.services.usage_service import UsageService
+
+    Base.metadata.create_all(bind=engine)
+    command.upgrade(get_alembic_config(), "head")
+
+    db = SessionLocal()
+    try:
+        UsageService(db).backfill_rollups()
+    finally:
+        db.close()
+    logger.info("Database schema is up to date")
+
+
+if __name__ == "__main__":
+    from app.core.log_config import setup_logging
+
+    setup_logging()
+    run_migrations()
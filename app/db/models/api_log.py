@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime, Text, ForeignKey
+from sqlalchemy import Column, Integer, String, DateTime, Text, ForeignKey, Index
 from sqlalchemy.sql import func
 from sqlalchemy.orm import relationship
 from app.db.base import Base
@@ -16,6 +16,13 @@ class ApiLog(Base):
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     
     user = relationship("User", backref="api_logs")
+
+    # Keyset pagination on (created_at, id), see migrations/versions
+    __table_args__ = (
+        Index("ix_api_logs_created_at_id", "created_at", "id"),
+        Index("ix_api_logs_user_id_created_at_id", "user_id", "created_at", "id"),
+        Index("ix_api_logs_endpoint_created_at_id", "endpoint", "created_at", "id"),
+    )
     
     def __repr__(self):
         return f"<ApiLog(id={self.id}, endpoint='{self.endpoint}', method='{self.method}')>"
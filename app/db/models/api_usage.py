@@ -0,0 +1,37 @@
+from sqlalchemy import Column, Integer, String, Date, UniqueConstraint, Index
+from app.db.base import Base
+
+
+# user_id used in rollups for requests without an authenticated user
+ANONYMOUS_USER_ID = 0
+
+
+class ApiUsageDaily(Base):
+    """Per-day, per-user, per-endpoint request counters"""
+    __tablename__ = "api_usage_daily"
+
+    id = Column(Integer, primary_key=True, index=True)
+    day = Column(Date, nullable=False)
+    user_id = Column(Integer, nullable=False, default=ANONYMOUS_USER_ID)  # 0 for anonymous
+    endpoint = Column(String, nullable=False)
+    request_count = Column(Integer, nullable=False, default=0)
+    error_count = Column(Integer, nullable=False, default=0)    # status_code >= 400
+
+    __table_args__ = (
+        UniqueConstraint("day", "user_id", "endpoint", name="uq_api_usage_daily_key"),
+        Index("ix_api_usage_daily_user_day", "user_id", "day"),
+    )
+
+    def __repr__(self):
+        return f"<ApiUsageDaily(day={self.day}, user_id={self.user_id}, endpoint='{self.endpoint}')>"
+
+
+class ApiCounter(Base):
+    """Named global counters, read by primary key for O(1) stats"""
+    __tablename__ = "api_counters"
+
+    name = Column(String, primary_key=True)
+    value = Column(Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f"<ApiCounter(name='{self.name}', value={self.value})>"
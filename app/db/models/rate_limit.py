@@ -0,0 +1,25 @@
+from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey
+from sqlalchemy.sql import func
+from app.db.base import Base
+
+
+class RateLimit(Base):
+    """
+    Rate limits of a role or of a single user, set through the admin API.
+    Unset fields inherit: user -> role -> RATE_LIMIT_ROLES. 0 means unlimited.
+    """
+    __tablename__ = "rate_limits"
+
+    id = Column(Integer, primary_key=True, index=True)
+    role = Column(String, unique=True, nullable=True)                           # set for role limits
+    user_id = Column(Integer, ForeignKey("users.id"), unique=True, nullable=True)  # set for user limits
+    requests_per_minute = Column(Float, nullable=True)
+    request_burst = Column(Float, nullable=True)
+    rows_per_minute = Column(Float, nullable=True)
+    rows_burst = Column(Float, nullable=True)
+    bytes_per_minute = Column(Float, nullable=True)
+    bytes_burst = Column(Float, nullable=True)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+    def __repr__(self):
+        return f"<RateLimit(role={self.role}, user_id={self.user_id})>"
@@ -0,0 +1,71 @@
+"""
+Per-role cost limits of ClickHouse queries.
+
+Every query made for a request carries the ClickHouse resource settings of
+the user's role from CLICKHOUSE_ROLE_LIMITS (max_rows_to_read,
+max_bytes_to_read, max_result_rows, max_execution_time, priority), so
+ClickHouse aborts it instead of scanning without bounds. Queries outside
+a request (shared cache refresh, warmup) use the "system" entry, if any.
+
+Queries that may be large can also be estimated first with EXPLAIN ESTIMATE
+(CLICKHOUSE_PREFLIGHT_ENABLED): when they would read more than the role's
+preflight_max_rows rows they are rejected before they take an admission
+slot or any ClickHouse time.
+
+The role comes from a contextvar set by the auth dependency, like the
+admission priority.
+"""
+from contextvars import ContextVar
+from typing import Any, Dict, Optional
+from app.core.config import settings
+from app.core.metrics import clickhouse_role_limit
+
+
+SYSTEM_ROLE = "system"
+
+# Sent to ClickHouse as query settings
+CLICKHOUSE_SETTINGS = (
+    "max_rows_to_read", "max_bytes_to_read", "max_result_rows", "max_execution_time", "priority"
+)
+# Checked here, against the EXPLAIN ESTIMATE of the query
+PREFLIGHT_MAX_ROWS = "preflight_max_rows"
+
+_query_role: ContextVar[Optional[str]] = ContextVar("clickhouse_query_role", default=None)
+
+
+def set_query_role(role: str) -> None:
+    """Sets the role whose limits apply to ClickHouse queries made by the current request"""
+    _query_role.set(role)
+
+
+def current_role() -> str:
+    return _query_role.get() or SYSTEM_ROLE
+
+
+def role_limits(role: str) -> Dict[str, Any]:
+    return settings.CLICKHOUSE_ROLE_LIMITS.get(role, {})
+
+
+def limit_settings(role: str) -> Dict[str, Any]:
+    """ClickHouse settings of a role, unset limits are left to the server defaults"""
+    limits = role_limits(role)
+    return {name: limits[name] for name in CLICKHOUSE_SETTINGS if limits.get(name)}
+
+
+def preflight_max_rows(role: str) -> Optional[int]:
+    """Rows a query may be estimated to read, None if the role has no pre-flight limit"""
+    if not settings.CLICKHOUSE_PREFLIGHT_ENABLED:
+        return None
+    return role_limits(role).get(PREFLIGHT_MAX_ROWS) or None
+
+
+def configured_limits() -> Dict[tuple, float]:
+    return {
+        (role, name): value
+        for role, limits in settings.CLICKHOUSE_ROLE_LIMITS.items()
+        for name, value in limits.items()
+        if name in CLICKHOUSE_SETTINGS or name == PREFLIGHT_MAX_ROWS
+    }
+
+
+clickhouse_role_limit.set_callback(configured_limits)
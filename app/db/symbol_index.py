@@ -0,0 +1,315 @@
+"""
+Per-symbol metadata of blob_rest_all_aggregated: first and last event_time,
+row count and rows per UTC day.
+
+The index is built once with an aggregate query over the whole table
+(GROUP BY symbol, day), then kept up to date in the background: each
+refresh recounts only the days from the start of the day that was still
+open at the previous refresh, and replaces them. Rows older than
+HISTORY_CACHE_IMMUTABLE_AFTER_SECONDS never change, so everything before
+`known_until` (refresh time minus that delay) is exact. A full rebuild every
+SYMBOL_INDEX_REBUILD_SECONDS drops data removed from the table since.
+
+Range queries are pruned with it: leading and trailing days without rows,
+time before the first row and the gap after the last known row are cut,
+and a range left empty is answered without a query. Rows of a symbol
+missing from the index can only be from after `known_until`. An index older than SYMBOL_INDEX_MAX_AGE_SECONDS is not used, so
+pruning never hides rows when refreshing fails.
+
+The index is built once per server, not per worker: the worker holding
+the writer lock of a shared segment (app.core.shared_memory) runs the
+aggregate queries and publishes the index as JSON, the other workers adopt
+each published version. When the writer exits another worker takes over
+from the published index, without a full rebuild. A worker refreshes on
+its own only when nothing fresh is published, e.g. without locks on
+Windows, or on a request before its background task ran.
+"""
+import asyncio
+import json
+import os
+import time
+from bisect import bisect_left, bisect_right
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+from app.core.config import settings
+from app.core.metrics import symbol_index_age_seconds, symbol_index_pruned_total
+from app.core.shared_memory import SegmentFullError, SharedSegment, default_segment_path
+from app.db.admission import PRIORITY_BULK, query_priority
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+DAY_MS = 86400 * 1000
+
+# Readers check for a newly published index at least this often
+ADOPT_INTERVAL_SECONDS = 5.0
+
+# load(since) -> rows of symbol, day, rows, first_time, last_time for days from `since`
+Load = Callable[[int], Awaitable[List[Dict[str, Any]]]]
+
+
+@dataclass
+class SymbolMeta:
+    first_time: int
+    last_time: int
+    # Day start (epoch ms, UTC) -> rows, days without rows are left out
+    days: Dict[int, int] = field(default_factory=dict)
+    # Sorted keys of days, for range pruning
+    day_starts: List[int] = field(default_factory=list)
+
+    @property
+    def rows(self) -> int:
+        return sum(self.days.values())
+
+
+class SymbolIndex:
+    def __init__(
+        self,
+        refresh_seconds: float,
+        rebuild_seconds: float,
+        max_age_seconds: float,
+        immutable_after_seconds: float,
+        path: str,
+        buffer_size: int,
+        enabled: bool = True,
+        remove_on_close: bool = False
+    ):
+        self.enabled = enabled
+        self.segment = SharedSegment(path, buffer_size)
+        self.remove_on_close = remove_on_close
+        # Segment version of the content, published or adopted
+        self._segment_version: Optional[int] = None
+        self.refresh_seconds = refresh_seconds
+        self.rebuild_seconds = rebuild_seconds
+        self.max_age_seconds = max_age_seconds
+        self.immutable_after_ms = int(immutable_after_seconds * 1000)
+        self.symbols: Dict[str, SymbolMeta] = {}
+        # Changes with the content, identifies cached responses built from it
+        self.version = 0
+        self.refreshed_at: Optional[float] = None
+        self.built_at: Optional[float] = None
+        # Rows with event_time before this were complete at the last refresh
+        self.known_until = 0
+        self._lock = asyncio.Lock()
+
+    def open(self) -> None:
+        self.segment.open()
+
+    def close(self) -> None:
+        self.segment.close()
+        if self.remove_on_close:
+            for path in (self.segment.path, f"{self.segment.path}.lock"):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def encode(self) -> bytes:
+        return json.dumps({
+            "version": self.version,
+            "refreshed_at": self.refreshed_at,
+            "built_at": self.built_at,
+            "known_until": self.known_until,
+            "symbols": {
+                symbol: [meta.first_time, meta.last_time, [[day, meta.days[day]] for day in meta.day_starts]]
+                for symbol, meta in self.symbols.items()
+            }
+        }, separators=(",", ":")).encode()
+
+    def decode(self, content: bytes) -> None:
+        data = json.loads(content)
+        symbols = {}
+        for symbol, (first_time, last_time, days) in data["symbols"].items():
+            days = dict((day, rows) for day, rows in days)
+            symbols[symbol] = SymbolMeta(first_time, last_time, days, sorted(days))
+        self.symbols = symbols
+        self.version = data["version"]
+        self.refreshed_at = data["refreshed_at"]
+        self.built_at = data["built_at"]
+        self.known_until = data["known_until"]
+
+    async def publish(self) -> None:
+        content = await asyncio.to_thread(self.encode)
+        try:
+            self._segment_version = self.segment.publish(content)
+        except SegmentFullError as e:
+            logger.warning(f"Symbol index is not shared with the other workers, raise SYMBOL_INDEX_SIZE_BYTES: {e}")
+
+    async def adopt(self) -> bool:
+        """Takes over the published index if it is newer than this one. Returns whether it did."""
+        def read_content(version: int, published_at: float, content: memoryview) -> Optional[bytes]:
+            return None if version == self._segment_version else bytes(content)
+
+        result = self.segment.read(read_content)
+        if result is None or result[1] is None:
+            return False
+        version, content = result
+        async with self._lock:
+            await asyncio.to_thread(self.decode, content)
+            self._segment_version = version
+        logger.debug(f"Adopted symbol index version {self.version}: {len(self.symbols)} symbols")
+        return True
+
+    @property
+    def loaded(self) -> bool:
+        return self.refreshed_at is not None
+
+    def usable(self) -> bool:
+        return (
+            self.enabled
+            and self.refreshed_at is not None
+            and time.time() - self.refreshed_at <= self.max_age_seconds
+        )
+
+    def age_seconds(self) -> Dict[tuple, float]:
+        return {(): time.time() - self.refreshed_at} if self.refreshed_at is not None else {}
+
+    def apply(self, rows: List[Dict[str, Any]], since: int, now_ms: int) -> None:
+        """Replaces the days from `since` with the counted rows"""
+        counted: Dict[str, List[Tuple[int, int, int, int]]] = {}
+        for row in rows:
+            counted.setdefault(row["symbol"], []).append(
+                (int(row["day"]), int(row["rows"]), int(row["first_time"]), int(row["last_time"]))
+            )
+
+        symbols = {} if since == 0 else self.symbols
+        for symbol, days in counted.items():
+            meta = symbols.get(symbol)
+            if meta is None:
+                meta = symbols[symbol] = SymbolMeta(first_time=days[0][2], last_time=days[-1][3])
+            for day in [day for day in meta.days if day >= since]:
+                del meta.days[day]
+            for day, count, first_time, last_time in days:
+                meta.days[day] = count
+                meta.first_time = min(meta.first_time, first_time)
+                meta.last_time = max(meta.last_time, last_time)
+            meta.day_starts = sorted(meta.days)
+        self.symbols = symbols
+        self.known_until = now_ms - self.immutable_after_ms
+        self.version += 1
+
+    async def refresh(self, load: Load, rebuild: bool = False) -> None:
+        """Recounts the days that may have changed since the last refresh, or the whole table"""
+        async with self._lock:
+            now = time.time()
+            rebuild = rebuild or self.built_at is None or now - self.built_at >= self.rebuild_seconds
+            since = 0 if rebuild else self.known_until - self.known_until % DAY_MS
+            rows = await load(since)
+            self.apply(rows, since, int(now * 1000))
+            self.refreshed_at = now
+            if rebuild:
+                self.built_at = now
+            logger.debug(f"Symbol index version {self.version}: {len(self.symbols)} symbols, {len(rows)} days counted from {since}")
+
+    async def ensure_fresh(self, load: Load) -> None:
+        """
+        Builds the index on first use and refreshes it when it is too old,
+        e.g. without the background refresh. A failed refresh keeps the old content.
+        """
+        if self.loaded and time.time() - self.refreshed_at <= self.max_age_seconds:
+            return
+        try:
+            await self.adopt()
+            if self.loaded and time.time() - self.refreshed_at <= self.max_age_seconds:
+                return
+            await self.refresh(load)
+        except Exception as e:
+            if not self.loaded:
+                raise
+            logger.warning(f"Symbol index refresh failed, using the index of {time.time() - self.refreshed_at:.0f}s ago: {e}")
+
+    async def run(self, load: Load) -> None:
+        """Refreshes and publishes the index while this worker holds the writer lock, adopts it otherwise"""
+        while True:
+            started = time.monotonic()
+            interval = self.refresh_seconds
+            try:
+                if not self.segment.is_writer and self.segment.try_become_writer():
+                    logger.info(f"This worker (pid {os.getpid()}) builds the symbol index {self.segment.path}")
+                    # Continue from the previous writer's index instead of rebuilding it
+                    await self.adopt()
+                if self.segment.is_writer or not self.segment.can_elect_writer:
+                    # Background work yields ClickHouse slots to requests
+                    with query_priority(PRIORITY_BULK):
+                        await self.refresh(load)
+                    if self.segment.is_writer:
+                        await self.publish()
+                else:
+                    interval = min(interval, ADOPT_INTERVAL_SECONDS)
+                    await self.adopt()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Symbol index refresh failed: {e}")
+            await asyncio.sleep(max(0.0, interval - (time.monotonic() - started)))
+
+    def get(self, symbol: str) -> Optional[SymbolMeta]:
+        return self.symbols.get(symbol)
+
+    def active_symbols(self, since: int) -> List[str]:
+        return sorted(symbol for symbol, meta in self.symbols.items() if meta.last_time >= since)
+
+    def rows_since(self, symbol: str) -> int:
+        """
+        Earliest event_time of rows the symbol can have: known_until when it
+        had no rows at the last refresh, 0 when the index doesn't tell
+        """
+        if not self.usable() or symbol in self.symbols:
+            return 0
+        symbol_index_pruned_total.inc("narrowed")
+        return self.known_until
+
+    def prune(self, symbol: str, start: int, end: int) -> Optional[Tuple[int, int]]:
+        """
+        Narrows [start, end) to where rows of the symbol can be
+
+        Returns:
+            The narrowed range, None when it has no rows
+        """
+        if not self.usable():
+            return start, end
+        known_until = self.known_until
+        meta = self.symbols.get(symbol)
+        if meta is None:
+            # Rows may only have been added after the last refresh
+            new_start, new_end = max(start, known_until), end
+        else:
+            new_start, new_end = max(start, meta.first_time), end
+            # Days without rows before the range's first day with rows
+            day = new_start - new_start % DAY_MS
+            index = bisect_left(meta.day_starts, day)
+            if index == len(meta.day_starts) or meta.day_starts[index] != day:
+                next_day = meta.day_starts[index] if index < len(meta.day_starts) else None
+                known_gap_end = known_until if next_day is None else min(next_day, known_until)
+                if new_start < known_gap_end:
+                    new_start = known_gap_end
+            if new_start > meta.last_time:
+                new_start = max(new_start, known_until)
+
+            if new_end <= known_until:
+                new_end = min(new_end, meta.last_time + 1)
+                # Days without rows after the range's last day with rows
+                index = bisect_right(meta.day_starts, new_end - 1) - 1
+                if index >= 0:
+                    new_end = min(new_end, meta.day_starts[index] + DAY_MS)
+
+        if new_start >= new_end:
+            symbol_index_pruned_total.inc("empty")
+            return None
+        if (new_start, new_end) != (start, end):
+            symbol_index_pruned_total.inc("narrowed")
+        return new_start, new_end
+
+
+symbol_index = SymbolIndex(
+    refresh_seconds=settings.SYMBOL_INDEX_REFRESH_SECONDS,
+    rebuild_seconds=settings.SYMBOL_INDEX_REBUILD_SECONDS,
+    max_age_seconds=settings.SYMBOL_INDEX_MAX_AGE_SECONDS,
+    immutable_after_seconds=settings.HISTORY_CACHE_IMMUTABLE_AFTER_SECONDS,
+    path=settings.SYMBOL_INDEX_PATH or default_segment_path("index"),
+    buffer_size=settings.SYMBOL_INDEX_SIZE_BYTES,
+    enabled=settings.SYMBOL_INDEX_ENABLED,
+    remove_on_close=not settings.SYMBOL_INDEX_PATH
+)
+symbol_index_age_seconds.set_callback(symbol_index.age_seconds)
@@ -1,64 +1,114 @@
-from fastapi import FastAPI, Depends, APIRouter
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Depends, APIRouter, Request
+from fastapi.responses import JSONResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 from sqlalchemy.orm import Session
 import logging
-from logging.handlers import RotatingFileHandler
-import os
 
 from app.api.endpoints import auth
 from app.core.config import settings
+from app.core.log_config import setup_logging
 from app.api.dependencies import get_current_active_user
-from app.db.session import get_db, engine
-from app.db.base import Base
-from app.middleware.logging import log_requests_middleware
+from app.db.session import get_db
+from app.middleware.logging import RequestLoggingMiddleware
+from app.middleware.compression import CompressionMiddleware
+from app.middleware.rate_limit import RateLimitMiddleware
 from app.api.endpoints import admin, crypto
-from app.db.clickhouse import clickhouse_client
+from app.db.clickhouse import clickhouse_client, ClickHouseQueryError, QueryTooExpensiveError
+from app.db.admission import ClickHouseOverloadedError
+from app.db.circuit_breaker import ClickHouseUnavailableError
+from app.services.api_log_writer import api_log_writer, run_log_retention
+from app.services.warmup import run_warmup, warmup_state
+from app.services.shared_cache import shared_cache
+from app.db.symbol_index import symbol_index
+from app.repositories.crypto_repository import CryptoRepository
+from app.services.rate_limiter import RateLimitExceededError
+from app.core.metrics import registry as metrics_registry, MultiProcessCollector
+from starlette.concurrency import run_in_threadpool
+import asyncio
 
 
-def setup_logging():
-    log_dir = "logs"
-    if not os.path.exists(log_dir):
-        os.makedirs(log_dir)    
-    
-    formatter = logging.Formatter(
-        '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-    )    
-    
-    file_handler = RotatingFileHandler(
-        f'{log_dir}/app.log',
-        maxBytes=5242880,  # 5 MB
-        backupCount=2
-    )
-    file_handler.setFormatter(formatter)
-    file_handler.setLevel(logging.INFO)    
-    
-    console_handler = logging.StreamHandler()
-    console_handler.setFormatter(formatter)
-    console_handler.setLevel(logging.DEBUG)    
-    
-    root_logger = logging.getLogger()
-    root_logger.setLevel(logging.INFO)
-    root_logger.addHandler(file_handler)
-    root_logger.addHandler(console_handler)    
-    
-    logging.getLogger('app').setLevel(logging.DEBUG)
-    logging.getLogger('sqlalchemy.engine').setLevel(logging.WARNING)
-    logging.getLogger('aiohttp').setLevel(logging.WARNING)
-
+logger = logging.getLogger(__name__)
 
-setup_logging()
 
-logger = logging.getLogger(__name__)
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Startup does only cheap work before the server accepts connections.
+    Pools and caches are warmed in the background, see /ready.
+    """
+    setup_logging()
+    if settings.RUN_MIGRATIONS_ON_STARTUP:
+        from app.db.migrations import run_migrations
+        await run_in_threadpool(run_migrations)
+
+    background_tasks = []
+    api_log_writer.start()
+    if settings.API_LOG_RETENTION_DAYS > 0:
+        background_tasks.append(asyncio.create_task(run_log_retention(
+            settings.API_LOG_RETENTION_DAYS,
+            settings.API_LOG_RETENTION_INTERVAL_SECONDS
+        )))
+
+    if settings.METRICS_MULTIPROCESS_DIR:
+        app.state.metrics_collector = MultiProcessCollector(metrics_registry, settings.METRICS_MULTIPROCESS_DIR)
+        background_tasks.append(asyncio.create_task(
+            publish_metrics(app.state.metrics_collector, settings.METRICS_FLUSH_INTERVAL_SECONDS)
+        ))
+
+    if shared_cache.enabled:
+        shared_cache.open()
+        background_tasks.append(asyncio.create_task(shared_cache.run_writer()))
+
+    if symbol_index.enabled:
+        symbol_index.open()
+        background_tasks.append(asyncio.create_task(symbol_index.run(CryptoRepository().get_symbol_days)))
+
+    background_tasks.append(asyncio.create_task(run_warmup()))
+    logger.info("Application started, warming up")
+
+    yield
+
+    for task in background_tasks:
+        task.cancel()
+    await api_log_writer.stop()
+    shared_cache.close()
+    symbol_index.close()
+    await clickhouse_client.close()
+    logger.info("ClickHouse connection closed. Application shutdown.")
 
-# Create tables in the db
-Base.metadata.create_all(bind=engine)
 
 app = FastAPI(
     title="LOB Data API",
     description="API for accessing Limit Order Book (LOB) data from Binance",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
+@app.exception_handler(ClickHouseOverloadedError)
+@app.exception_handler(ClickHouseUnavailableError)
+async def clickhouse_unavailable_handler(request: Request, exc):
+    return JSONResponse(
+        status_code=503,
+        content={"detail": str(exc)},
+        headers={"Retry-After": str(exc.retry_after)}
+    )
+
+@app.exception_handler(RateLimitExceededError)
+async def rate_limit_exceeded_handler(request: Request, exc: RateLimitExceededError):
+    return JSONResponse(status_code=429, content={"detail": str(exc)}, headers=exc.headers)
+
+@app.exception_handler(QueryTooExpensiveError)
+async def query_too_expensive_handler(request: Request, exc: QueryTooExpensiveError):
+    return JSONResponse(status_code=400, content={"detail": str(exc)})
+
+@app.exception_handler(ClickHouseQueryError)
+async def clickhouse_query_error_handler(request: Request, exc: ClickHouseQueryError):
+    # 4xx from ClickHouse means the request asked for something invalid, e.g. an unknown column
+    if exc.status < 500:
+        return JSONResponse(status_code=400, content={"detail": "Invalid query parameters"})
+    return JSONResponse(status_code=502, content={"detail": "ClickHouse query failed"})
+
 # CORS middleware
 app.add_middleware(
     CORSMiddleware,
@@ -68,8 +118,15 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Charges rate limited requests for the rows and bytes they return, before compression
+app.add_middleware(RateLimitMiddleware)
+
 # Middleware for logging in db requests
-app.middleware("http")(log_requests_middleware)
+app.add_middleware(RequestLoggingMiddleware)
+
+# Outermost: logging and metrics see the uncompressed response
+if settings.COMPRESSION_ENABLED:
+    app.add_middleware(CompressionMiddleware)
 
 # Router for public endpoints
 public_router = APIRouter()
@@ -84,6 +141,29 @@ async def health_check():
     logger.debug("Health check endpoint accessed")
     return {"status": "healthy", "version": "1.0.0"}
 
+@public_router.get("/ready")
+async def readiness_check():
+    """503 until the worker's db pool, ClickHouse pool and symbols cache are warm"""
+    return JSONResponse(warmup_state.to_dict(), status_code=200 if warmup_state.ready else 503)
+
+@public_router.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+async def metrics(request: Request):
+    metrics_collector = getattr(request.app.state, "metrics_collector", None)
+    if metrics_collector is not None:
+        snapshots = await run_in_threadpool(metrics_collector.collect)
+        body = metrics_registry.render(snapshots)
+    else:
+        body = metrics_registry.render()
+    return PlainTextResponse(body, media_type="text/plain; version=0.0.4; charset=utf-8")
+
+async def publish_metrics(metrics_collector: MultiProcessCollector, interval: float):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await run_in_threadpool(metrics_collector.write_snapshot)
+        except Exception as e:
+            logger.error(f"Failed to publish metrics snapshot: {e}")
+
 # Connect public endpoints to the main app without dependencies
 app.include_router(public_router, dependencies=[])
 
@@ -95,6 +175,7 @@ app.include_router(admin.router, prefix="/admin", tags=["administration"])
 
 # Connect crypto router
 app.include_router(crypto.router, prefix="/crypto", tags=["cryptodata"])
+app.include_router(crypto.websocket_router, prefix="/crypto", tags=["cryptodata"])
 
 # Protected endpoint test
 @app.get("/protected-test")
@@ -107,7 +188,7 @@ async def protected_test(current_user = Depends(get_current_active_user)):
 
 # Endpoint for checking the db
 @app.get("/db-status")
-async def db_status(db: Session = Depends(get_db)):
+def db_status(db: Session = Depends(get_db)):
     from app.db.models.user import User
     from app.db.models.api_log import ApiLog
     
@@ -126,19 +207,9 @@ async def db_status(db: Session = Depends(get_db)):
 @app.get("/clickhouse-health")
 async def clickhouse_health():
     try:
-        result = await clickhouse_client.execute("SELECT 1 as status")
+        result = await clickhouse_client.execute("SELECT 1 as status", name="health")
         logger.debug("ClickHouse health check passed")
         return {"clickhouse": "connected", "status": "healthy"}
     except Exception as e:
         logger.error(f"ClickHouse health check failed: {e}")
         return {"clickhouse": "disconnected", "status": "unhealthy", "error": str(e)}
-
-@app.on_event("startup")
-async def startup_event():    
-    await clickhouse_client.connect()
-    logger.info("Application started with ClickHouse connection")
-
-@app.on_event("shutdown")
-async def shutdown_event():    
-    await clickhouse_client.close()
-    logger.info("ClickHouse connection closed. Application shutdown.")
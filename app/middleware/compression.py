@@ -0,0 +1,122 @@
+"""
+Negotiated response compression (zstd, br, gzip) as a pure ASGI middleware.
+
+The compression policy (minimum size, levels) is chosen by the route
+template, which the router stores in the scope before the response starts.
+Bodies with a Content-Length are collected and compressed as a whole:
+smaller than the minimum size they are sent as is, large ones are compressed
+in a worker thread. Streamed bodies without a length (e.g. NDJSON exports)
+are compressed chunk by chunk. Responses that already carry a Content-Encoding,
+such as the pre-compressed cached responses, pass through untouched.
+"""
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+from app.core.compression import (
+    StreamCompressor, compress_body, default_policy, is_compressible, negotiate, route_policies,
+    server_preference
+)
+from app.core.metrics import http_compressed_responses_total
+
+
+class CompressionMiddleware:
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or scope["method"] == "HEAD":
+            await self.app(scope, receive, send)
+            return
+        encoding = negotiate(Headers(scope=scope).get("accept-encoding", ""), server_preference())
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        await CompressionResponder(self.app, scope, encoding)(receive, send)
+
+
+class CompressionResponder:
+    def __init__(self, app: ASGIApp, scope: Scope, encoding: str):
+        self.app = app
+        self.scope = scope
+        self.encoding = encoding
+        self.send = None
+        self.start_message: Message = None
+        self.compressor: StreamCompressor = None
+        self.passthrough = False
+        # Chunks of a body with a known length, compressed as a whole
+        self.buffer: bytearray = None
+
+    async def __call__(self, receive: Receive, send: Send) -> None:
+        self.send = send
+        await self.app(self.scope, receive, self.send_compressed)
+
+    def _policy(self):
+        route = self.scope.get("route")
+        return route_policies().get(getattr(route, "path", None)) or default_policy()
+
+    async def send_compressed(self, message: Message) -> None:
+        if message["type"] == "http.response.start":
+            # Headers are sent with the first body chunk, when the body size is known
+            self.start_message = message
+            headers = Headers(raw=message["headers"])
+            self.passthrough = (
+                "content-encoding" in headers
+                or not is_compressible(headers.get("content-type", ""))
+                or not self._policy().enabled
+            )
+            if "content-length" in headers:
+                self.buffer = bytearray()
+            return
+
+        if message["type"] != "http.response.body":
+            await self.send(message)
+            return
+
+        if self.passthrough:
+            if self.start_message is not None:
+                await self.send(self.start_message)
+                self.start_message = None
+            await self.send(message)
+            return
+
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+        if self.buffer is not None:
+            # Complete responses re-streamed by inner middleware arrive in chunks
+            self.buffer += body
+            if more_body:
+                return
+            body, self.buffer = bytes(self.buffer), None
+        policy = self._policy()
+
+        if self.start_message is not None:
+            start_message, self.start_message = self.start_message, None
+            headers = MutableHeaders(raw=start_message["headers"])
+            headers.add_vary_header("Accept-Encoding")
+
+            if not more_body:
+                # Complete body
+                if len(body) < policy.min_size:
+                    self.passthrough = True
+                    await self.send(start_message)
+                    await self.send({"type": "http.response.body", "body": body})
+                    return
+                body = await compress_body(self.encoding, body, policy.levels[self.encoding])
+                headers["Content-Encoding"] = self.encoding
+                headers["Content-Length"] = str(len(body))
+                http_compressed_responses_total.inc(self.encoding)
+                await self.send(start_message)
+                await self.send({"type": "http.response.body", "body": body})
+                return
+
+            # Streamed body
+            self.compressor = StreamCompressor(self.encoding, policy.levels[self.encoding])
+            headers["Content-Encoding"] = self.encoding
+            if "content-length" in headers:
+                del headers["Content-Length"]
+            http_compressed_responses_total.inc(self.encoding)
+            await self.send(start_message)
+
+        chunk = self.compressor.compress(body) if body else b""
+        if not more_body:
+            chunk += self.compressor.finish()
+        await self.send({"type": "http.response.body", "body": chunk, "more_body": more_body})
@@ -1,8 +1,31 @@
-from fastapi import Request
-from sqlalchemy.orm import Session
-from app.db.session import SessionLocal
-from app.db.models.api_log import ApiLog
-from app.core.security import verify_token
+"""
+Request logging, metrics, tracing and profiling as a pure ASGI middleware.
+
+Status, response size and latency are taken from the messages the app
+sends, the body passes through as it is produced and is never buffered,
+so streamed responses cost nothing per chunk. The trace ends and the
+Server-Timing and X-Profile-Id headers are added when the response
+starts. The request is counted, timed and logged when its body ends, so
+the latency of streamed responses covers the whole stream.
+
+The user comes from the request state set by the auth dependency, the
+token is not decoded again.
+"""
+from datetime import datetime, timezone
+from typing import Optional
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers, MutableHeaders, QueryParams
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+from app.core.config import settings
+from app.core.profiling import (
+    PROFILE_STATE, PROFILE_TRACE_STATE, RequestProfile, profiling_requested, finish_profile, profile_store
+)
+from app.core.tracing import should_sample, start_trace, end_trace
+from app.models.roles import UserRole
+from app.services.api_log_writer import api_log_writer
+from app.core.metrics import (
+    http_requests_total, http_request_duration_seconds, http_requests_in_flight, http_response_bytes_total
+)
 import time
 import logging
 
@@ -10,75 +33,130 @@ import logging
 logger = logging.getLogger(__name__)
 
 
-"""
-TODO:
-    Add asynchronous logging
-    Send logging to a background task
-
-    async def async_logging(request: Request, call_next):
-        start_time = time.time()
-        response = await call_next(request)
-        process_time = time.time() - start_time
-        
-        asyncio.create_task(save_log_async(request, response, process_time))
-
-    async def save_log_async(request, response, process_time):
-        # Asynchronously save the log
-        # This doesn't block the main thread
-        pass
-"""
+def get_route_template(scope: Scope) -> str:
+    # Route path with placeholders, keeps metric label cardinality bounded
+    route = scope.get("route")
+    return getattr(route, "path", None) or "<unmatched>"
 
-async def log_requests_middleware(request: Request, call_next):
-    start_time = time.time()
-    
+
+async def save_profile(user, headers: MutableHeaders, status_code: int, profile: RequestProfile) -> None:
+    # Profiles are kept only for admins
+    if user is None or user.role != UserRole.ADMIN:
+        return
     try:
-        response = await call_next(request)
-        process_time = time.time() - start_time
+        data = profile.to_dict(user.username, status_code)
+        await run_in_threadpool(profile_store.save, data)
+        headers["X-Profile-Id"] = profile.id
     except Exception as e:
-        logger.error(f"Request processing error: {e}")
-        raise    
-    
+        logger.error(f"Failed to save request profile: {e}")
+
+
+class RequestLoggingMiddleware:
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start_time = time.perf_counter()
+        method, path = scope["method"], scope["path"]
+        state = scope.setdefault("state", {})
+        http_requests_in_flight.inc()
+
+        trace = None
+        profile_requested = (
+            settings.PROFILING_ENABLED
+            and profiling_requested(Headers(scope=scope), QueryParams(scope.get("query_string", b"")))
+        )
+        if profile_requested or should_sample():
+            trace = start_trace(f"{method} {path}")
+        if profile_requested:
+            # cProfile is started by the auth dependency, for admins only
+            state[PROFILE_TRACE_STATE] = trace
+
+        status_code: Optional[int] = None
+        body_bytes = 0
+        completed = False
+
+        def finish_trace() -> Optional[RequestProfile]:
+            state.pop(PROFILE_TRACE_STATE, None)
+            profile = state.pop(PROFILE_STATE, None)
+            if profile is not None:
+                finish_profile(profile)
+            if trace is not None:
+                trace.name = f"{method} {get_route_template(scope)}"
+                end_trace(trace)
+            return profile
+
+        async def send_with_logging(message: Message) -> None:
+            nonlocal status_code, body_bytes, completed, trace
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                if trace is not None:
+                    profile = finish_trace()
+                    headers = MutableHeaders(scope=message)
+                    headers["Server-Timing"] = trace.server_timing()
+                    if profile is not None:
+                        await save_profile(state.get("user"), headers, status_code, profile)
+                    trace = None
+            elif message["type"] == "http.response.body" and not completed:
+                body_bytes += len(message.get("body", b""))
+                if not message.get("more_body", False):
+                    completed = True
+                    # Bodies compressed by cached_response are counted before compression
+                    body_bytes = state.get("uncompressed_bytes", body_bytes)
+                    self.record(scope, status_code, body_bytes, time.perf_counter() - start_time)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_logging)
+        except Exception as e:
+            logger.error(f"Request processing error: {e}")
+            if not completed:
+                completed = True
+                route = get_route_template(scope)
+                http_requests_total.inc(method, route, "500")
+                http_request_duration_seconds.observe(time.perf_counter() - start_time, method, route)
+            raise
+        finally:
+            http_requests_in_flight.dec()
+            # Without a response, e.g. on errors or a client that left before it started
+            finish_trace()
+
+    @staticmethod
+    def record(scope: Scope, status_code: int, body_bytes: int, process_time: float) -> None:
+        method = scope["method"]
+        route = get_route_template(scope)
+        http_requests_total.inc(method, route, str(status_code))
+        http_request_duration_seconds.observe(process_time, method, route)
+        http_response_bytes_total.inc(method, route, amount=body_bytes)
+        log_request(scope, status_code, process_time)
+
+
+def log_request(scope: Scope, status_code: int, process_time: float) -> None:
     try:
-        db = SessionLocal()
-        user_id = None
-        authorization = request.headers.get("authorization")
-        
-        # Extract user_id from token
-        if authorization and authorization.startswith("Bearer "):
-            token = authorization.replace("Bearer ", "")
-            username = verify_token(token)
-            
-            if username:
-                # Find a user in the db by username
-                from app.db.models.user import User
-                user = db.query(User).filter(User.username == username).first()
-                if user:
-                    user_id = user.id
-        
-        # Create a log entry
-        api_log = ApiLog(
-            user_id=user_id,
-            endpoint=str(request.url.path),
-            method=request.method,
-            status_code=response.status_code,
-            client_host=request.client.host if request.client else None,
-            user_agent=request.headers.get("user-agent")
-        )        
-        db.add(api_log)
-        db.commit()
+        # Set by the auth dependency, absent on public endpoints and failed authentication
+        user = scope["state"].get("user")
+        client = scope.get("client")
+
+        # Queue a log entry, it is written to the db in batches
+        api_log_writer.enqueue({
+            "user_id": user.id if user is not None else None,
+            "endpoint": scope["path"],
+            "method": scope["method"],
+            "status_code": status_code,
+            "client_host": client[0] if client else None,
+            "user_agent": Headers(scope=scope).get("user-agent"),
+            "created_at": datetime.now(timezone.utc)
+        })
 
         logger.info(
-            f"Request: {request.method} {request.url.path} "
-            f"Status: {response.status_code} "
+            f"Request: {scope['method']} {scope['path']} "
+            f"Status: {status_code} "
             f"Duration: {process_time:.3f}s "
-            f"User: {user_id or 'anonymous'}"
+            f"User: {user.username if user is not None else 'anonymous'}"
         )
     except Exception as e:
         logger.error(f"Logging error: {e}")
-        if db:
-            db.rollback()        
-    finally:
-        if db:
-            db.close()
-    
-    return response
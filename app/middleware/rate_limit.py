@@ -0,0 +1,47 @@
+"""
+Charges rate limited requests for what they return and adds the quota headers.
+
+The auth dependency of rate limited routes admits the request and leaves
+a ticket in the request state. When the response starts, the ticket is
+charged for the rows the endpoint recorded and the body size, so the
+headers show the quota left after this request. Streamed bodies without
+a Content-Length are charged when they end, their headers show the quota
+left before them. Bodies are charged uncompressed: responses compressed
+before they get here (cached_response) leave their size in the request
+state.
+"""
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+from app.services.rate_limiter import rate_limiter
+
+
+class RateLimitMiddleware:
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or not rate_limiter.enabled:
+            await self.app(scope, receive, send)
+            return
+        state = scope.setdefault("state", {})
+        streamed_bytes = 0
+
+        async def send_with_quota(message: Message) -> None:
+            nonlocal streamed_bytes
+            ticket = state.get("rate_limit")
+            if ticket is None:
+                await send(message)
+                return
+            if message["type"] == "http.response.start":
+                headers = MutableHeaders(scope=message)
+                length = state.get("uncompressed_bytes", headers.get("content-length"))
+                if length is not None:
+                    rate_limiter.charge(ticket, int(length))
+                headers.update(rate_limiter.quota_headers(ticket))
+            elif message["type"] == "http.response.body" and not ticket.charged:
+                streamed_bytes += len(message.get("body", b""))
+                if not message.get("more_body", False):
+                    rate_limiter.charge(ticket, streamed_bytes)
+            await send(message)
+
+        await self.app(scope, receive, send_with_quota)
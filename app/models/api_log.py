@@ -0,0 +1,24 @@
+from datetime import datetime
+from pydantic import BaseModel
+from typing import List, Optional
+
+
+class ApiLog(BaseModel):
+    id: int
+    user_id: Optional[int] = None
+    endpoint: str
+    method: str
+    status_code: int
+    client_host: Optional[str] = None
+    user_agent: Optional[str] = None
+    created_at: Optional[datetime] = None
+
+    class Config:
+        from_attributes = True
+
+class ApiLogPage(BaseModel):
+    logs: List[ApiLog]
+    next_cursor: Optional[str] = None
+    limit: int
+    total: Optional[int] = None
+    total_is_estimate: bool = False
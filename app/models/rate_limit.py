@@ -0,0 +1,31 @@
+from datetime import datetime
+from pydantic import BaseModel, Field
+from typing import Dict, List, Optional
+
+
+class RateLimits(BaseModel):
+    """Per-minute refill rates and bucket sizes, None inherits and 0 means unlimited"""
+    requests_per_minute: Optional[float] = Field(None, ge=0)
+    request_burst: Optional[float] = Field(None, ge=0, description="Bucket size, the per-minute rate if unset")
+    rows_per_minute: Optional[float] = Field(None, ge=0)
+    rows_burst: Optional[float] = Field(None, ge=0)
+    bytes_per_minute: Optional[float] = Field(None, ge=0)
+    bytes_burst: Optional[float] = Field(None, ge=0)
+
+class RateLimitEntry(RateLimits):
+    role: Optional[str] = None
+    user_id: Optional[int] = None
+    updated_at: Optional[datetime] = None
+
+    class Config:
+        from_attributes = True
+
+class RateLimitOverview(BaseModel):
+    defaults: Dict[str, RateLimits]
+    overrides: List[RateLimitEntry]
+
+class UserRateLimitStatus(BaseModel):
+    user_id: int
+    role: str
+    limits: RateLimits
+    remaining: Dict[str, Optional[float]]
@@ -1,51 +1,197 @@
-from typing import List, Dict, Any
-from app.db.clickhouse import clickhouse_client
+from functools import lru_cache
+from typing import List, Dict, Any, Optional, Sequence, Tuple
+from app.db.clickhouse import clickhouse_client, query_cache_settings
+from app.db.admission import ClickHouseOverloadedError
+from app.db.circuit_breaker import ClickHouseUnavailableError
+from app.db.symbol_index import symbol_index
+from app.core.tracing import span
 import logging
 
 
 logger = logging.getLogger(__name__)
 
 
-class CryptoRepository:    
-    async def get_available_symbols(self) -> List[str]:
-        """active symbols for 24 hours"""
-        query = """
+# Fail fast errors, expected while ClickHouse is overloaded or down
+FAST_FAILURES = (ClickHouseOverloadedError, ClickHouseUnavailableError)
+
+
+# Constant query texts, values are bound by ClickHouse from {name:Type}
+# placeholders, so each query is one normalized query for ClickHouse
+AVAILABLE_SYMBOLS_QUERY = """
         SELECT DISTINCT symbol 
         FROM blob_rest_all_aggregated 
         WHERE event_time >= (now() - 86400000)
         ORDER BY symbol
         """
 
+SYMBOL_DATA_QUERY = """
+        SELECT *
+        FROM blob_rest_all_aggregated 
+        WHERE symbol = {symbol:String}
+        ORDER BY event_time DESC
+        LIMIT {limit:UInt32}
+        """
+
+# A symbol the index doesn't know can only have rows since its last refresh
+NEW_SYMBOL_DATA_QUERY = """
+        SELECT *
+        FROM blob_rest_all_aggregated 
+        WHERE symbol = {symbol:String} AND event_time >= {since:UInt64}
+        ORDER BY event_time DESC
+        LIMIT {limit:UInt32}
+        """
+
+LATEST_ROWS_QUERY = """
+        SELECT *
+        FROM blob_rest_all_aggregated
+        WHERE event_time >= (now() - 86400000)
+        ORDER BY symbol, event_time DESC
+        LIMIT {limit:UInt32} BY symbol
+        """
+
+SYMBOL_DAYS_QUERY = """
+        SELECT symbol, intDiv(event_time, 86400000) * 86400000 AS day, count() AS rows,
+            min(event_time) AS first_time, max(event_time) AS last_time
+        FROM blob_rest_all_aggregated
+        WHERE event_time >= {since:UInt64}
+        GROUP BY symbol, day
+        ORDER BY symbol, day
+        """
+
+
+@lru_cache(maxsize=256)
+def symbol_range_query(columns: Tuple[str, ...], descending: bool, limited: bool) -> str:
+    """Range query text, one per column set and order; columns must be validated names"""
+    query = f"""
+        SELECT {", ".join(columns) if columns else "*"}
+        FROM blob_rest_all_aggregated
+        WHERE symbol = {{symbol:String}} AND event_time >= {{start:UInt64}} AND event_time < {{end:UInt64}}
+        ORDER BY event_time {"DESC" if descending else "ASC"}
+        """
+    if limited:
+        query += "LIMIT {limit:UInt64}\n"
+    return query
+
+
+class CryptoRepository:    
+    async def get_available_symbols(self) -> List[str]:
+        """active symbols for 24 hours"""
         try:
             logger.debug("Fetching available symbols from ClickHouse")
-            result = await clickhouse_client.execute(query)
+            with span("crypto_repository.get_available_symbols"):
+                result = await clickhouse_client.execute(
+                    AVAILABLE_SYMBOLS_QUERY,
+                    query_settings=query_cache_settings("available_symbols", nondeterministic=True),
+                    name="available_symbols"
+                )
             symbols = [row['symbol'] for row in result]
             logger.info(f"Found {len(symbols)} available symbols")
             return symbols
+        except FAST_FAILURES:
+            raise
         except Exception as e:
             logger.error(f"Error getting available symbols: {e}")
-            return []
+            raise
 
     async def get_symbol_data(self, symbol: str, limit: int = 100) -> List[Dict[str, Any]]:
-        # placeholders {name}
-        query = """
-        SELECT *
-        FROM blob_rest_all_aggregated 
-        WHERE symbol = {symbol}
-        ORDER BY event_time DESC
-        LIMIT {limit}
-        """
-        
         params = {
             'symbol': symbol,
             'limit': limit
         }
+        query = SYMBOL_DATA_QUERY
+        since = symbol_index.rows_since(symbol)
+        if since:
+            logger.debug(f"Symbol {symbol} is not in the symbol index, looking for rows since {since}")
+            query = NEW_SYMBOL_DATA_QUERY
+            params['since'] = since
         
         try:
             logger.debug(f"Fetching data for symbol {symbol}, limit: {limit}")
-            data = await clickhouse_client.execute(query, params)
+            with span("crypto_repository.get_symbol_data"):
+                data = await clickhouse_client.execute(
+                    query, params,
+                    query_settings=query_cache_settings("symbol_data"),
+                    name="symbol_data"
+                )
             logger.info(f"Retrieved {len(data)} records for symbol {symbol}")
             return data
+        except FAST_FAILURES:
+            raise
         except Exception as e:
             logger.error(f"Error getting data for symbol {symbol}: {e}")
-            return []
+            raise
+
+    async def get_latest_rows(self, limit_per_symbol: int) -> Tuple[List[Dict[str, str]], List[Dict[str, Any]]]:
+        """Latest rows of every symbol active for 24 hours, with one query"""
+        try:
+            with span("crypto_repository.get_latest_rows"):
+                meta, data = await clickhouse_client.execute_with_meta(
+                    LATEST_ROWS_QUERY, {'limit': limit_per_symbol}, name="latest_rows"
+                )
+            logger.debug(f"Retrieved {len(data)} latest records of all symbols")
+            return meta, data
+        except FAST_FAILURES:
+            raise
+        except Exception as e:
+            logger.error(f"Error getting latest rows: {e}")
+            raise
+
+    async def get_symbol_days(self, since: int) -> List[Dict[str, Any]]:
+        """Rows, first and last event_time per symbol and UTC day, for days from `since` (epoch ms)"""
+        try:
+            with span("crypto_repository.get_symbol_days"):
+                data = await clickhouse_client.execute(SYMBOL_DAYS_QUERY, {'since': since}, name="symbol_days")
+            logger.debug(f"Counted {len(data)} symbol days from {since}")
+            return data
+        except FAST_FAILURES:
+            raise
+        except Exception as e:
+            logger.error(f"Error counting symbol days: {e}")
+            raise
+
+    async def get_symbol_range(
+        self,
+        symbol: str,
+        start: int,
+        end: int,
+        columns: Optional[Sequence[str]] = None,
+        descending: bool = True,
+        limit: Optional[int] = None
+    ) -> Tuple[List[Dict[str, str]], List[Dict[str, Any]]]:
+        """
+        Rows with start <= event_time < end (epoch ms)
+
+        Args:
+            columns: Validated column names, None for all
+
+        Returns:
+            Column names and types, and the rows
+        """
+        pruned = symbol_index.prune(symbol, start, end)
+        if pruned is None:
+            logger.debug(f"Range [{start}, {end}) of {symbol} has no rows according to the symbol index")
+            return [], []
+        start, end = pruned
+
+        query = symbol_range_query(tuple(columns or ()), descending, limit is not None)
+        params = {'symbol': symbol, 'start': start, 'end': end}
+        if limit is not None:
+            params['limit'] = limit
+
+        try:
+            logger.debug(f"Fetching range [{start}, {end}) for symbol {symbol}")
+            with span("crypto_repository.get_symbol_range"):
+                meta, data = await clickhouse_client.execute_with_meta(
+                    query, params,
+                    query_settings=query_cache_settings("symbol_range"),
+                    name="symbol_range",
+                    # Without a limit the whole range is read
+                    preflight=limit is None
+                )
+            logger.info(f"Retrieved {len(data)} records for symbol {symbol} in [{start}, {end})")
+            return meta, data
+        except FAST_FAILURES:
+            raise
+        except Exception as e:
+            logger.error(f"Error getting data range for symbol {symbol}: {e}")
+            raise
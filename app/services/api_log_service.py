@@ -0,0 +1,141 @@
+import base64
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional, Tuple, Iterator
+from sqlalchemy import tuple_, func
+from sqlalchemy.orm import Session, Query
+from app.core.config import settings
+from app.db.models.api_log import ApiLog
+from app.db.models.api_usage import ApiUsageDaily, ANONYMOUS_USER_ID
+from app.services.usage_service import UsageService, LOGS_RAW
+
+
+class InvalidCursorError(ValueError):
+    pass
+
+
+def encode_cursor(log: ApiLog) -> str:
+    raw = f"{log.created_at.isoformat()}|{log.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    try:
+        created_at, log_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.fromisoformat(created_at), int(log_id)
+    except Exception:
+        raise InvalidCursorError("Invalid cursor")
+
+
+class ApiLogService:
+    """
+    Service for reading raw api logs with keyset pagination on (created_at, id).
+    """
+    def __init__(self, db: Session):
+        self.db = db
+
+    def filtered_query(
+        self,
+        user_id: Optional[int] = None,
+        endpoint: Optional[str] = None,
+        status_code: Optional[int] = None,
+        since: Optional[datetime] = None,
+        until: Optional[datetime] = None
+    ) -> Query:
+        query = self.db.query(ApiLog)
+        if user_id is not None:
+            query = query.filter(ApiLog.user_id == user_id)
+        if endpoint is not None:
+            query = query.filter(ApiLog.endpoint == endpoint)
+        if status_code is not None:
+            query = query.filter(ApiLog.status_code == status_code)
+        if since is not None:
+            query = query.filter(ApiLog.created_at >= _naive_utc(since))
+        if until is not None:
+            query = query.filter(ApiLog.created_at < _naive_utc(until))
+        return query
+
+    def get_page(
+        self,
+        query: Query,
+        limit: int,
+        cursor: Optional[str] = None,
+        skip: int = 0
+    ) -> Tuple[List[ApiLog], Optional[str]]:
+        """
+        Returns a page of logs, newest first, and the cursor of the next page
+
+        Args:
+            query: Filtered query from filtered_query()
+            limit: Page size
+            cursor: Cursor returned with the previous page
+            skip: Legacy offset, used only without a cursor
+        """
+        if cursor:
+            created_at, log_id = decode_cursor(cursor)
+            query = query.filter(tuple_(ApiLog.created_at, ApiLog.id) < tuple_(created_at, log_id))
+        elif skip:
+            query = query.offset(skip)
+
+        # Fetch one extra row to know whether there is a next page
+        logs = query.order_by(ApiLog.created_at.desc(), ApiLog.id.desc())\
+                    .limit(limit + 1)\
+                    .all()
+
+        next_cursor = None
+        if len(logs) > limit:
+            logs = logs[:limit]
+            next_cursor = encode_cursor(logs[-1])
+        return logs, next_cursor
+
+    def iter_logs(self, query: Query, batch_size: int = 1000) -> Iterator[ApiLog]:
+        cursor = None
+        while True:
+            logs, cursor = self.get_page(query, batch_size, cursor)
+            yield from logs
+            self.db.expunge_all()
+            if cursor is None:
+                break
+
+    def count_exact(self, query: Query) -> int:
+        return query.order_by(None).count()
+
+    def count_estimate(
+        self,
+        user_id: Optional[int] = None,
+        endpoint: Optional[str] = None,
+        status_code: Optional[int] = None,
+        since: Optional[datetime] = None,
+        until: Optional[datetime] = None
+    ) -> Optional[int]:
+        """
+        Estimates the number of logs from usage rollups, without touching api_logs.
+        Time filters are rounded to whole days. Returns None if the filters
+        can't be answered from the rollups.
+        """
+        if status_code is not None:
+            return None
+
+        if user_id is None and endpoint is None and since is None and until is None:
+            return UsageService(self.db).get_counters([LOGS_RAW])[LOGS_RAW]
+
+        query = self.db.query(func.coalesce(func.sum(ApiUsageDaily.request_count), 0))
+        if user_id is not None:
+            query = query.filter(ApiUsageDaily.user_id == (user_id or ANONYMOUS_USER_ID))
+        if endpoint is not None:
+            query = query.filter(ApiUsageDaily.endpoint == endpoint)
+
+        # Rollups also count logs already removed by retention
+        if settings.API_LOG_RETENTION_DAYS > 0:
+            retained_since = _naive_utc(datetime.now(timezone.utc) - timedelta(days=settings.API_LOG_RETENTION_DAYS))
+            since = max(_naive_utc(since), retained_since) if since else retained_since
+        if since is not None:
+            query = query.filter(ApiUsageDaily.day >= _naive_utc(since).date())
+        if until is not None:
+            query = query.filter(ApiUsageDaily.day <= _naive_utc(until).date())
+        return query.scalar()
+
+
+def _naive_utc(value: datetime) -> datetime:
+    # Timestamps are stored as naive UTC in SQLite
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
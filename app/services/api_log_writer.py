@@ -0,0 +1,125 @@
+import asyncio
+from typing import List, Dict, Any, Optional
+from starlette.concurrency import run_in_threadpool
+from app.core.config import settings
+from app.db.session import SessionLocal
+from app.db.models.user import User
+from app.services.usage_service import UsageService
+from app.core.metrics import api_log_queue_depth, api_log_dropped_total
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+class ApiLogWriter:
+    """
+    Buffers api log entries in memory and writes them to the db in batches,
+    updating usage rollups in the same transaction.
+    """
+    def __init__(
+        self,
+        batch_size: int = settings.API_LOG_BATCH_SIZE,
+        flush_interval: float = settings.API_LOG_FLUSH_INTERVAL_SECONDS,
+        max_queue_size: int = settings.API_LOG_QUEUE_MAX_SIZE
+    ):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue_size = max_queue_size
+        self._buffer: List[Dict[str, Any]] = []
+        self._dropped = 0
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._buffer)
+
+    def enqueue(self, entry: Dict[str, Any]) -> None:
+        if len(self._buffer) >= self.max_queue_size:
+            self._dropped += 1
+            api_log_dropped_total.inc()
+            if self._dropped % 1000 == 1:
+                logger.warning(f"API log queue is full, dropped {self._dropped} entries")
+            return
+
+        self._buffer.append(entry)
+        if len(self._buffer) >= self.batch_size and self._wakeup is not None:
+            self._wakeup.set()
+
+    async def flush(self) -> None:
+        while self._buffer:
+            batch = self._buffer[:self.batch_size]
+            del self._buffer[:self.batch_size]
+            try:
+                await run_in_threadpool(self._write_batch, batch)
+            except Exception as e:
+                logger.error(f"Failed to write {len(batch)} api logs: {e}")
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    @staticmethod
+    def _write_batch(batch: List[Dict[str, Any]]) -> None:
+        db = SessionLocal()
+        try:
+            # Entries may carry a username instead of user_id, resolve them in one query
+            usernames = {entry["username"] for entry in batch if entry.get("username")}
+            user_ids = {}
+            if usernames:
+                user_ids = dict(
+                    db.query(User.username, User.id).filter(User.username.in_(usernames)).all()
+                )
+            for entry in batch:
+                username = entry.pop("username", None)
+                if entry.get("user_id") is None:
+                    entry["user_id"] = user_ids.get(username)
+
+            UsageService(db).record_logs(batch)
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+
+async def run_log_retention(retention_days: int, interval: float) -> None:
+    """Background task: periodically compacts raw logs into rollups"""
+    def compact():
+        db = SessionLocal()
+        try:
+            return UsageService(db).compact_logs(retention_days)
+        finally:
+            db.close()
+
+    while True:
+        try:
+            await run_in_threadpool(compact)
+        except Exception as e:
+            logger.error(f"API log retention failed: {e}")
+        await asyncio.sleep(interval)
+
+
+api_log_writer = ApiLogWriter()
+api_log_queue_depth.set_callback(lambda: {(): api_log_writer.queue_depth})
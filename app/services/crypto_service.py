@@ -1,30 +1,177 @@
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Awaitable, Callable, Hashable, Optional, Sequence
 from app.repositories.crypto_repository import CryptoRepository
+from app.core.tracing import span
+from app.core.cache import TTLCache, LastGoodCache
+from app.core.config import settings
+from app.core.metrics import stale_responses_total
+from app.db.admission import ClickHouseOverloadedError
+from app.db.circuit_breaker import ClickHouseUnavailableError, circuit_breaker
+from app.db.clickhouse import ClickHouseQueryError
+from app.db.symbol_index import DAY_MS, SymbolMeta, symbol_index
+from app.services.history_cache import history_cache
+from app.services.shared_cache import shared_cache
+import itertools
 import logging
+import time
 
 logger = logging.getLogger(__name__)
 
+# The active symbols list changes rarely and is requested often.
+# Entries are (generation, symbols), the generation identifies the cached list.
+symbols_cache = TTLCache("symbols", settings.SYMBOLS_CACHE_TTL_SECONDS, max_size=1)
+_symbols_generation = itertools.count(1)
+
+# Last successful results, served when ClickHouse fails
+last_good_cache = LastGoodCache("last_good", settings.STALE_DATA_MAX_ROWS)
+
 class CryptoService:
     """
     Сервис для работы с крипто-данными
     """
-    
+
     def __init__(self):
         self.repository = CryptoRepository()
+        # Age in seconds of the returned data when it was served from the fallback cache
+        self.stale_seconds: Optional[float] = None
+        # Identifies the cached data version the result came from, None for fresh or stale data.
+        # Responses built from the same version are identical, see app.core.compression.cached_response.
+        self.cache_key: Optional[Hashable] = None
         logger.debug("CryptoService initialized")
-    
+
+    async def _load_with_fallback(self, key: Hashable, endpoint: str, load: Callable[[], Awaitable[list]]) -> list:
+        """
+        Loads fresh data and remembers it. If ClickHouse fails, returns the last
+        known good result and sets stale_seconds, or raises a 503 error if there is none.
+        """
+        try:
+            result = await load()
+        except ClickHouseQueryError as e:
+            if e.status < 500:
+                raise  # a bad request, not an outage
+            return self._serve_stale(key, endpoint, e)
+        except Exception as e:
+            return self._serve_stale(key, endpoint, e)
+
+        if result:
+            last_good_cache.set(key, result, weight=len(result))
+        return result
+
+    def _serve_stale(self, key: Hashable, endpoint: str, error: Exception) -> list:
+        cached = last_good_cache.get(key, max_age=settings.STALE_DATA_MAX_AGE_SECONDS)
+        if cached is None:
+            if isinstance(error, (ClickHouseOverloadedError, ClickHouseUnavailableError)):
+                raise error
+            raise ClickHouseUnavailableError(
+                "ClickHouse is unavailable and no cached data exists", circuit_breaker.retry_after()
+            ) from error
+        result, self.stale_seconds = cached
+        stale_responses_total.inc(endpoint)
+        logger.warning(f"Serving stale {endpoint} response ({self.stale_seconds:.0f}s old): {error}")
+        return result
+
     async def get_available_symbols(self) -> List[str]:
         """Получает список доступных символов"""
         logger.debug("Getting available symbols from service")
-        
-        return await self.repository.get_available_symbols()
-    
-    async def get_symbol_data(self, symbol: str, limit: int = 100) -> Dict[str, Any]:        
+
+        if shared_cache.enabled:
+            cached = shared_cache.get_symbols()
+            if cached is not None:
+                version, symbols = cached
+                self.cache_key = ("symbols", "shared", version)
+                return symbols
+
+        if symbol_index.usable():
+            symbols = symbol_index.active_symbols(int(time.time() * 1000) - DAY_MS)
+            if symbols:
+                self.cache_key = ("symbols", "index", symbol_index.version)
+                return symbols
+
+        cached = symbols_cache.get("active")
+        if cached is not None:
+            generation, symbols = cached
+            self.cache_key = ("symbols", "local", generation)
+            return symbols
+
+        with span("crypto_service.get_available_symbols"):
+            symbols = await self._load_with_fallback(
+                ("symbols",), "symbols", self.repository.get_available_symbols
+            )
+        # Empty means no fresh data, stale lists are not cached: retry next time
+        if symbols and self.stale_seconds is None:
+            generation = next(_symbols_generation)
+            symbols_cache.set("active", (generation, symbols))
+            if symbols_cache.ttl_seconds > 0:
+                self.cache_key = ("symbols", "local", generation)
+        return symbols
+
+    async def get_symbol_meta(self, symbol: str) -> Optional[SymbolMeta]:
+        """Indexed metadata of a symbol, None if it has no rows"""
+        with span("crypto_service.get_symbol_meta"):
+            await symbol_index.ensure_fresh(self.repository.get_symbol_days)
+        return symbol_index.get(symbol.upper())
+
+    async def get_symbol_data(
+        self,
+        symbol: str,
+        limit: int = 100,
+        start: Optional[int] = None,
+        end: Optional[int] = None,
+        columns: Optional[Sequence[str]] = None
+    ) -> Dict[str, Any]:
         logger.debug(f"Service: getting data for {symbol}")
-        data = await self.repository.get_symbol_data(symbol.upper(), limit)
+        symbol_upper = symbol.upper()
+        with span("crypto_service.get_symbol_data"):
+            latest = start is None and end is None and not columns
+            data = None
+            if latest and shared_cache.enabled:
+                cached = shared_cache.get_latest_rows(symbol_upper, limit)
+                if cached is not None:
+                    version, data = cached
+                    self.cache_key = ("data", symbol, limit, "shared", version)
+
+            if data is None and latest:
+                data = await self._load_with_fallback(
+                    ("data", symbol_upper, limit), "data",
+                    lambda: self.repository.get_symbol_data(symbol_upper, limit)
+                )
+            elif data is None:
+                columns = tuple(columns) if columns else None
+                data = await self._load_with_fallback(
+                    ("data", symbol_upper, limit, start, end, columns), "data",
+                    lambda: self._get_symbol_range(symbol_upper, limit, start, end, columns)
+                )
 
         return {
             'symbol': symbol,
             'data': data,
             'data_points': len(data)
         }
+
+    async def _get_symbol_range(
+        self,
+        symbol: str,
+        limit: int,
+        start: Optional[int],
+        end: Optional[int],
+        columns: Optional[Sequence[str]]
+    ) -> List[Dict[str, Any]]:
+        """Newest rows of [start, end), closed time buckets come from the history cache"""
+        end = end if end is not None else int(time.time() * 1000) + 1
+        # Stored files are searched by event_time, so it is always selected
+        selected = list(columns) if columns else None
+        if selected and "event_time" not in selected:
+            selected.append("event_time")
+
+        async def fetch(range_start: int, range_end: int, descending: bool, range_limit: Optional[int]):
+            return await self.repository.get_symbol_range(
+                symbol, range_start, range_end, selected, descending=descending, limit=range_limit
+            )
+
+        if start is None or not settings.HISTORY_CACHE_ENABLED:
+            _, data = await fetch(start or 0, end, True, limit)
+        else:
+            data = await history_cache.get_range(fetch, symbol, start, end, limit, selected)
+
+        if columns and "event_time" not in columns:
+            data = [{name: row[name] for name in columns} for row in data]
+        return data
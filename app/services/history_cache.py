@@ -0,0 +1,321 @@
+"""
+Persistent cache of historical blob_rest_all_aggregated data.
+
+Rows older than a few minutes never change, so the data of a closed time
+bucket is fetched from ClickHouse once and kept on disk in the columnar
+format of app.core.columnar, one file per (symbol, columns, bucket):
+
+    <dir>/<SYMBOL>/<columns key>/<bucket start ms>.lobc
+
+Files are immutable and written atomically. They are evicted least recently
+used first when the total size exceeds the budget; the modification time of
+a file records its last use, so the order survives restarts and is shared
+by the workers.
+
+A range request is answered newest first: the still open part (newer than
+the immutable threshold) always comes from ClickHouse, cached buckets are
+read through mmap, and runs of missing buckets are fetched with one query
+per run. Reading stops once `limit` rows are collected, so the first run is
+the newest missing bucket only, and every further run of the request is
+twice as long, up to max_buckets_per_query: a small limit never fetches
+(or exceeds the result row limit with) a day of rows it doesn't need.
+
+The directory is shared by the workers. Each keeps its own index of it:
+a file written by another worker is adopted when a lookup finds it on
+disk, a file removed by another worker is treated as a miss. The budget
+applies to the whole directory: a worker rescans it after writing
+1/SCAN_FRACTION of the budget and when its index exceeds the budget, and
+evicts from the rescanned directory, so the cache exceeds the budget by at
+most that much per worker between rescans.
+"""
+import asyncio
+import hashlib
+import os
+import re
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
+from app.core.columnar import ColumnarFile, ColumnarFormatError, KIND_NUMERIC, write_file
+from app.core.config import settings
+from app.core.metrics import history_cache_bytes, history_cache_evictions_total, record_cache_access
+from app.core.tracing import span
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+FILE_SUFFIX = ".lobc"
+
+# Written bytes, as a fraction of the budget, after which the directory is rescanned
+SCAN_FRACTION = 16
+
+# Temporary files older than this are leftovers of interrupted writes
+LEFTOVER_SECONDS = 600
+
+_SAFE_NAME_RE = re.compile(r"^[A-Za-z0-9_\-]+$")
+
+# fetch(start, end, descending, limit) -> (meta, rows) with start <= event_time < end
+Fetch = Callable[[int, int, bool, Optional[int]], Awaitable[Tuple[List[Dict[str, str]], List[Dict[str, Any]]]]]
+
+
+def columns_key(columns: Optional[Sequence[str]]) -> str:
+    if not columns:
+        return "all"
+    return "c-" + hashlib.sha1(",".join(columns).encode()).hexdigest()[:16]
+
+
+class HistoryCache:
+    def __init__(
+        self,
+        directory: str,
+        max_bytes: int,
+        bucket_seconds: int,
+        immutable_after_seconds: int,
+        max_buckets_per_query: int = 24
+    ):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.bucket_ms = bucket_seconds * 1000
+        self.immutable_after_ms = immutable_after_seconds * 1000
+        self.max_buckets_per_query = max(1, max_buckets_per_query)
+        # path -> size, least recently used first
+        self._index: "OrderedDict[str, int]" = OrderedDict()
+        self.total_bytes = 0
+        self._written_since_scan = 0
+        self._loaded = False
+
+    def _scan(self) -> Tuple["OrderedDict[str, int]", int]:
+        """Files of the cache directory in last use order and their total size, may run in a thread"""
+        files = []
+        now = time.time()
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                    if not name.endswith(FILE_SUFFIX):
+                        # Other workers may be writing theirs right now
+                        if now - stat.st_mtime > LEFTOVER_SECONDS:
+                            os.remove(path)
+                        continue
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, path, stat.st_size))
+        index: "OrderedDict[str, int]" = OrderedDict()
+        for _, path, size in sorted(files):
+            index[path] = size
+        return index, sum(index.values())
+
+    def _apply_scan(self, index: "OrderedDict[str, int]", total_bytes: int) -> None:
+        self._index = index
+        self.total_bytes = total_bytes
+        self._written_since_scan = 0
+        history_cache_bytes.set(value=self.total_bytes)
+
+    def _load_index(self) -> None:
+        """Scans the cache directory on first use"""
+        self._loaded = True
+        self._apply_scan(*self._scan())
+        logger.info(f"History cache: {len(self._index)} files, {self.total_bytes} bytes in {self.directory}")
+        self._evict()
+
+    def bucket_path(self, symbol: str, key: str, bucket_start: int) -> str:
+        return os.path.join(self.directory, symbol, key, f"{bucket_start}{FILE_SUFFIX}")
+
+    def closed_until(self, now_ms: Optional[int] = None) -> int:
+        """Buckets ending at or before this time are complete and never change"""
+        now_ms = int(time.time() * 1000) if now_ms is None else now_ms
+        boundary = now_ms - self.immutable_after_ms
+        return boundary - boundary % self.bucket_ms
+
+    def _touch(self, path: str) -> None:
+        self._index.move_to_end(path)
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def _is_cached(self, path: str) -> bool:
+        """Whether the file exists, adopting files written by other workers into the index"""
+        if path in self._index:
+            return True
+        try:
+            size = os.stat(path).st_size
+        except OSError:
+            return False
+        self._index[path] = size
+        self.total_bytes += size
+        history_cache_bytes.set(value=self.total_bytes)
+        return True
+
+    def _forget(self, path: str) -> None:
+        size = self._index.pop(path, None)
+        if size is not None:
+            self.total_bytes -= size
+            history_cache_bytes.set(value=self.total_bytes)
+
+    def _evict(self) -> None:
+        while self.total_bytes > self.max_bytes and self._index:
+            path, _ = next(iter(self._index.items()))
+            self._forget(path)
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            history_cache_evictions_total.inc()
+
+    def _read(
+        self, path: str, start: int, end: int, limit: int, names: Optional[Sequence[str]]
+    ) -> Optional[List[Dict[str, Any]]]:
+        """Up to `limit` newest rows of a cached bucket with start <= event_time < end, None if not cached"""
+        if not self._is_cached(path):
+            return None
+        try:
+            with ColumnarFile(path) as f:
+                if f.columns["event_time"][0] == KIND_NUMERIC:
+                    times = f.numeric("event_time")
+                else:
+                    times = [int(value) for value in f.values("event_time", 0, f.rows)]
+                hi = bisect_left(times, end)
+                lo = max(bisect_left(times, start), hi - limit)
+                rows = f.rows_between(lo, hi, names)
+        except (OSError, KeyError, ColumnarFormatError) as e:
+            logger.warning(f"History cache file {path} is unreadable, dropping it: {e}")
+            self._forget(path)
+            return None
+        self._touch(path)
+        rows.reverse()
+        return rows
+
+    def _write_buckets(self, files: List[Tuple[str, List[Dict[str, str]], List[Dict[str, Any]]]]) -> List[Tuple[str, int]]:
+        """Runs in a thread. Returns (path, size) of the written files."""
+        written = []
+        for path, meta, rows in files:
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                written.append((path, write_file(path, meta, rows)))
+            except OSError as e:
+                logger.warning(f"History cache write of {path} failed: {e}")
+        return written
+
+    async def _fetch_buckets(
+        self,
+        fetch: Fetch,
+        symbol: str,
+        key: str,
+        first_bucket: int,
+        last_bucket: int
+    ) -> Dict[int, List[Dict[str, Any]]]:
+        """Fetches whole buckets [first_bucket, last_bucket] with one query and stores them"""
+        meta, rows = await fetch(first_bucket, last_bucket + self.bucket_ms, False, None)
+        buckets: Dict[int, List[Dict[str, Any]]] = {
+            bucket: [] for bucket in range(first_bucket, last_bucket + 1, self.bucket_ms)
+        }
+        for row in rows:
+            event_time = int(row["event_time"])
+            buckets[event_time - event_time % self.bucket_ms].append(row)
+
+        if meta:
+            files = [(self.bucket_path(symbol, key, bucket), meta, bucket_rows) for bucket, bucket_rows in buckets.items()]
+            written = await asyncio.to_thread(self._write_buckets, files)
+            for path, size in written:
+                self._forget(path)
+                self._index[path] = size
+                self.total_bytes += size
+                self._written_since_scan += size
+            history_cache_bytes.set(value=self.total_bytes)
+            # Other workers write to the same directory, the budget is checked against all of it
+            if self.total_bytes > self.max_bytes or self._written_since_scan * SCAN_FRACTION >= self.max_bytes:
+                self._apply_scan(*await asyncio.to_thread(self._scan))
+                self._evict()
+        return buckets
+
+    async def get_range(
+        self,
+        fetch: Fetch,
+        symbol: str,
+        start: int,
+        end: int,
+        limit: int,
+        columns: Optional[Sequence[str]] = None
+    ) -> List[Dict[str, Any]]:
+        """
+        Rows of a symbol with start <= event_time < end, newest first
+
+        Args:
+            fetch: Loads a range from ClickHouse
+            columns: Selected columns, None for all. Must include event_time.
+        """
+        if not _SAFE_NAME_RE.match(symbol):
+            _, rows = await fetch(start, end, True, limit)
+            return rows
+        if not self._loaded:
+            self._load_index()
+
+        names = list(columns) if columns else None
+        key = columns_key(columns)
+        closed_until = self.closed_until()
+        result: List[Dict[str, Any]] = []
+
+        # The open part is never cached
+        if end > closed_until:
+            _, rows = await fetch(max(start, closed_until), end, True, limit)
+            result.extend(rows)
+            end = closed_until
+
+        if start >= end:
+            return result
+
+        bucket = (end - 1) - (end - 1) % self.bucket_ms
+        first_bucket = start - start % self.bucket_ms
+        with span("history_cache.get_range") as read_span:
+            hits = misses = 0
+            run_size = 1
+            while bucket >= first_bucket and len(result) < limit:
+                rows = self._read(self.bucket_path(symbol, key, bucket), start, end, limit - len(result), names)
+                if rows is not None:
+                    record_cache_access("history", True)
+                    hits += 1
+                    result.extend(rows)
+                    bucket -= self.bucket_ms
+                    continue
+
+                # A run of consecutive missing buckets, newest to oldest
+                run_end = bucket
+                run_start = bucket
+                while (
+                    run_start - self.bucket_ms >= first_bucket
+                    and (run_end - run_start) // self.bucket_ms + 1 < run_size
+                    and not self._is_cached(self.bucket_path(symbol, key, run_start - self.bucket_ms))
+                ):
+                    run_start -= self.bucket_ms
+                run_buckets = (run_end - run_start) // self.bucket_ms + 1
+                for _ in range(run_buckets):
+                    record_cache_access("history", False)
+                misses += run_buckets
+                run_size = min(run_size * 2, self.max_buckets_per_query)
+
+                fetched = await self._fetch_buckets(fetch, symbol, key, run_start, run_end)
+                for fetched_bucket in range(run_end, run_start - 1, -self.bucket_ms):
+                    rows = [
+                        row for row in fetched[fetched_bucket]
+                        if start <= int(row["event_time"]) < end
+                    ]
+                    rows.reverse()
+                    result.extend(rows[:limit - len(result)])
+                    if len(result) >= limit:
+                        break
+                bucket = run_start - self.bucket_ms
+            read_span.set("hits", hits)
+            read_span.set("misses", misses)
+        return result
+
+
+history_cache = HistoryCache(
+    directory=settings.HISTORY_CACHE_DIR,
+    max_bytes=settings.HISTORY_CACHE_MAX_BYTES,
+    bucket_seconds=settings.HISTORY_CACHE_BUCKET_SECONDS,
+    immutable_after_seconds=settings.HISTORY_CACHE_IMMUTABLE_AFTER_SECONDS,
+    max_buckets_per_query=settings.HISTORY_CACHE_MAX_BUCKETS_PER_QUERY
+)
@@ -0,0 +1,42 @@
+from sqlalchemy.orm import Session
+from typing import List, Optional
+from app.db.models.rate_limit import RateLimit
+from app.models.rate_limit import RateLimits
+
+
+class RateLimitService:
+    """
+    Service for the role and user rate limits stored in the db.
+    """
+    def __init__(self, db: Session):
+        self.db = db
+
+    def get_all(self) -> List[RateLimit]:
+        return self.db.query(RateLimit).order_by(RateLimit.role, RateLimit.user_id).all()
+
+    def get_for_role(self, role: str) -> Optional[RateLimit]:
+        return self.db.query(RateLimit).filter(RateLimit.role == role).first()
+
+    def get_for_user(self, user_id: int) -> Optional[RateLimit]:
+        return self.db.query(RateLimit).filter(RateLimit.user_id == user_id).first()
+
+    def set_for_role(self, role: str, limits: RateLimits) -> RateLimit:
+        entry = self.get_for_role(role) or RateLimit(role=role)
+        return self._save(entry, limits)
+
+    def set_for_user(self, user_id: int, limits: RateLimits) -> RateLimit:
+        entry = self.get_for_user(user_id) or RateLimit(user_id=user_id)
+        return self._save(entry, limits)
+
+    def delete(self, entry: RateLimit) -> None:
+        self.db.delete(entry)
+        self.db.commit()
+
+    def _save(self, entry: RateLimit, limits: RateLimits) -> RateLimit:
+        # The whole entry is replaced, fields left out inherit again
+        for field, value in limits.model_dump().items():
+            setattr(entry, field, value)
+        self.db.add(entry)
+        self.db.commit()
+        self.db.refresh(entry)
+        return entry
@@ -0,0 +1,215 @@
+"""
+Per-user token bucket limits on requests and on the rows and bytes returned.
+
+Every user has three buckets (app.core.token_buckets): requests, rows and
+bytes. A request is admitted when it can take one request token and the
+row and byte buckets are not in debt; rows and bytes are only known once
+the response is built, so they are charged afterwards by
+RateLimitMiddleware and may push the buckets into debt, which delays the
+next requests. An exhausted bucket answers 429 with Retry-After.
+
+Limits are resolved field by field: the user's entry, then the role's
+entry (both in the rate_limits table, edited through the admin API), then
+RATE_LIMIT_ROLES. The resolved limits are kept per user in memory; a change
+bumps the generation in the bucket table and every worker reloads the
+table on its next request. Bucket state lives in RATE_LIMIT_STATE_PATH,
+shared by the workers of a server, or in process memory when it is unset.
+"""
+import math
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+from app.core.config import settings
+from app.core.metrics import rate_limit_rejected_total
+from app.core.token_buckets import Bucket, TokenBucketTable
+from app.db.session import SessionLocal
+from app.models.rate_limit import RateLimits
+from app.services.rate_limit_service import RateLimitService
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+REQUESTS = "requests"
+ROWS = "rows"
+BYTES = "bytes"
+KINDS = (REQUESTS, ROWS, BYTES)
+
+# Admission needs a request token and no debt of rows and bytes
+_REQUIRED = (1.0, 1.0, 1.0)
+_ADMISSION_COST = (1.0, 0.0, 0.0)
+
+
+class RateLimitExceededError(Exception):
+    """A bucket of the user is exhausted"""
+    def __init__(self, message: str, retry_after: int, headers: Dict[str, str]):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.headers = headers
+
+
+@dataclass(frozen=True)
+class EffectiveLimits:
+    limits: RateLimits
+    buckets: Tuple[Bucket, ...]
+
+    @property
+    def unlimited(self) -> bool:
+        return all(rate <= 0 for rate, _ in self.buckets)
+
+    @classmethod
+    def from_limits(cls, limits: RateLimits) -> "EffectiveLimits":
+        buckets = []
+        for per_minute, burst in (
+            (limits.requests_per_minute, limits.request_burst),
+            (limits.rows_per_minute, limits.rows_burst),
+            (limits.bytes_per_minute, limits.bytes_burst),
+        ):
+            if not per_minute:
+                buckets.append((0.0, 0.0))
+            else:
+                buckets.append((per_minute / 60.0, burst or per_minute))
+        return cls(limits=limits, buckets=tuple(buckets))
+
+
+@dataclass
+class RateLimitTicket:
+    """An admitted request, charged for its rows and bytes when the response is sent"""
+    user_id: int
+    limits: EffectiveLimits
+    tokens: List[float]
+    rows: int = 0
+    charged: bool = field(default=False)
+
+
+def merge_limits(*layers: Optional[RateLimits]) -> RateLimits:
+    """Field by field, the first layer with a value wins"""
+    merged = {}
+    for name in RateLimits.model_fields:
+        for layer in layers:
+            value = getattr(layer, name) if layer is not None else None
+            if value is not None:
+                merged[name] = value
+                break
+    return RateLimits(**merged)
+
+
+class RateLimiter:
+    def __init__(self, table: TokenBucketTable, enabled: bool, role_defaults: Dict[str, Dict[str, float]]):
+        self.table = table
+        self.enabled = enabled
+        self.role_defaults = {role: RateLimits(**values) for role, values in role_defaults.items()}
+        self._roles: Dict[str, RateLimits] = {}
+        self._users: Dict[int, RateLimits] = {}
+        self._effective: Dict[Tuple[int, str], EffectiveLimits] = {}
+        self._generation: Optional[int] = None
+
+    def needs_reload(self) -> bool:
+        return self._generation != self.table.generation()
+
+    def reload(self) -> None:
+        """Loads the db limits; runs in a worker thread"""
+        # Read first: a change made during the load triggers another reload
+        generation = self.table.generation()
+        db = SessionLocal()
+        try:
+            entries = RateLimitService(db).get_all()
+            roles = {entry.role: RateLimits.model_validate(entry, from_attributes=True)
+                     for entry in entries if entry.role is not None}
+            users = {entry.user_id: RateLimits.model_validate(entry, from_attributes=True)
+                     for entry in entries if entry.user_id is not None}
+        finally:
+            db.close()
+        self._roles, self._users, self._effective = roles, users, {}
+        self._generation = generation
+        logger.debug(f"Rate limits loaded: {len(roles)} roles, {len(users)} users, generation {generation}")
+
+    def limits_changed(self) -> None:
+        """Makes every worker reload the limits"""
+        self.table.bump_generation()
+
+    def limits_for(self, user_id: int, role: str) -> EffectiveLimits:
+        key = (user_id, role)
+        limits = self._effective.get(key)
+        if limits is None:
+            limits = EffectiveLimits.from_limits(merge_limits(
+                self._users.get(user_id), self._roles.get(role), self.role_defaults.get(role)
+            ))
+            self._effective[key] = limits
+        return limits
+
+    def check(self, user_id: int, role: str) -> Optional[RateLimitTicket]:
+        """
+        Admits a request of a user or raises RateLimitExceededError
+
+        Returns:
+            Ticket to charge rows and bytes to, None if the user is unlimited
+        """
+        limits = self.limits_for(user_id, role)
+        if limits.unlimited:
+            return None
+        allowed, tokens = self.table.acquire(user_id, limits.buckets, _ADMISSION_COST, required=_REQUIRED)
+        ticket = RateLimitTicket(user_id=user_id, limits=limits, tokens=tokens)
+        if allowed:
+            return ticket
+
+        # The bucket that takes longest to refill decides the wait
+        waits = {
+            kind: (required - tokens[index]) / rate
+            for index, ((rate, _), kind, required) in enumerate(zip(limits.buckets, KINDS, _REQUIRED))
+            if rate > 0 and tokens[index] < required
+        }
+        kind = max(waits, key=waits.get)
+        retry_after = max(1, math.ceil(waits[kind]))
+        rate_limit_rejected_total.inc(role, kind)
+        headers = self.quota_headers(ticket)
+        headers["Retry-After"] = str(retry_after)
+        raise RateLimitExceededError(f"Rate limit exceeded ({kind}), retry in {retry_after}s", retry_after, headers)
+
+    def charge(self, ticket: RateLimitTicket, body_bytes: int) -> None:
+        """Takes the rows and bytes a response returned"""
+        if ticket.charged:
+            return
+        ticket.charged = True
+        if ticket.rows <= 0 and body_bytes <= 0:
+            return
+        _, ticket.tokens = self.table.acquire(ticket.user_id, ticket.limits.buckets, (0.0, ticket.rows, body_bytes))
+
+    def quota_headers(self, ticket: RateLimitTicket) -> Dict[str, str]:
+        headers = {}
+        (rate, capacity), tokens = ticket.limits.buckets[0], ticket.tokens[0]
+        if rate > 0:
+            headers["X-RateLimit-Limit"] = str(int(capacity))
+            headers["X-RateLimit-Remaining"] = str(max(0, math.floor(tokens)))
+            headers["X-RateLimit-Reset"] = str(math.ceil((capacity - tokens) / rate))
+        for index, name in ((1, "Rows"), (2, "Bytes")):
+            rate, capacity = ticket.limits.buckets[index]
+            if rate > 0:
+                headers[f"X-RateLimit-{name}-Limit"] = str(int(capacity))
+                headers[f"X-RateLimit-{name}-Remaining"] = str(max(0, math.floor(ticket.tokens[index])))
+        return headers
+
+    def status(self, user_id: int, role: str) -> Dict[str, Optional[float]]:
+        """Tokens left per bucket, None for unlimited ones"""
+        limits = self.limits_for(user_id, role)
+        tokens = self.table.peek(user_id, limits.buckets)
+        return {
+            kind: (tokens[index] if limits.buckets[index][0] > 0 else None)
+            for index, kind in enumerate(KINDS)
+        }
+
+    def reset(self, user_id: int) -> None:
+        self.table.reset(user_id)
+
+
+def record_rows(request, rows: int) -> None:
+    """Rows returned by a request, charged to the user's rows bucket"""
+    ticket = getattr(request.state, "rate_limit", None)
+    if ticket is not None:
+        ticket.rows = rows
+
+
+rate_limiter = RateLimiter(
+    TokenBucketTable(settings.RATE_LIMIT_STATE_PATH, settings.RATE_LIMIT_SLOTS),
+    enabled=settings.RATE_LIMIT_ENABLED,
+    role_defaults=settings.RATE_LIMIT_ROLES
+)
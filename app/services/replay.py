@@ -0,0 +1,177 @@
+"""
+Replay of the historical rows of several symbols in event time order.
+
+Every symbol is read with the range query in chunks of REPLAY_CHUNK_ROWS
+rows, in ascending event_time, and the symbols are merged by event time
+with a heap. While a chunk is replayed, the next chunk of the same symbol
+is already being fetched (double buffering), so the stream only waits for
+ClickHouse when it outruns it. A session holds at most two chunks per
+symbol, whatever the length of the range.
+
+Rows are paced by their event time divided by the speed multiplier, or
+sent as fast as the client reads them with speed 0. Rows due together are
+sent as one batch of at most REPLAY_BATCH_ROWS rows.
+
+Chunk queries run at bulk admission priority, so replays yield ClickHouse
+slots to interactive requests.
+"""
+import asyncio
+import heapq
+import time
+from typing import Any, AsyncIterator, Dict, List, Optional, Sequence, Tuple
+from app.core.config import settings
+from app.core.metrics import replay_sessions, replay_stall_seconds
+from app.db.admission import PRIORITY_BULK, query_priority
+from app.repositories.crypto_repository import CryptoRepository
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+# Needed to merge the symbols, always returned
+REQUIRED_COLUMNS = ("symbol", "event_time")
+
+
+class SymbolFeed:
+    """Chunks of one symbol, the next one fetched while the current one is replayed"""
+    def __init__(
+        self,
+        repository: CryptoRepository,
+        symbol: str,
+        start: int,
+        end: int,
+        columns: Optional[Sequence[str]],
+        chunk_rows: int
+    ):
+        self.repository = repository
+        self.symbol = symbol
+        self.end = end
+        self.columns = columns
+        self.chunk_rows = chunk_rows
+        self.rows: List[Dict[str, Any]] = []
+        self.position = 0
+        self.chunks = 0
+        self._next: Optional[asyncio.Task] = asyncio.create_task(self._fetch(start))
+
+    async def _fetch(self, start: int) -> Tuple[List[Dict[str, Any]], Optional[int]]:
+        """A chunk from start and where the next one starts, None after the last one"""
+        with query_priority(PRIORITY_BULK):
+            _, rows = await self.repository.get_symbol_range(
+                self.symbol, start, self.end, self.columns, descending=False, limit=self.chunk_rows
+            )
+        if len(rows) < self.chunk_rows:
+            return rows, None
+        last_time = int(rows[-1]["event_time"])
+        # Rows of the last event time may continue in the next chunk: fetch them again with it
+        complete = len(rows)
+        while complete > 0 and int(rows[complete - 1]["event_time"]) == last_time:
+            complete -= 1
+        if complete == 0:
+            return rows, last_time + 1
+        return rows[:complete], last_time
+
+    @property
+    def head_time(self) -> int:
+        return int(self.rows[self.position]["event_time"])
+
+    def pop(self) -> Dict[str, Any]:
+        row = self.rows[self.position]
+        self.position += 1
+        return row
+
+    @property
+    def drained(self) -> bool:
+        return self.position >= len(self.rows)
+
+    async def advance(self) -> bool:
+        """Swaps in the prefetched chunk and starts fetching the one after, False when the symbol is done"""
+        if self._next is None:
+            self.rows, self.position = [], 0
+            return False
+        started = time.perf_counter()
+        rows, next_start = await self._next
+        if self.chunks:
+            replay_stall_seconds.observe(time.perf_counter() - started)
+        self.chunks += 1
+        self.rows, self.position = rows, 0
+        self._next = asyncio.create_task(self._fetch(next_start)) if next_start is not None else None
+        return bool(rows)
+
+    def close(self) -> None:
+        if self._next is not None:
+            if self._next.done() and not self._next.cancelled():
+                # A prefetch that failed after the client left is not an error of the replay
+                self._next.exception()
+            self._next.cancel()
+            self._next = None
+
+
+class ReplaySession:
+    def __init__(
+        self,
+        symbols: Sequence[str],
+        start: int,
+        end: int,
+        speed: float,
+        columns: Optional[Sequence[str]] = None,
+        chunk_rows: Optional[int] = None,
+        batch_rows: Optional[int] = None
+    ):
+        self.symbols = list(symbols)
+        self.start = start
+        self.end = end
+        self.speed = speed
+        if columns:
+            columns = list(REQUIRED_COLUMNS) + [column for column in columns if column not in REQUIRED_COLUMNS]
+        self.columns = columns
+        self.chunk_rows = chunk_rows or settings.REPLAY_CHUNK_ROWS
+        self.batch_rows = batch_rows or settings.REPLAY_BATCH_ROWS
+        self.repository = CryptoRepository()
+        # Rows taken from the feeds so far
+        self.rows_sent = 0
+
+    async def batches(self) -> AsyncIterator[List[Dict[str, Any]]]:
+        """Merged rows of all symbols, in batches sent when they are due"""
+        feeds = [
+            SymbolFeed(self.repository, symbol, self.start, self.end, self.columns, self.chunk_rows)
+            for symbol in self.symbols
+        ]
+        replay_sessions.inc()
+        try:
+            ready = await asyncio.gather(*(feed.advance() for feed in feeds))
+            # (event time, feed index): the index keeps symbols of one event time in request order
+            heap = [(feed.head_time, index) for index, feed in enumerate(feeds) if ready[index]]
+            heapq.heapify(heap)
+
+            batch: List[Dict[str, Any]] = []
+            first_time, started = None, None
+            while heap:
+                event_time, index = heap[0]
+                if self.speed > 0:
+                    if first_time is None:
+                        first_time, started = event_time, time.monotonic()
+                    delay = (event_time - first_time) / 1000 / self.speed - (time.monotonic() - started)
+                    if delay > 0:
+                        if batch:
+                            # Rows due so far go out before waiting
+                            yield batch
+                            batch = []
+                            continue
+                        await asyncio.sleep(delay)
+
+                feed = feeds[index]
+                batch.append(feed.pop())
+                if feed.drained and not await feed.advance():
+                    heapq.heappop(heap)
+                else:
+                    heapq.heapreplace(heap, (feed.head_time, index))
+                self.rows_sent += 1
+                if len(batch) >= self.batch_rows:
+                    yield batch
+                    batch = []
+            if batch:
+                yield batch
+        finally:
+            for feed in feeds:
+                feed.close()
+            replay_sessions.dec()
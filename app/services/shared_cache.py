@@ -0,0 +1,215 @@
+"""
+Symbols and latest rows cached once for all workers.
+
+One worker (see app.core.shared_memory) refreshes the active symbols and
+the latest SHARED_CACHE_ROWS_PER_SYMBOL rows of every symbol with two
+ClickHouse queries per interval and publishes them to the shared segment,
+so the ClickHouse load doesn't grow with the number of workers. All workers
+answer from the segment without copying it: the directory is parsed once
+per version, rows are decoded in place from columnar blocks
+(app.core.columnar) and only the requested ones are converted.
+
+Content of a version:
+
+    directory length u32, directory JSON, columnar blocks
+    directory: {"symbols": [...], "rows": {symbol: [offset after the directory, size]}}
+
+A miss (disabled, nothing published, content older than
+SHARED_CACHE_MAX_AGE_SECONDS, more rows requested than kept) falls back to
+the regular per-worker path.
+"""
+import asyncio
+import json
+import os
+import struct
+import time
+from typing import Any, Dict, List, Optional, Tuple
+from app.core.columnar import ColumnarReader, encode_columns
+from app.core.config import settings
+from app.core.metrics import record_cache_access, shared_cache_age_seconds, shared_cache_writer
+from app.core.shared_memory import SharedSegment, default_segment_path
+from app.db.admission import PRIORITY_BULK, query_priority
+from app.repositories.crypto_repository import CryptoRepository
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+_DIRECTORY_LENGTH = struct.Struct("<I")
+
+
+def build_content(
+    symbols: List[str],
+    meta: List[Dict[str, str]],
+    rows_by_symbol: Dict[str, List[Dict[str, Any]]],
+    capacity: int
+) -> bytes:
+    """Encodes a version, leaving out rows of symbols that don't fit in capacity"""
+    blocks = [(symbol, encode_columns(meta, rows)) for symbol, rows in rows_by_symbol.items()]
+    while True:
+        # Block offsets are relative to the end of the directory
+        directory = {"symbols": symbols, "rows": {}}
+        position = 0
+        for symbol, block in blocks:
+            directory["rows"][symbol] = [position, len(block)]
+            position += len(block)
+        encoded = json.dumps(directory).encode()
+        content = _DIRECTORY_LENGTH.pack(len(encoded)) + encoded + b"".join(block for _, block in blocks)
+        if len(content) <= capacity or not blocks:
+            return content
+        dropped, _ = blocks.pop()
+        logger.warning(f"Shared cache is full, latest rows of {dropped} are left out")
+
+
+class SharedLobCache:
+    def __init__(
+        self,
+        path: str,
+        buffer_size: int,
+        refresh_seconds: float,
+        rows_per_symbol: int,
+        max_age_seconds: float,
+        enabled: bool = True,
+        remove_on_close: bool = False
+    ):
+        self.enabled = enabled
+        self.remove_on_close = remove_on_close
+        self.segment = SharedSegment(path, buffer_size)
+        self.refresh_seconds = refresh_seconds
+        self.rows_per_symbol = rows_per_symbol
+        self.max_age_seconds = max_age_seconds
+        self.repository = CryptoRepository()
+        # (version, parsed directory)
+        self._directory: Optional[Tuple[int, dict]] = None
+
+    def open(self) -> None:
+        self.segment.open()
+
+    def close(self) -> None:
+        self.segment.close()
+        if self.remove_on_close:
+            for path in (self.segment.path, f"{self.segment.path}.lock"):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def _parse_directory(self, version: int, content: memoryview) -> dict:
+        if self._directory is not None and self._directory[0] == version:
+            return self._directory[1]
+        (length,) = _DIRECTORY_LENGTH.unpack_from(content, 0)
+        directory = json.loads(bytes(content[_DIRECTORY_LENGTH.size:_DIRECTORY_LENGTH.size + length]))
+        directory["blocks_offset"] = _DIRECTORY_LENGTH.size + length
+        self._directory = (version, directory)
+        return directory
+
+    def _read(self, read_content) -> Optional[Tuple[int, Any]]:
+        def reader(version: int, published_at: float, content: memoryview):
+            if time.time() - published_at > self.max_age_seconds:
+                return None
+            return read_content(self._parse_directory(version, content), content)
+
+        result = self.segment.read(reader) if self.enabled else None
+        if result is not None and result[1] is None:
+            result = None
+        record_cache_access("shared", result is not None)
+        return result
+
+    def get_symbols(self) -> Optional[Tuple[int, List[str]]]:
+        """(content version, active symbols)"""
+        def read_symbols(directory: dict, content: memoryview) -> Optional[List[str]]:
+            return list(directory["symbols"]) or None
+        return self._read(read_symbols)
+
+    def get_latest_rows(self, symbol: str, limit: int) -> Optional[Tuple[int, List[Dict[str, Any]]]]:
+        """(content version, newest `limit` rows of a symbol), None if the cache doesn't hold as many"""
+        def read_rows(directory: dict, content: memoryview) -> Optional[List[Dict[str, Any]]]:
+            entry = directory["rows"].get(symbol)
+            if entry is None:
+                return None
+            offset, size = entry
+            offset += directory["blocks_offset"]
+            columns = ColumnarReader(content[offset:offset + size])
+            try:
+                if columns.rows < limit:
+                    return None
+                return columns.rows_between(0, limit)
+            finally:
+                columns.release()
+        return self._read(read_rows)
+
+    def get_rows_after(self, symbol: str, watermark: int, limit: int) -> Optional[Tuple[int, List[Dict[str, Any]]]]:
+        """
+        (content version, oldest `limit` rows of a symbol with event_time > watermark, ascending)
+
+        None if rows after the watermark may be older than the cached ones
+        """
+        def read_rows(directory: dict, content: memoryview) -> Optional[List[Dict[str, Any]]]:
+            entry = directory["rows"].get(symbol)
+            if entry is None:
+                return None
+            offset, size = entry
+            offset += directory["blocks_offset"]
+            columns = ColumnarReader(content[offset:offset + size])
+            try:
+                # Newest first: the rows after the watermark are a prefix
+                times = columns.numeric("event_time")
+                if columns.rows == 0 or times[columns.rows - 1] > watermark:
+                    return None
+                low, high = 0, columns.rows
+                while low < high:
+                    middle = (low + high) // 2
+                    if times[middle] > watermark:
+                        low = middle + 1
+                    else:
+                        high = middle
+                rows = columns.rows_between(max(0, low - limit), low)
+                rows.reverse()
+                return rows
+            finally:
+                columns.release()
+        return self._read(read_rows)
+
+    def age_seconds(self) -> Dict[tuple, float]:
+        result = self.segment.read(lambda version, published_at, content: time.time() - published_at)
+        return {(): result[1]} if result is not None else {}
+
+    async def refresh(self) -> None:
+        symbols = await self.repository.get_available_symbols()
+        meta, rows = await self.repository.get_latest_rows(self.rows_per_symbol)
+        rows_by_symbol: Dict[str, List[Dict[str, Any]]] = {}
+        for row in rows:
+            rows_by_symbol.setdefault(row["symbol"], []).append(row)
+        content = await asyncio.to_thread(build_content, symbols, meta, rows_by_symbol, self.segment.capacity)
+        version = self.segment.publish(content)
+        logger.debug(f"Shared cache version {version}: {len(symbols)} symbols, {len(rows)} rows, {len(content)} bytes")
+
+    async def run_writer(self) -> None:
+        """Refreshes the segment while this worker holds the writer lock, takes over if the writer exits"""
+        while True:
+            started = time.monotonic()
+            try:
+                if not self.segment.is_writer and self.segment.try_become_writer():
+                    logger.info(f"This worker (pid {os.getpid()}) writes the shared cache {self.segment.path}")
+                    shared_cache_writer.set(value=1)
+                if self.segment.is_writer:
+                    # Background work yields ClickHouse slots to requests
+                    with query_priority(PRIORITY_BULK):
+                        await self.refresh()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Shared cache refresh failed: {e}")
+            await asyncio.sleep(max(0.0, self.refresh_seconds - (time.monotonic() - started)))
+
+
+shared_cache = SharedLobCache(
+    path=settings.SHARED_CACHE_PATH or default_segment_path("cache"),
+    buffer_size=settings.SHARED_CACHE_SIZE_BYTES,
+    refresh_seconds=settings.SHARED_CACHE_REFRESH_SECONDS,
+    rows_per_symbol=settings.SHARED_CACHE_ROWS_PER_SYMBOL,
+    max_age_seconds=settings.SHARED_CACHE_MAX_AGE_SECONDS,
+    enabled=settings.SHARED_CACHE_ENABLED,
+    remove_on_close=not settings.SHARED_CACHE_PATH
+)
+shared_cache_age_seconds.set_callback(shared_cache.age_seconds)
@@ -0,0 +1,195 @@
+"""
+Incremental sync for polling clients.
+
+A client sends the last event_time it has of every symbol (its watermark)
+and gets only the rows newer than that, for all symbols in one response,
+with the new watermarks. Symbols without new rows only get their
+watermark back. A null watermark asks for the latest rows.
+
+Rows come from the shared cache when it holds the latest rows of the
+symbol back to the watermark, so a client that keeps up never causes a
+ClickHouse query; otherwise from a range query, pruned by the symbol
+index. Cached rows are as new as the last shared cache refresh.
+
+Rows are sent in ascending event_time, column by column:
+
+    {"rows": 3, "complete": true, "columns": {
+        "event_time": {"delta": [1700000000000, 100, 100]},
+        "best_bid": {"delta": [4210012345, -120, 35], "scale": 6},
+        "flag": {"values": ["a", "b", "c"]}}}
+
+"delta" holds the first value followed by the difference to the previous
+row. Floats are sent as integers scaled by 10^scale, value = integer /
+10^scale restores them exactly. Other columns are sent as plain values.
+See decode_columns. The symbol column is left out, rows are keyed by
+symbol.
+
+At most `limit` rows are sent per symbol; "complete" is false when more
+rows follow the new watermark. Rows of one event_time are not split
+between responses, unless more than `limit` of them share it. Rows
+inserted later with an event_time at or before a watermark are not sent.
+"""
+import asyncio
+import time
+from itertools import repeat
+from operator import sub, truediv
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+from app.core.config import settings
+from app.core.metrics import sync_symbols_total
+from app.repositories.crypto_repository import CryptoRepository
+from app.services.shared_cache import shared_cache
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+# Integers up to this are exact in a double, e.g. for JavaScript clients
+_MAX_EXACT_INT = 2 ** 53
+
+
+def scale_floats(values: List[float]) -> Optional[Tuple[int, List[int]]]:
+    """
+    Fewest decimals d for which every value is exactly integer / 10^d, and
+    the integers; None if there are more than SYNC_MAX_DECIMALS or a value
+    isn't finite
+    """
+    head = values[:32]
+    try:
+        for scale in range(settings.SYNC_MAX_DECIMALS + 1):
+            factor = 10 ** scale
+            # Most scales fail on the first values already
+            if not all(round(value * factor) / factor == value for value in head):
+                continue
+            scaled = list(map(round, map(float(factor).__mul__, values)))
+            if list(map(truediv, scaled, repeat(factor))) == values:
+                return scale, scaled
+    except (ValueError, OverflowError):
+        pass
+    return None
+
+
+def delta_encode(values: List[int]) -> List[int]:
+    return [values[0]] + list(map(sub, values[1:], values[:-1])) if values else []
+
+
+def encode_column(values: List[Any]) -> Dict[str, Any]:
+    types = set(map(type, values))
+    if types <= {int}:
+        return {"delta": delta_encode(values)}
+
+    if types <= {int, float}:
+        scaled = scale_floats(values)
+        if scaled is not None:
+            scale, integers = scaled
+            if -_MAX_EXACT_INT < min(integers) and max(integers) < _MAX_EXACT_INT:
+                return {"delta": delta_encode(integers), "scale": scale}
+
+    return {"values": values}
+
+
+def encode_rows(rows: Sequence[Dict[str, Any]], names: Sequence[str]) -> Dict[str, Dict[str, Any]]:
+    return {name: encode_column([row[name] for row in rows]) for name in names}
+
+
+def decode_columns(columns: Dict[str, Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Rows of an encoded symbol, the reference for clients"""
+    decoded = {}
+    for name, column in columns.items():
+        if "values" in column:
+            decoded[name] = column["values"]
+            continue
+        values, total = [], 0
+        for delta in column["delta"]:
+            total += delta
+            values.append(total)
+        scale = column.get("scale")
+        decoded[name] = [value / 10 ** scale for value in values] if scale is not None else values
+    names = list(decoded)
+    return [dict(zip(names, row)) for row in zip(*decoded.values())]
+
+
+def trim_to_limit(rows: List[Dict[str, Any]], limit: int) -> Tuple[List[Dict[str, Any]], bool]:
+    """
+    First `limit` of up to limit + 1 ascending rows, without splitting the
+    rows of the last event_time unless all of them share it
+
+    Returns:
+        The rows and whether no rows follow them
+    """
+    if len(rows) <= limit:
+        return rows, True
+    next_time = int(rows[limit]["event_time"])
+    count = limit
+    while count > 0 and int(rows[count - 1]["event_time"]) == next_time:
+        count -= 1
+    return rows[:count or limit], False
+
+
+class SyncService:
+    def __init__(self, limit: int, columns: Optional[Sequence[str]] = None):
+        self.limit = limit
+        # event_time is needed for the watermark, the symbol is the key
+        self.columns = ["event_time"] + [name for name in columns if name != "event_time"] if columns else None
+        self.repository = CryptoRepository()
+        # Rows in the response
+        self.rows = 0
+
+    def _from_shared_cache(self, symbol: str, watermark: Optional[int]) -> Optional[List[Dict[str, Any]]]:
+        """Up to limit + 1 ascending rows after the watermark, None on a miss"""
+        if not shared_cache.enabled:
+            return None
+        if watermark is None:
+            cached = shared_cache.get_latest_rows(symbol, self.limit)
+            if cached is not None:
+                cached = cached[0], cached[1][::-1]
+        else:
+            cached = shared_cache.get_rows_after(symbol, watermark, self.limit + 1)
+        if cached is None:
+            return None
+        rows = cached[1]
+        # Unknown columns are reported by ClickHouse
+        if rows and self.columns and any(name not in rows[0] for name in self.columns):
+            return None
+        return rows
+
+    async def _from_clickhouse(self, symbol: str, watermark: Optional[int]) -> List[Dict[str, Any]]:
+        end = int(time.time() * 1000) + 1
+        if watermark is None:
+            _, rows = await self.repository.get_symbol_range(
+                symbol, 0, end, self.columns, descending=True, limit=self.limit
+            )
+            return rows[::-1]
+        _, rows = await self.repository.get_symbol_range(
+            symbol, watermark + 1, end, self.columns, descending=False, limit=self.limit + 1
+        )
+        return rows
+
+    async def _symbol_rows(self, symbol: str, watermark: Optional[int]) -> Tuple[List[Dict[str, Any]], bool]:
+        rows = self._from_shared_cache(symbol, watermark)
+        if rows is not None:
+            sync_symbols_total.inc("shared")
+        else:
+            sync_symbols_total.inc("clickhouse")
+            rows = await self._from_clickhouse(symbol, watermark)
+        return trim_to_limit(rows, self.limit)
+
+    async def sync(self, watermarks: Dict[str, Optional[int]]) -> Dict[str, Any]:
+        """New watermarks of all symbols and the encoded rows of those with new rows"""
+        results = await asyncio.gather(
+            *(self._symbol_rows(symbol, watermark) for symbol, watermark in watermarks.items())
+        )
+        new_watermarks: Dict[str, Optional[int]] = {}
+        symbols: Dict[str, Dict[str, Any]] = {}
+        for (symbol, watermark), (rows, complete) in zip(watermarks.items(), results):
+            if not rows:
+                new_watermarks[symbol] = watermark
+                continue
+            # ClickHouse quotes 64-bit integers in JSON
+            event_times = [int(row["event_time"]) for row in rows]
+            names = [name for name in (self.columns or rows[0]) if name not in ("symbol", "event_time")]
+            columns = {"event_time": encode_column(event_times), **encode_rows(rows, names)}
+            new_watermarks[symbol] = event_times[-1]
+            symbols[symbol] = {"rows": len(rows), "complete": complete, "columns": columns}
+            self.rows += len(rows)
+        logger.debug(f"Sync of {len(watermarks)} symbols: {self.rows} new rows of {len(symbols)} symbols")
+        return {"watermarks": new_watermarks, "symbols": symbols}
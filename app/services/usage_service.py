@@ -0,0 +1,207 @@
+from collections import defaultdict
+from datetime import date, datetime, timedelta, timezone
+from typing import List, Dict, Any, Iterable
+from sqlalchemy import func, case, insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+from app.db.models.api_log import ApiLog
+from app.db.models.api_usage import ApiUsageDaily, ApiCounter, ANONYMOUS_USER_ID
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+# Counter names
+LOGS_TOTAL = "logs.total"          # all requests ever logged (including compacted)
+LOGS_RAW = "logs.raw"              # rows currently kept in api_logs
+LOGS_DAY_PREFIX = "logs.day:"      # requests per UTC day, e.g. logs.day:2025-01-31
+
+
+def day_counter(day: date) -> str:
+    return f"{LOGS_DAY_PREFIX}{day.isoformat()}"
+
+
+class UsageService:
+    """
+    Service for API usage rollups and raw log retention.
+    """
+    def __init__(self, db: Session):
+        self.db = db
+
+    def record_logs(self, entries: List[Dict[str, Any]]) -> None:
+        """
+        Inserts a batch of raw log entries and updates rollups in one transaction
+
+        Args:
+            entries: Dicts with ApiLog column values, created_at must be set
+        """
+        if not entries:
+            return
+
+        self.db.execute(insert(ApiLog), entries)
+
+        rollups = defaultdict(lambda: [0, 0])
+        day_totals = defaultdict(int)
+        for entry in entries:
+            day = entry["created_at"].astimezone(timezone.utc).date()
+            key = (day, entry["user_id"] or ANONYMOUS_USER_ID, entry["endpoint"])
+            rollups[key][0] += 1
+            if entry["status_code"] >= 400:
+                rollups[key][1] += 1
+            day_totals[day] += 1
+
+        self._upsert_rollups(
+            {"day": day, "user_id": user_id, "endpoint": endpoint,
+             "request_count": counts[0], "error_count": counts[1]}
+            for (day, user_id, endpoint), counts in rollups.items()
+        )
+
+        counters = {LOGS_TOTAL: len(entries), LOGS_RAW: len(entries)}
+        for day, count in day_totals.items():
+            counters[day_counter(day)] = count
+        self._increment_counters(counters)
+
+        self.db.commit()
+
+    def get_counters(self, names: Iterable[str]) -> Dict[str, int]:
+        names = list(names)
+        rows = self.db.query(ApiCounter).filter(ApiCounter.name.in_(names)).all()
+        values = {name: 0 for name in names}
+        values.update({row.name: row.value for row in rows})
+        return values
+
+    def get_log_stats(self) -> Dict[str, int]:
+        today = datetime.now(timezone.utc).date()
+        counters = self.get_counters([LOGS_TOTAL, LOGS_RAW, day_counter(today)])
+        return {
+            "total": counters[LOGS_TOTAL],
+            "retained": counters[LOGS_RAW],
+            "today": counters[day_counter(today)]
+        }
+
+    def get_user_usage(self, user_id: int, days: int = 30) -> Dict[str, Any]:
+        since = datetime.now(timezone.utc).date() - timedelta(days=days - 1)
+        base = self.db.query(ApiUsageDaily).filter(
+            ApiUsageDaily.user_id == user_id,
+            ApiUsageDaily.day >= since
+        )
+
+        by_day = base.with_entities(
+            ApiUsageDaily.day,
+            func.sum(ApiUsageDaily.request_count),
+            func.sum(ApiUsageDaily.error_count)
+        ).group_by(ApiUsageDaily.day).order_by(ApiUsageDaily.day).all()
+
+        by_endpoint = base.with_entities(
+            ApiUsageDaily.endpoint,
+            func.sum(ApiUsageDaily.request_count),
+            func.sum(ApiUsageDaily.error_count)
+        ).group_by(ApiUsageDaily.endpoint)\
+         .order_by(func.sum(ApiUsageDaily.request_count).desc()).all()
+
+        return {
+            "user_id": user_id,
+            "since": since,
+            "requests": sum(row[1] for row in by_day),
+            "errors": sum(row[2] for row in by_day),
+            "by_day": [
+                {"day": day, "requests": requests, "errors": errors}
+                for day, requests, errors in by_day
+            ],
+            "by_endpoint": [
+                {"endpoint": endpoint, "requests": requests, "errors": errors}
+                for endpoint, requests, errors in by_endpoint
+            ]
+        }
+
+    def compact_logs(self, retention_days: int, batch_size: int = 5000) -> int:
+        """
+        Deletes raw logs older than the retention period.
+        They are already counted in the rollups, so no data is lost for stats.
+
+        Args:
+            retention_days: Number of days of raw logs to keep
+            batch_size: Rows deleted per transaction
+
+        Returns:
+            Number of deleted rows
+        """
+        cutoff = datetime.now(timezone.utc) - timedelta(days=retention_days)
+        deleted = 0
+        while True:
+            ids = [
+                row[0] for row in self.db.query(ApiLog.id)
+                .filter(ApiLog.created_at < cutoff)
+                .limit(batch_size)
+                .all()
+            ]
+            if not ids:
+                break
+            self.db.query(ApiLog).filter(ApiLog.id.in_(ids))\
+                .delete(synchronize_session=False)
+            self._increment_counters({LOGS_RAW: -len(ids)})
+            self.db.commit()
+            deleted += len(ids)
+
+        if deleted:
+            logger.info(f"Compacted {deleted} api logs older than {cutoff.date()}")
+        return deleted
+
+    def backfill_rollups(self) -> bool:
+        """
+        Builds rollups and counters from existing raw logs.
+        Runs only once: when the log counters do not exist yet.
+
+        Returns:
+            True if the backfill was performed
+        """
+        if self.db.get(ApiCounter, LOGS_TOTAL) is not None:
+            return False
+
+        day = func.date(ApiLog.created_at)
+        user_id = func.coalesce(ApiLog.user_id, ANONYMOUS_USER_ID)
+        rows = self.db.query(
+            day, user_id, ApiLog.endpoint,
+            func.count(ApiLog.id),
+            func.sum(case((ApiLog.status_code >= 400, 1), else_=0))
+        ).group_by(day, user_id, ApiLog.endpoint).all()
+
+        self.db.query(ApiUsageDaily).delete(synchronize_session=False)
+        self._upsert_rollups(
+            {"day": date.fromisoformat(row_day), "user_id": row_user_id, "endpoint": endpoint,
+             "request_count": requests, "error_count": errors}
+            for row_day, row_user_id, endpoint, requests, errors in rows
+        )
+
+        total = sum(row[3] for row in rows)
+        counters = {LOGS_TOTAL: total, LOGS_RAW: total}
+        for row_day, _, _, requests, _ in rows:
+            name = f"{LOGS_DAY_PREFIX}{row_day}"
+            counters[name] = counters.get(name, 0) + requests
+        self._increment_counters(counters)
+
+        self.db.commit()
+        logger.info(f"Backfilled usage rollups from {total} api logs")
+        return True
+
+    def _upsert_rollups(self, rows: Iterable[Dict[str, Any]]) -> None:
+        for row in rows:
+            stmt = sqlite_insert(ApiUsageDaily).values(**row)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=["day", "user_id", "endpoint"],
+                set_={
+                    "request_count": ApiUsageDaily.request_count + stmt.excluded.request_count,
+                    "error_count": ApiUsageDaily.error_count + stmt.excluded.error_count
+                }
+            )
+            self.db.execute(stmt)
+
+    def _increment_counters(self, deltas: Dict[str, int]) -> None:
+        for name, delta in deltas.items():
+            stmt = sqlite_insert(ApiCounter).values(name=name, value=delta)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=["name"],
+                set_={"value": ApiCounter.value + stmt.excluded.value}
+            )
+            self.db.execute(stmt)
@@ -0,0 +1,112 @@
+"""
+Warmup of a worker's resources after startup.
+
+The database pool, the ClickHouse connection pool and the symbols cache are
+warmed in parallel in the background while the server already accepts
+connections. Failed steps are retried until they succeed. /ready reports
+the state, so a load balancer only routes traffic to warm workers.
+"""
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional
+from sqlalchemy import inspect, text
+from starlette.concurrency import run_in_threadpool
+from app.core.config import settings
+from app.db.clickhouse import clickhouse_client
+from app.db.session import engine, SessionLocal
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+MAX_RETRY_SECONDS = 30.0
+
+
+class WarmupState:
+    def __init__(self, *components: str):
+        self.started = time.monotonic()
+        self.components: Dict[str, Dict[str, Any]] = {
+            name: {"ready": False, "seconds": None, "error": None} for name in components
+        }
+        self.ready_seconds: Optional[float] = None
+
+    @property
+    def ready(self) -> bool:
+        return all(component["ready"] for component in self.components.values())
+
+    def mark_ready(self, name: str) -> None:
+        component = self.components[name]
+        component.update(ready=True, seconds=round(time.monotonic() - self.started, 3), error=None)
+        if self.ready and self.ready_seconds is None:
+            self.ready_seconds = round(time.monotonic() - self.started, 3)
+            logger.info(f"Worker is ready, warmup took {self.ready_seconds}s")
+
+    def mark_failed(self, name: str, error: Exception) -> None:
+        self.components[name]["error"] = str(error) or error.__class__.__name__
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "status": "ready" if self.ready else "warming_up",
+            "uptime_seconds": round(time.monotonic() - self.started, 3),
+            "ready_seconds": self.ready_seconds,
+            "components": self.components
+        }
+
+
+warmup_state = WarmupState("database", "clickhouse", "symbols_cache")
+
+
+def _warm_db_connection() -> None:
+    db = SessionLocal()
+    try:
+        db.execute(text("SELECT 1"))
+    finally:
+        db.close()
+
+
+async def warm_database(connections: int) -> None:
+    """Checks the schema and opens pooled connections concurrently"""
+    has_users = await run_in_threadpool(lambda: inspect(engine).has_table("users"))
+    if not has_users:
+        raise RuntimeError("Database schema is missing, run `python -m app.db.migrations`")
+    await asyncio.gather(*(run_in_threadpool(_warm_db_connection) for _ in range(max(1, connections))))
+
+
+async def warm_clickhouse(connections: int) -> None:
+    """Connects and fills the keep-alive pool with concurrent pings"""
+    await clickhouse_client.connect()
+    await asyncio.gather(*(clickhouse_client.execute("SELECT 1 as warmup", name="warmup") for _ in range(max(1, connections))))
+
+
+async def warm_symbols_cache() -> None:
+    from app.services.crypto_service import CryptoService
+
+    # Failed queries raise; no active symbols is a valid state, not a failure
+    symbols = await CryptoService().get_available_symbols()
+    if not symbols:
+        logger.warning("Warmup found no active symbols")
+
+
+async def _warm(name: str, step: Callable[[], Awaitable[None]], retry_seconds: float) -> None:
+    delay = retry_seconds
+    while True:
+        try:
+            await step()
+            warmup_state.mark_ready(name)
+            return
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            warmup_state.mark_failed(name, e)
+            logger.warning(f"Warmup of {name} failed, retrying in {delay:.1f}s: {e}")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, MAX_RETRY_SECONDS)
+
+
+async def run_warmup() -> None:
+    retry_seconds = settings.WARMUP_RETRY_SECONDS
+    await asyncio.gather(
+        _warm("database", lambda: warm_database(settings.WARMUP_DB_CONNECTIONS), retry_seconds),
+        _warm("clickhouse", lambda: warm_clickhouse(settings.WARMUP_CLICKHOUSE_CONNECTIONS), retry_seconds),
+        _warm("symbols_cache", warm_symbols_cache, retry_seconds),
+    )
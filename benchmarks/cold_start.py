@@ -0,0 +1,189 @@
+"""
+Cold start benchmark.
+
+Measures, from spawning the API process, the time until it accepts
+connections (/health), reports warm (/ready) and serves the first successful
+/crypto/data response. The db is prepared (migrated, users registered) once
+before the measured runs, like on a restart of a deployed service. Also
+measures the import time of app.main in a fresh interpreter.
+
+    python -m benchmarks.cold_start --runs 5
+    python -m benchmarks.cold_start --workers 2 --ch-latency-ms 5
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+import aiohttp
+from benchmarks.load import (
+    PROJECT_ROOT, RESULTS_DIR, app_command, app_environment, free_port, git_commit, parse_env,
+    setup_users, wait_for_url
+)
+from benchmarks.lob_fixtures import SYMBOLS
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+POLL_INTERVAL = 0.005
+
+
+async def time_until_ok(
+    session: aiohttp.ClientSession,
+    url: str,
+    started: float,
+    process: subprocess.Popen,
+    timeout: float,
+    headers: Optional[Dict[str, str]] = None
+) -> float:
+    """Seconds from `started` until url answers 200"""
+    deadline = started + timeout
+    while time.perf_counter() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"API exited with code {process.returncode} while starting")
+        try:
+            async with session.get(url, headers=headers) as response:
+                await response.read()
+                if response.status == 200:
+                    return time.perf_counter() - started
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(POLL_INTERVAL)
+    raise TimeoutError(f"{url} did not answer 200 in {timeout}s")
+
+
+def stop(process: subprocess.Popen) -> None:
+    process.terminate()
+    try:
+        process.wait(timeout=15)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+def measure_import_time(env: Dict[str, str], workdir: str) -> float:
+    code = "import time; t = time.perf_counter(); import app.main; print(time.perf_counter() - t)"
+    output = subprocess.check_output([sys.executable, "-c", code], cwd=workdir, env=env, stderr=subprocess.DEVNULL)
+    return float(output.decode().strip().splitlines()[-1])
+
+
+async def run_cold_start(args) -> Dict[str, object]:
+    workdir = tempfile.mkdtemp(prefix="lob-cold-start-")
+    ch_port = free_port()
+    fake_ch = subprocess.Popen(
+        [sys.executable, "-m", "benchmarks.fake_clickhouse", "--port", str(ch_port),
+         "--latency-ms", str(args.ch_latency_ms)],
+        cwd=PROJECT_ROOT,
+        env={**os.environ, "PYTHONPATH": PROJECT_ROOT}
+    )
+    output = None if args.app_output else subprocess.DEVNULL
+    env = app_environment(ch_port, workdir, parse_env(args.env))
+    runs: List[Dict[str, float]] = []
+    try:
+        await wait_for_url(f"http://127.0.0.1:{ch_port}/ping", process=fake_ch)
+
+        # Prepare the db and a user once, measured runs are restarts
+        port = free_port()
+        process = subprocess.Popen(app_command(args, port), cwd=workdir, env=env, stdout=output, stderr=output)
+        try:
+            await wait_for_url(f"http://127.0.0.1:{port}/health", timeout=60, process=process)
+            async with aiohttp.ClientSession() as session:
+                _, user_token = await setup_users(session, f"http://127.0.0.1:{port}")
+        finally:
+            stop(process)
+
+        import_seconds = [measure_import_time(env, workdir) for _ in range(args.runs)]
+
+        headers = {"Authorization": f"Bearer {user_token}"}
+        for run in range(args.runs):
+            port = free_port()
+            base_url = f"http://127.0.0.1:{port}"
+            started = time.perf_counter()
+            process = subprocess.Popen(app_command(args, port), cwd=workdir, env=env, stdout=output, stderr=output)
+            try:
+                async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=5)) as session:
+                    listening, ready, first_data = await asyncio.gather(
+                        time_until_ok(session, f"{base_url}/health", started, process, args.timeout),
+                        time_until_ok(session, f"{base_url}/ready", started, process, args.timeout),
+                        time_until_ok(
+                            session, f"{base_url}/crypto/data/{SYMBOLS[0]}?limit=100", started, process,
+                            args.timeout, headers=headers
+                        ),
+                    )
+            finally:
+                stop(process)
+            result = {"listening_s": listening, "ready_s": ready, "first_data_s": first_data}
+            logger.info(f"Run {run + 1}: " + ", ".join(f"{key}={value:.3f}" for key, value in result.items()))
+            runs.append(result)
+    finally:
+        stop(fake_ch)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    summary = {
+        key: {
+            "median": round(statistics.median(run[key] for run in runs), 4),
+            "min": round(min(run[key] for run in runs), 4),
+            "max": round(max(run[key] for run in runs), 4),
+        }
+        for key in ("listening_s", "ready_s", "first_data_s")
+    }
+    summary["import_app_main_s"] = {
+        "median": round(statistics.median(import_seconds), 4),
+        "min": round(min(import_seconds), 4),
+        "max": round(max(import_seconds), 4),
+    }
+    return {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "commit": git_commit(),
+            "workers": args.workers,
+            "runs": args.runs,
+            "ch_latency_ms": args.ch_latency_ms,
+        },
+        "summary": summary,
+        "runs": runs,
+    }
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Cold start time of the API")
+    parser.add_argument("--runs", type=int, default=5, help="Measured restarts")
+    parser.add_argument("--workers", type=int, default=1, help="API worker processes (run.py --prod)")
+    parser.add_argument("--timeout", type=float, default=60.0, help="Max seconds to wait for each milestone")
+    parser.add_argument("--ch-latency-ms", type=float, default=2.0, help="Fake ClickHouse base latency")
+    parser.add_argument("--env", action="append", default=[], help="Extra app env var KEY=VALUE, repeatable")
+    parser.add_argument("--app-output", action="store_true", help="Show app stdout/stderr")
+    parser.add_argument("--output", default=None, help="Result JSON path (default: benchmarks/results/cold-start-<time>.json)")
+    return parser
+
+
+def main():
+    args = build_parser().parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    report = asyncio.run(run_cold_start(args))
+
+    header = f"{'milestone':<20} {'median s':>9} {'min s':>9} {'max s':>9}"
+    print(header)
+    print("-" * len(header))
+    for key, values in report["summary"].items():
+        print(f"{key:<20} {values['median']:>9} {values['min']:>9} {values['max']:>9}")
+
+    output = args.output or os.path.join(
+        RESULTS_DIR, f"cold-start-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResults saved to {output}")
+
+
+if __name__ == "__main__":
+    main()
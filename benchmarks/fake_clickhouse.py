@@ -0,0 +1,380 @@
+"""
+Fake ClickHouse HTTP endpoint serving synthetic blob_rest_all_aggregated data.
+
+Understands the queries the API sends (connection check, symbol list, latest
+rows of a symbol or of all symbols with LIMIT BY, time ranges) in JSON,
+JSONEachRow, RowBinary and RowBinaryWithNamesAndTypes formats, with
+configurable latency and error rate. Params are bound from param_<name>
+URL parameters; use_query_cache is reflected in the X-ClickHouse-Summary
+header only. EXPLAIN ESTIMATE answers with the matching rows rounded up
+to whole granules, max_rows_to_read is enforced on the returned rows.
+Rows per symbol and day (GROUP BY symbol, day) are computed from the
+fixture's time range without generating rows.
+With enable_http_compression=1 responses are compressed with the first
+of gzip, deflate, br, zstd, lz4 listed in Accept-Encoding (br, zstd and lz4
+when their packages are installed); lz4 query bodies are decoded here,
+gzip, deflate and br ones by aiohttp (zstd ones need backports.zstd).
+
+    python -m benchmarks.fake_clickhouse --port 18123 --latency-ms 5
+"""
+import argparse
+import asyncio
+import json
+import random
+import re
+import struct
+import time
+import zlib
+from typing import Any, Dict, List, Optional, Tuple
+from aiohttp import web
+from benchmarks.lob_fixtures import SYMBOLS, COLUMNS, HISTORY_MS, STEP_MS, iter_rows, latest_event_time, to_clickhouse_json_row
+import logging
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+
+logger = logging.getLogger(__name__)
+
+COLUMN_TYPES = dict(COLUMNS)
+
+_FORMAT_RE = re.compile(r"\bFORMAT\s+(\w+)\s*;?\s*$", re.IGNORECASE)
+_PARAM_RE = re.compile(r"\{(\w+):[^}]+\}")
+_SELECT_ONE_RE = re.compile(r"^\s*SELECT\s+1\s+(?:as\s+)?(\w+)", re.IGNORECASE)
+_SYMBOL_RE = re.compile(r"\bsymbol\s*=\s*'([^']*)'", re.IGNORECASE)
+_LIMIT_RE = re.compile(r"\bLIMIT\s+(\d+)\b(?!\s+BY)", re.IGNORECASE)
+_LIMIT_BY_RE = re.compile(r"\bLIMIT\s+(\d+)\s+BY\s+symbol\b", re.IGNORECASE)
+_SELECT_COLUMNS_RE = re.compile(r"^\s*SELECT\s+(.*?)\s+FROM\s", re.IGNORECASE | re.DOTALL)
+_TIME_FILTER_RE = re.compile(r"\bevent_time\s*(>=|>|<=|<)\s*(\d+)", re.IGNORECASE)
+_EXPLAIN_ESTIMATE_RE = re.compile(r"^\s*EXPLAIN\s+ESTIMATE\s+", re.IGNORECASE)
+_GROUP_BY_DAY_RE = re.compile(r"\bGROUP\s+BY\s+symbol\s*,\s*day\b", re.IGNORECASE)
+
+INDEX_GRANULARITY = 8192
+
+RESPONSE_COMPRESSORS = {
+    "gzip": lambda data: zlib.compress(data, 3, wbits=31),
+    "deflate": lambda data: zlib.compress(data, 3),
+    **({"br": lambda data: brotli.compress(data, quality=3)} if brotli else {}),
+    **({"zstd": lambda data: zstandard.ZstdCompressor(level=1).compress(data)} if zstandard else {}),
+    **({"lz4": lambda data: lz4.frame.compress(data)} if lz4 else {}),
+}
+
+
+class FakeClickHouse:
+    def __init__(
+        self,
+        latency_ms: float = 0.0,
+        jitter_ms: float = 0.0,
+        error_rate: float = 0.0,
+        symbols: Optional[List[str]] = None
+    ):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.symbols = symbols or SYMBOLS
+        self.stats = {"queries": 0, "rows": 0, "errors": 0, "query_cache_hits": 0}
+        # (query, params) -> expiry of results kept for use_query_cache
+        self.query_cache: Dict[Tuple[str, tuple], float] = {}
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_route("*", "/", self.handle)
+        app.router.add_get("/ping", self.ping)
+        app.router.add_get("/fake/stats", self.get_stats)
+        app.router.add_post("/fake/config", self.set_config)
+        return app
+
+    async def ping(self, request: web.Request) -> web.Response:
+        return web.Response(text="Ok.\n")
+
+    async def get_stats(self, request: web.Request) -> web.Response:
+        return web.json_response(self.stats)
+
+    async def set_config(self, request: web.Request) -> web.Response:
+        """Changes latency/error rate while running, e.g. to simulate an outage"""
+        config = await request.json()
+        for key in ("latency_ms", "jitter_ms", "error_rate"):
+            if key in config:
+                setattr(self, key, float(config[key]))
+        return web.json_response({"latency_ms": self.latency_ms, "jitter_ms": self.jitter_ms, "error_rate": self.error_rate})
+
+    async def handle(self, request: web.Request) -> web.Response:
+        query = request.query.get("query", "")
+        if request.method == "POST":
+            body = await request.read()
+            if request.headers.get("Content-Encoding", "").lower() == "lz4" and lz4 is not None:
+                body = lz4.frame.decompress(body)
+            query = f"{query} {body.decode()}".strip()
+        params = {
+            key[len("param_"):]: value
+            for key, value in request.query.items() if key.startswith("param_")
+        }
+
+        self.stats["queries"] += 1
+        delay = self.latency_ms + random.uniform(0, self.jitter_ms)
+        if delay > 0:
+            await asyncio.sleep(delay / 1000)
+
+        if self.error_rate and random.random() < self.error_rate:
+            self.stats["errors"] += 1
+            return web.Response(status=500, text="Code: 999. DB::Exception: Injected failure (fake)")
+
+        started = time.perf_counter()
+        try:
+            query, fmt = self._split_format(self._bind_params(query, params))
+            meta, rows = self.run_query(query)
+        except ValueError as e:
+            self.stats["errors"] += 1
+            return web.Response(status=400, text=f"Code: 62. DB::Exception: {e} (fake)")
+
+        max_rows_to_read = int(request.query.get("max_rows_to_read", 0))
+        if max_rows_to_read and len(rows) > max_rows_to_read:
+            self.stats["errors"] += 1
+            return web.Response(
+                status=500,
+                text=f"Code: 158. DB::Exception: Limit for rows (controlled by 'max_rows_to_read' setting) exceeded, "
+                     f"max rows: {max_rows_to_read}, current rows: {len(rows)}. (TOO_MANY_ROWS) (fake)"
+            )
+
+        self.stats["rows"] += len(rows)
+        elapsed = time.perf_counter() - started
+        read_rows = len(rows)
+        if request.query.get("use_query_cache") in ("1", "true"):
+            # Only the summary is simulated: a hit reads nothing
+            key = (query, tuple(sorted(params.items())))
+            now = time.monotonic()
+            if self.query_cache.get(key, 0) > now:
+                read_rows = 0
+                self.stats["query_cache_hits"] += 1
+            else:
+                self.query_cache[key] = now + float(request.query.get("query_cache_ttl", 60))
+        summary = {"read_rows": str(read_rows), "read_bytes": str(read_rows * 96), "elapsed_ns": str(int(elapsed * 1e9))}
+        headers = {"X-ClickHouse-Summary": json.dumps(summary), "X-ClickHouse-Format": fmt}
+        body = encode(fmt, meta, rows, elapsed)
+        if request.query.get("enable_http_compression") in ("1", "true"):
+            accepted = [value.split(";")[0].strip().lower() for value in request.headers.get("Accept-Encoding", "").split(",")]
+            encoding = next((value for value in accepted if value in RESPONSE_COMPRESSORS), None)
+            if encoding is not None:
+                body = RESPONSE_COMPRESSORS[encoding](body)
+                headers["Content-Encoding"] = encoding
+        return web.Response(body=body, headers=headers, content_type=content_type(fmt))
+
+    @staticmethod
+    def _bind_params(query: str, params: Dict[str, str]) -> str:
+        def replace(match: re.Match) -> str:
+            name = match.group(1)
+            if name not in params:
+                raise ValueError(f"Substitution `{name}` is not set")
+            value = params[name]
+            return value if value.lstrip("-").isdigit() else "'" + value.replace("'", "\\'") + "'"
+        return _PARAM_RE.sub(replace, query)
+
+    @staticmethod
+    def _split_format(query: str) -> Tuple[str, str]:
+        match = _FORMAT_RE.search(query)
+        if not match:
+            return query, "TabSeparated"
+        return query[:match.start()], match.group(1)
+
+    def run_query(self, query: str) -> Tuple[List[Tuple[str, str]], List[Dict[str, Any]]]:
+        match = _SELECT_ONE_RE.match(query)
+        if match:
+            return [(match.group(1), "UInt8")], [{match.group(1): 1}]
+
+        if "blob_rest_all_aggregated" not in query:
+            raise ValueError("Unknown table (fake server serves blob_rest_all_aggregated only)")
+
+        explain = _EXPLAIN_ESTIMATE_RE.match(query)
+        if explain:
+            # Whole granules of the rows matching the filters, LIMIT doesn't reduce the estimate
+            _, rows = self._select_rows(_LIMIT_RE.sub("", query[explain.end():]))
+            estimate = -(-len(rows) // INDEX_GRANULARITY) * INDEX_GRANULARITY
+            meta = [("database", "String"), ("table", "String"), ("parts", "UInt64"), ("rows", "UInt64"), ("marks", "UInt64")]
+            return meta, [{"database": "default", "table": "blob_rest_all_aggregated", "parts": 1,
+                           "rows": estimate, "marks": estimate // INDEX_GRANULARITY}]
+
+        if _GROUP_BY_DAY_RE.search(query):
+            return self._symbol_days(query)
+
+        if re.search(r"DISTINCT\s+symbol", query, re.IGNORECASE):
+            return [("symbol", "String")], [{"symbol": symbol} for symbol in sorted(self.symbols)]
+
+        return self._select_rows(query)
+
+    def _symbol_days(self, query: str) -> Tuple[List[Tuple[str, str]], List[Dict[str, Any]]]:
+        """Rows, first and last event_time per symbol and day, counted from the fixture's range"""
+        day_ms = 86400 * 1000
+        last = latest_event_time()
+        first = last - HISTORY_MS
+        for op, value in _TIME_FILTER_RE.findall(query):
+            if op == ">=":
+                first = max(first, int(value) + (-int(value)) % STEP_MS)
+        meta = [("symbol", "String"), ("day", "UInt64"), ("rows", "UInt64"), ("first_time", "UInt64"), ("last_time", "UInt64")]
+        rows = []
+        for symbol in sorted(self.symbols):
+            day = first - first % day_ms
+            while day <= last:
+                lo, hi = max(first, day), min(last, day + day_ms - STEP_MS)
+                if lo <= hi:
+                    rows.append({"symbol": symbol, "day": str(day), "rows": str((hi - lo) // STEP_MS + 1),
+                                 "first_time": str(lo), "last_time": str(hi)})
+                day += day_ms
+        return meta, rows
+
+    def _select_rows(self, query: str) -> Tuple[List[Tuple[str, str]], List[Dict[str, Any]]]:
+        symbol_match = _SYMBOL_RE.search(query)
+        limit_match = _LIMIT_RE.search(query)
+        limit = int(limit_match.group(1)) if limit_match else None
+        limit_by_match = _LIMIT_BY_RE.search(query)
+        limit_per_symbol = int(limit_by_match.group(1)) if limit_by_match else limit
+        descending = not re.search(r"ORDER\s+BY\s+event_time\s+ASC", query, re.IGNORECASE)
+
+        start = end = None
+        for op, value in _TIME_FILTER_RE.findall(query):
+            value = int(value)
+            if op == ">=":
+                start = value if start is None else max(start, value)
+            elif op == ">":
+                start = value + 1 if start is None else max(start, value + 1)
+            elif op == "<":
+                end = value if end is None else min(end, value)
+            else:
+                end = value + 1 if end is None else min(end, value + 1)
+
+        columns = [name for name, _ in COLUMNS]
+        select_match = _SELECT_COLUMNS_RE.match(query)
+        if select_match and select_match.group(1).strip() != "*":
+            requested = [column.strip() for column in select_match.group(1).split(",")]
+            unknown = [column for column in requested if column not in COLUMN_TYPES]
+            if unknown:
+                raise ValueError(f"Missing columns: {unknown}")
+            columns = requested
+
+        symbols = [symbol_match.group(1)] if symbol_match else self.symbols
+        rows = []
+        for symbol in symbols:
+            if symbol not in self.symbols:
+                continue
+            rows.extend(iter_rows(symbol, start, end, descending=descending, limit=limit_per_symbol))
+        if len(symbols) > 1:
+            rows.sort(key=lambda row: row["event_time"], reverse=descending)
+            rows = rows[:limit] if limit is not None else rows
+
+        meta = [(name, COLUMN_TYPES[name]) for name in columns]
+        if columns != [name for name, _ in COLUMNS]:
+            rows = [{name: row[name] for name in columns} for row in rows]
+        return meta, rows
+
+
+def content_type(fmt: str) -> str:
+    if fmt.startswith("RowBinary"):
+        return "application/octet-stream"
+    if fmt.startswith("JSON"):
+        return "application/json"
+    return "text/plain"
+
+
+def encode(fmt: str, meta: List[Tuple[str, str]], rows: List[Dict[str, Any]], elapsed: float = 0.0) -> bytes:
+    if fmt == "JSON":
+        return json.dumps({
+            "meta": [{"name": name, "type": type_} for name, type_ in meta],
+            "data": [to_clickhouse_json_row(row) for row in rows],
+            "rows": len(rows),
+            "statistics": {"elapsed": elapsed, "rows_read": len(rows), "bytes_read": len(rows) * 96}
+        }).encode()
+    if fmt == "JSONEachRow":
+        return "".join(json.dumps(to_clickhouse_json_row(row)) + "\n" for row in rows).encode()
+    if fmt in ("RowBinary", "RowBinaryWithNamesAndTypes"):
+        return encode_row_binary(meta, rows, with_header=fmt == "RowBinaryWithNamesAndTypes")
+    if fmt == "TabSeparated":
+        return "".join("\t".join(str(row[name]) for name, _ in meta) + "\n" for row in rows).encode()
+    raise ValueError(f"Unsupported format {fmt}")
+
+
+def _varint(value: int) -> bytes:
+    out = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def _encode_string(value: str) -> bytes:
+    data = value.encode()
+    return _varint(len(data)) + data
+
+
+_STRUCT_CODES = {
+    "UInt8": "<B", "UInt16": "<H", "UInt32": "<I", "UInt64": "<Q",
+    "Int8": "<b", "Int16": "<h", "Int32": "<i", "Int64": "<q",
+    "Float32": "<f", "Float64": "<d",
+}
+
+
+def encode_row_binary(meta: List[Tuple[str, str]], rows: List[Dict[str, Any]], with_header: bool = False) -> bytes:
+    out = bytearray()
+    if with_header:
+        out += _varint(len(meta))
+        for name, _ in meta:
+            out += _encode_string(name)
+        for _, type_ in meta:
+            out += _encode_string(type_)
+    packers = [
+        (name, _encode_string if type_ == "String" else struct.Struct(_STRUCT_CODES[type_]).pack)
+        for name, type_ in meta
+    ]
+    for row in rows:
+        for name, pack in packers:
+            out += pack(row[name])
+    return bytes(out)
+
+
+class FakeClickHouseServer:
+    """Runs the fake endpoint in the current event loop"""
+    def __init__(self, fake: FakeClickHouse, host: str = "127.0.0.1", port: int = 18123):
+        self.fake = fake
+        self.host = host
+        self.port = port
+        self._runner: Optional[web.AppRunner] = None
+
+    async def start(self) -> None:
+        self._runner = web.AppRunner(self.fake.make_app(), access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        logger.info(f"Fake ClickHouse listening on {self.host}:{self.port}")
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake ClickHouse HTTP server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=18123)
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="Base latency added to each query")
+    parser.add_argument("--jitter-ms", type=float, default=0.0, help="Random extra latency, uniform 0..jitter")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of queries answered with an error")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    fake = FakeClickHouse(args.latency_ms, args.jitter_ms, args.error_rate)
+    web.run_app(fake.make_app(), host=args.host, port=args.port, access_log=None, print=None)
+
+
+if __name__ == "__main__":
+    main()
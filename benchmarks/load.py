@@ -0,0 +1,402 @@
+"""
+End-to-end load benchmark.
+
+Starts the fake ClickHouse endpoint and the API (uvicorn) in subprocesses,
+drives the main endpoints with an async load generator and reports throughput
+and latency percentiles. Results are saved as JSON and can be compared with a
+previous run to spot regressions.
+
+    python -m benchmarks.load --duration 20 --concurrency 32 --ch-latency-ms 5
+    python -m benchmarks.load --compare benchmarks/results/baseline.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple
+import aiohttp
+from benchmarks.lob_fixtures import SYMBOLS
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(PROJECT_ROOT, "benchmarks", "results")
+
+REGISTRATION_SECRET = "bench-registration-secret"
+ADMIN_SECRET = "bench-admin-secret"
+PASSWORD = "bench-password"
+
+# scenario name -> weight
+DEFAULT_MIX = {"symbols": 2, "data": 6, "token": 1, "admin": 1}
+
+# Load shedding (rate limits, admission control), reported apart from errors
+REJECTED_STATUSES = {429, 503}
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def app_environment(ch_port: int, workdir: str, extra_env: Dict[str, str]) -> Dict[str, str]:
+    env = dict(os.environ)
+    env.update({
+        "PYTHONPATH": PROJECT_ROOT,
+        "SECRET_KEY": "bench-secret-key",
+        "CLICKHOUSE_HOST": "127.0.0.1",
+        "CLICKHOUSE_PORT": str(ch_port),
+        "CLICKHOUSE_USER": "default",
+        "CLICKHOUSE_PASSWORD": "bench",
+        "CLICKHOUSE_DATABASE": "bench",
+        "DATABASE_URL": f"sqlite:///{os.path.join(workdir, 'bench.db')}",
+        "REGISTRATION_ENABLED": "True",
+        "REGISTRATION_SECRET": REGISTRATION_SECRET,
+        "ADMIN_SECRET": ADMIN_SECRET,
+        # The benchmark user would mostly measure 429s, enable with --env to benchmark the limiter
+        "RATE_LIMIT_ENABLED": "false",
+    })
+    env.update(extra_env)
+    return env
+
+
+async def wait_for_url(url: str, timeout: float = 30.0, process: Optional[subprocess.Popen] = None) -> None:
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline:
+            if process is not None and process.poll() is not None:
+                raise RuntimeError(f"Process exited with code {process.returncode} while starting")
+            try:
+                async with session.get(url) as response:
+                    if response.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.1)
+    raise TimeoutError(f"{url} did not become ready in {timeout}s")
+
+
+@contextmanager
+def run_stack(args, extra_env: Dict[str, str]):
+    """
+    Starts fake ClickHouse and the API, yields (base_url, ch_url)
+    """
+    workdir = tempfile.mkdtemp(prefix="lob-bench-")
+    ch_port = args.ch_port or free_port()
+    app_port = free_port()
+    processes: List[subprocess.Popen] = []
+    try:
+        processes.append(subprocess.Popen(
+            [sys.executable, "-m", "benchmarks.fake_clickhouse", "--port", str(ch_port),
+             "--latency-ms", str(args.ch_latency_ms), "--jitter-ms", str(args.ch_jitter_ms)],
+            cwd=PROJECT_ROOT,
+            env={**os.environ, "PYTHONPATH": PROJECT_ROOT}
+        ))
+        env = app_environment(ch_port, workdir, extra_env)
+        processes.append(subprocess.Popen(
+            app_command(args, app_port),
+            cwd=workdir,  # logs/ and profiles are written relative to cwd
+            env=env,
+            stdout=subprocess.DEVNULL if not args.app_output else None,
+            stderr=subprocess.DEVNULL if not args.app_output else None
+        ))
+        yield f"http://127.0.0.1:{app_port}", f"http://127.0.0.1:{ch_port}", processes
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+        for process in reversed(processes):
+            try:
+                process.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def app_command(args, port: int) -> List[str]:
+    return [
+        sys.executable, os.path.join(PROJECT_ROOT, "run.py"), "--prod",
+        "--host", "127.0.0.1", "--port", str(port),
+        "--workers", str(args.workers), "--log-level", "warning",
+    ]
+
+
+async def get_token(session: aiohttp.ClientSession, base_url: str, username: str) -> str:
+    async with session.post(f"{base_url}/auth/token", data={"username": username, "password": PASSWORD}) as response:
+        response.raise_for_status()
+        return (await response.json())["access_token"]
+
+
+async def setup_users(session: aiohttp.ClientSession, base_url: str) -> Tuple[str, str]:
+    for username, is_admin in (("bench_admin", True), ("bench_user", False)):
+        headers = {"X-Registration-Secret": REGISTRATION_SECRET}
+        if is_admin:
+            headers["X-Admin-Secret"] = ADMIN_SECRET
+        async with session.post(
+            f"{base_url}/auth/register",
+            json={"username": username, "email": f"{username}@bench.local", "password": PASSWORD},
+            headers=headers
+        ) as response:
+            if response.status not in (200, 400):  # 400: already registered
+                raise RuntimeError(f"Registration failed: {response.status} {await response.text()}")
+    return await get_token(session, base_url, "bench_admin"), await get_token(session, base_url, "bench_user")
+
+
+class LoadGenerator:
+    def __init__(self, base_url: str, admin_token: str, user_token: str, mix: Dict[str, int], limits: List[int]):
+        self.base_url = base_url
+        self.admin_headers = {"Authorization": f"Bearer {admin_token}"}
+        self.user_headers = {"Authorization": f"Bearer {user_token}"}
+        self.scenarios = list(mix)
+        self.weights = [mix[name] for name in self.scenarios]
+        self.limits = limits
+        self.samples: Dict[str, List[float]] = {name: [] for name in self.scenarios}
+        # scenario -> status code (or "timeout"/"connection") -> count, successes left out
+        self.statuses: Dict[str, Dict[str, int]] = {name: {} for name in self.scenarios}
+        self.recording = False
+
+    def request_for(self, scenario: str) -> Tuple[str, str, Dict[str, Any]]:
+        if scenario == "symbols":
+            return "GET", "/crypto/symbols", {"headers": self.user_headers}
+        if scenario == "data":
+            symbol = random.choice(SYMBOLS)
+            limit = random.choice(self.limits)
+            return "GET", f"/crypto/data/{symbol}?limit={limit}", {"headers": self.user_headers}
+        if scenario == "token":
+            return "POST", "/auth/token", {"data": {"username": "bench_user", "password": PASSWORD}}
+        if scenario == "admin":
+            path = random.choice(["/admin/stats", "/admin/logs?limit=50"])
+            return "GET", path, {"headers": self.admin_headers}
+        raise ValueError(f"Unknown scenario {scenario}")
+
+    async def worker(self, session: aiohttp.ClientSession, stop_at: float) -> None:
+        while time.monotonic() < stop_at:
+            scenario = random.choices(self.scenarios, self.weights)[0]
+            method, path, kwargs = self.request_for(scenario)
+            start = time.perf_counter()
+            status = None
+            try:
+                async with session.request(method, f"{self.base_url}{path}", **kwargs) as response:
+                    await response.read()
+                    if response.status >= 400:
+                        status = str(response.status)
+            except asyncio.TimeoutError:
+                status = "timeout"
+            except aiohttp.ClientError:
+                status = "connection"
+            latency = time.perf_counter() - start
+            if self.recording:
+                self.samples[scenario].append(latency)
+                if status is not None:
+                    statuses = self.statuses[scenario]
+                    statuses[status] = statuses.get(status, 0) + 1
+
+    async def run(self, concurrency: int, duration: float, warmup: float, timeout: float) -> float:
+        connector = aiohttp.TCPConnector(limit=concurrency)
+        client_timeout = aiohttp.ClientTimeout(total=timeout)
+        async with aiohttp.ClientSession(connector=connector, timeout=client_timeout) as session:
+            if warmup > 0:
+                stop_at = time.monotonic() + warmup
+                await asyncio.gather(*(self.worker(session, stop_at) for _ in range(concurrency)))
+            self.recording = True
+            started = time.monotonic()
+            stop_at = started + duration
+            await asyncio.gather(*(self.worker(session, stop_at) for _ in range(concurrency)))
+            return time.monotonic() - started
+
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, int(round(pct / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def summarize(samples: List[float], statuses: Dict[str, int], elapsed: float) -> Dict[str, Any]:
+    """
+    errors are failed requests (other 4xx/5xx, timeouts, connection errors),
+    rejected the ones shed with 429/503; statuses counts both by status
+    """
+    values = sorted(samples)
+    rejected = sum(count for status, count in statuses.items() if status.isdigit() and int(status) in REJECTED_STATUSES)
+    return {
+        "requests": len(values),
+        "errors": sum(statuses.values()) - rejected,
+        "rejected": rejected,
+        "statuses": dict(sorted(statuses.items())),
+        "rps": round(len(values) / elapsed, 2) if elapsed else 0.0,
+        "mean_ms": round(sum(values) / len(values) * 1000, 3) if values else 0.0,
+        "p50_ms": round(percentile(values, 50) * 1000, 3),
+        "p95_ms": round(percentile(values, 95) * 1000, 3),
+        "p99_ms": round(percentile(values, 99) * 1000, 3),
+        "max_ms": round(values[-1] * 1000, 3) if values else 0.0,
+    }
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=PROJECT_ROOT, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(current: Dict[str, Any], baseline: Dict[str, Any], threshold: float) -> List[str]:
+    """
+    Returns human readable regressions: rps drop or p95 increase above threshold (fraction)
+    """
+    regressions = []
+    for scenario, result in current["results"].items():
+        base = baseline.get("results", {}).get(scenario)
+        if not base or not base["requests"]:
+            continue
+        if base["rps"] and result["rps"] < base["rps"] * (1 - threshold):
+            regressions.append(f"{scenario}: rps {base['rps']} -> {result['rps']}")
+        if base["p95_ms"] and result["p95_ms"] > base["p95_ms"] * (1 + threshold):
+            regressions.append(f"{scenario}: p95 {base['p95_ms']}ms -> {result['p95_ms']}ms")
+    return regressions
+
+
+def print_report(report: Dict[str, Any]) -> None:
+    header = (
+        f"{'scenario':<10} {'requests':>9} {'errors':>7} {'rejected':>9} {'rps':>9} "
+        f"{'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}"
+    )
+    print(header)
+    print("-" * len(header))
+    for scenario, r in report["results"].items():
+        print(
+            f"{scenario:<10} {r['requests']:>9} {r['errors']:>7} {r.get('rejected', 0):>9} {r['rps']:>9} "
+            f"{r['p50_ms']:>9} {r['p95_ms']:>9} {r['p99_ms']:>9} {r['max_ms']:>9}"
+        )
+    statuses = report["results"].get("total", {}).get("statuses")
+    if statuses:
+        print("\nFailed and rejected requests by status: " + ", ".join(f"{status}: {count}" for status, count in statuses.items()))
+
+
+def parse_env(values: List[str]) -> Dict[str, str]:
+    env = {}
+    for value in values:
+        key, _, val = value.partition("=")
+        env[key] = val
+    return env
+
+
+def parse_mix(value: str) -> Dict[str, int]:
+    mix = {}
+    for item in value.split(","):
+        name, _, weight = item.partition("=")
+        mix[name.strip()] = int(weight or 1)
+    return mix
+
+
+async def run_benchmark(args) -> Dict[str, Any]:
+    extra_env = parse_env(args.env)
+    mix = parse_mix(args.mix) if args.mix else DEFAULT_MIX
+    with run_stack(args, extra_env) as (base_url, ch_url, processes):
+        await wait_for_url(f"{ch_url}/ping", process=processes[0])
+        await wait_for_url(f"{base_url}/health", timeout=60, process=processes[1])
+
+        async with aiohttp.ClientSession() as session:
+            admin_token, user_token = await setup_users(session, base_url)
+
+        generator = LoadGenerator(base_url, admin_token, user_token, mix, args.limits)
+        elapsed = await generator.run(args.concurrency, args.duration, args.warmup, args.timeout)
+
+        async with aiohttp.ClientSession() as session:
+            async with session.get(f"{ch_url}/fake/stats") as response:
+                backend_stats = await response.json()
+
+    results = {
+        scenario: summarize(generator.samples[scenario], generator.statuses[scenario], elapsed)
+        for scenario in generator.scenarios
+    }
+    all_samples = [value for values in generator.samples.values() for value in values]
+    all_statuses: Dict[str, int] = {}
+    for statuses in generator.statuses.values():
+        for status, count in statuses.items():
+            all_statuses[status] = all_statuses.get(status, 0) + count
+    results["total"] = summarize(all_samples, all_statuses, elapsed)
+
+    return {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "cpu_count": os.cpu_count(),
+            "workers": args.workers,
+            "concurrency": args.concurrency,
+            "duration": args.duration,
+            "ch_latency_ms": args.ch_latency_ms,
+            "mix": mix,
+            "env": extra_env,
+        },
+        "backend": backend_stats,
+        "results": results,
+    }
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="End-to-end load benchmark against a fake ClickHouse")
+    parser.add_argument("--duration", type=float, default=15.0, help="Measured seconds")
+    parser.add_argument("--warmup", type=float, default=2.0, help="Unmeasured seconds before the run")
+    parser.add_argument("--concurrency", type=int, default=32, help="Concurrent client connections")
+    parser.add_argument("--workers", type=int, default=1, help="API worker processes (run.py --prod)")
+    parser.add_argument("--timeout", type=float, default=10.0, help="Client timeout per request, counted as error")
+    parser.add_argument("--mix", default=None, help="Scenario weights, e.g. data=6,symbols=2,token=1,admin=1")
+    parser.add_argument("--limits", type=int, nargs="+", default=[10, 100, 1000], help="limit values for /crypto/data")
+    parser.add_argument("--ch-port", type=int, default=None)
+    parser.add_argument("--ch-latency-ms", type=float, default=2.0, help="Fake ClickHouse base latency")
+    parser.add_argument("--ch-jitter-ms", type=float, default=1.0, help="Fake ClickHouse random extra latency")
+    parser.add_argument("--env", action="append", default=[], help="Extra app env var KEY=VALUE, repeatable")
+    parser.add_argument("--app-output", action="store_true", help="Show app stdout/stderr")
+    parser.add_argument("--output", default=None, help="Result JSON path (default: benchmarks/results/load-<time>.json)")
+    parser.add_argument("--compare", default=None, help="Previous result JSON to compare with")
+    parser.add_argument("--threshold", type=float, default=0.10, help="Regression threshold as a fraction")
+    parser.add_argument("--fail-on-regression", action="store_true", help="Exit with code 1 on regressions")
+    return parser
+
+
+def main():
+    args = build_parser().parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    report = asyncio.run(run_benchmark(args))
+    print_report(report)
+
+    output = args.output or os.path.join(
+        RESULTS_DIR, f"load-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResults saved to {output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.threshold)
+        if regressions:
+            print("\nRegressions:")
+            for line in regressions:
+                print(f"  {line}")
+            if args.fail_on_regression:
+                sys.exit(1)
+        else:
+            print(f"\nNo regressions above {args.threshold:.0%} compared to {args.compare}")
+
+
+if __name__ == "__main__":
+    main()
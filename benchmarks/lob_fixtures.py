@@ -0,0 +1,110 @@
+"""
+Synthetic rows shaped like blob_rest_all_aggregated.
+
+Rows are a pure function of (symbol, event_time), so any time range can be
+generated on demand without keeping data in memory.
+"""
+import math
+import time
+import zlib
+from typing import Any, Dict, Iterator, List, Optional
+
+
+SYMBOLS = [
+    "BTCUSDT", "ETHUSDT", "BNBUSDT", "SOLUSDT", "XRPUSDT",
+    "ADAUSDT", "DOGEUSDT", "TRXUSDT", "LINKUSDT", "AVAXUSDT",
+]
+
+# event_time is epoch milliseconds, one aggregated snapshot per second
+STEP_MS = 1000
+# Data exists for this long before now
+HISTORY_MS = 7 * 86400 * 1000
+
+# (name, ClickHouse type)
+COLUMNS = [
+    ("symbol", "String"),
+    ("event_time", "UInt64"),
+    ("best_bid", "Float64"),
+    ("best_ask", "Float64"),
+    ("best_bid_qty", "Float64"),
+    ("best_ask_qty", "Float64"),
+    ("mid_price", "Float64"),
+    ("spread", "Float64"),
+    ("bid_volume_10", "Float64"),
+    ("ask_volume_10", "Float64"),
+    ("imbalance", "Float64"),
+    ("trades_count", "UInt32"),
+]
+
+
+def _noise(symbol_seed: int, event_time: int, salt: int) -> float:
+    # Deterministic value in [0, 1)
+    return (zlib.crc32(f"{symbol_seed}:{event_time}:{salt}".encode()) & 0xFFFFFF) / 0x1000000
+
+
+def make_row(symbol: str, event_time: int) -> Dict[str, Any]:
+    seed = zlib.crc32(symbol.encode())
+    base = 10 + (seed % 50000)
+    t = event_time / 1000
+    mid = base * (1 + 0.02 * math.sin(t / 3600 + seed) + 0.002 * math.sin(t / 60))
+    spread = base * 0.0001 * (1 + _noise(seed, event_time, 1))
+    bid_volume = 100 * (1 + 4 * _noise(seed, event_time, 2))
+    ask_volume = 100 * (1 + 4 * _noise(seed, event_time, 3))
+    return {
+        "symbol": symbol,
+        "event_time": event_time,
+        "best_bid": round(mid - spread / 2, 6),
+        "best_ask": round(mid + spread / 2, 6),
+        "best_bid_qty": round(10 * _noise(seed, event_time, 4), 4),
+        "best_ask_qty": round(10 * _noise(seed, event_time, 5), 4),
+        "mid_price": round(mid, 6),
+        "spread": round(spread, 6),
+        "bid_volume_10": round(bid_volume, 4),
+        "ask_volume_10": round(ask_volume, 4),
+        "imbalance": round((bid_volume - ask_volume) / (bid_volume + ask_volume), 6),
+        "trades_count": int(50 * _noise(seed, event_time, 6)),
+    }
+
+
+def latest_event_time(now_ms: Optional[int] = None) -> int:
+    now_ms = int(time.time() * 1000) if now_ms is None else now_ms
+    return now_ms - now_ms % STEP_MS
+
+
+def iter_rows(
+    symbol: str,
+    start: Optional[int] = None,
+    end: Optional[int] = None,
+    descending: bool = True,
+    limit: Optional[int] = None,
+    now_ms: Optional[int] = None,
+    history_ms: int = HISTORY_MS
+) -> Iterator[Dict[str, Any]]:
+    """
+    Rows of a symbol with start <= event_time < end
+
+    Args:
+        history_ms: How far back data exists relative to now
+    """
+    last = latest_event_time(now_ms)
+    first = last - history_ms
+    lo = first if start is None else max(first, start + (-start) % STEP_MS)
+    hi = last if end is None else min(last, end - 1 - (end - 1) % STEP_MS)
+    if lo > hi:
+        return
+
+    times = range(hi, lo - 1, -STEP_MS) if descending else range(lo, hi + 1, STEP_MS)
+    for count, event_time in enumerate(times):
+        if limit is not None and count >= limit:
+            return
+        yield make_row(symbol, event_time)
+
+
+def make_rows(symbol: str, count: int, now_ms: Optional[int] = None) -> List[Dict[str, Any]]:
+    """The latest `count` rows of a symbol, newest first"""
+    return list(iter_rows(symbol, limit=count, now_ms=now_ms))
+
+
+def to_clickhouse_json_row(row: Dict[str, Any]) -> Dict[str, Any]:
+    # ClickHouse quotes 64-bit integers in JSON formats by default
+    return {key: str(value) if key == "event_time" else value for key, value in row.items()}
@@ -0,0 +1,42 @@
+"""
+Micro-benchmarks for code that runs on every request.
+
+    python -m benchmarks.micro
+    python -m benchmarks.micro -k decode --sizes 100 10000
+
+Each benchmark is a setup function registered with @benchmark. It returns
+the operation to measure (a plain or async callable without arguments).
+Benchmarks with sizes are run once per LOB fixture size.
+"""
+import os
+import tempfile
+from typing import Callable, List, NamedTuple, Optional, Sequence
+
+# app settings are required at import time, benchmarks don't talk to any server
+for _key, _value in {
+    "SECRET_KEY": "micro-benchmark-secret",
+    "CLICKHOUSE_HOST": "127.0.0.1",
+    "CLICKHOUSE_USER": "default",
+    "CLICKHOUSE_PASSWORD": "bench",
+    "CLICKHOUSE_DATABASE": "bench",
+    "DATABASE_URL": f"sqlite:///{os.path.join(tempfile.gettempdir(), 'lob_api_micro.db')}",
+}.items():
+    os.environ.setdefault(_key, _value)
+
+ROW_COUNTS = (10, 100, 1000, 10000)
+
+
+class Benchmark(NamedTuple):
+    name: str
+    setup: Callable
+    sizes: Optional[Sequence[int]]
+
+
+BENCHMARKS: List[Benchmark] = []
+
+
+def benchmark(name: str, sizes: Optional[Sequence[int]] = None):
+    def register(setup: Callable) -> Callable:
+        BENCHMARKS.append(Benchmark(name, setup, sizes))
+        return setup
+    return register
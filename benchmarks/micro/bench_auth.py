@@ -0,0 +1,16 @@
+from benchmarks.micro import benchmark
+
+
+@benchmark("auth.verify_token")
+def verify_token():
+    from app.core.security import create_access_token, verify_token
+
+    token = create_access_token(subject="bench_user")
+    return lambda: verify_token(token)
+
+
+@benchmark("auth.create_access_token")
+def create_access_token():
+    from app.core.security import create_access_token
+
+    return lambda: create_access_token(subject="bench_user")
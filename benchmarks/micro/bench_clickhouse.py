@@ -0,0 +1,19 @@
+from benchmarks.micro import benchmark, ROW_COUNTS
+from benchmarks.micro.fixtures import clickhouse_json_body
+
+
+@benchmark("clickhouse.build_query")
+def build_query():
+    from app.db.clickhouse import AsyncClickHouseClient
+    from app.repositories.crypto_repository import SYMBOL_DATA_QUERY
+
+    params = {"symbol": "BTCUSDT", "limit": 100}
+    return lambda: (AsyncClickHouseClient.build_query(SYMBOL_DATA_QUERY), AsyncClickHouseClient.build_params(params))
+
+
+@benchmark("clickhouse.decode_response", sizes=ROW_COUNTS)
+def decode_response(size: int):
+    from app.db.clickhouse import AsyncClickHouseClient
+
+    body = clickhouse_json_body(size)
+    return lambda: AsyncClickHouseClient.decode_response(body)
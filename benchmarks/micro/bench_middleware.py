@@ -0,0 +1,116 @@
+from benchmarks.micro import benchmark
+
+
+@benchmark("middleware.log_requests")
+def log_requests():
+    """Per-request work of the logging middleware around a no-op endpoint"""
+    from app.middleware.logging import RequestLoggingMiddleware
+    from app.services.api_log_writer import api_log_writer
+
+    scope = {
+        "type": "http",
+        "method": "GET",
+        "path": "/crypto/data/BTCUSDT",
+        "raw_path": b"/crypto/data/BTCUSDT",
+        "query_string": b"limit=100",
+        "headers": [(b"host", b"localhost"), (b"user-agent", b"micro-benchmark")],
+        "client": ("127.0.0.1", 50000),
+        "server": ("localhost", 8000),
+        "scheme": "http",
+        "root_path": "",
+    }
+
+    async def endpoint(scope, receive, send):
+        await send({"type": "http.response.start", "status": 200, "headers": [(b"content-type", b"application/json")]})
+        await send({"type": "http.response.body", "body": b"{}"})
+
+    middleware = RequestLoggingMiddleware(endpoint)
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        pass
+
+    async def op():
+        await middleware(dict(scope), receive, send)
+        # Nothing drains the log queue here, keep it from filling up
+        api_log_writer._buffer.clear()
+
+    return op
+
+
+@benchmark("middleware.streamed_response", sizes=(10, 100, 1000))
+def streamed_response(chunks: int):
+    """A streamed response of `chunks` 1 KB body messages through the logging middleware"""
+    from app.middleware.logging import RequestLoggingMiddleware
+    from app.services.api_log_writer import api_log_writer
+
+    scope = {
+        "type": "http",
+        "method": "GET",
+        "path": "/crypto/replay",
+        "raw_path": b"/crypto/replay",
+        "query_string": b"",
+        "headers": [(b"host", b"localhost"), (b"user-agent", b"micro-benchmark")],
+        "client": ("127.0.0.1", 50000),
+        "server": ("localhost", 8000),
+        "scheme": "http",
+        "root_path": "",
+    }
+    chunk = b"x" * 1024
+
+    async def endpoint(scope, receive, send):
+        await send({"type": "http.response.start", "status": 200, "headers": [(b"content-type", b"application/x-ndjson")]})
+        for _ in range(chunks - 1):
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body", "body": chunk})
+
+    middleware = RequestLoggingMiddleware(endpoint)
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        pass
+
+    async def op():
+        await middleware(dict(scope), receive, send)
+        api_log_writer._buffer.clear()
+
+    return op
+
+
+@benchmark("middleware.app_request")
+def app_request():
+    """A request to a public endpoint through the whole middleware stack, called as ASGI"""
+    from app.main import app
+    from app.services.api_log_writer import api_log_writer
+
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "path": "/",
+        "raw_path": b"/",
+        "query_string": b"",
+        "headers": [(b"host", b"localhost"), (b"user-agent", b"micro-benchmark")],
+        "client": ("127.0.0.1", 50000),
+        "server": ("localhost", 8000),
+        "scheme": "http",
+        "root_path": "",
+    }
+    request_message = {"type": "http.request", "body": b"", "more_body": False}
+
+    async def receive():
+        return request_message
+
+    async def send(message):
+        pass
+
+    async def op():
+        await app(dict(scope), receive, send)
+        api_log_writer._buffer.clear()
+
+    return op
@@ -0,0 +1,25 @@
+from benchmarks.micro import benchmark, ROW_COUNTS
+from benchmarks.micro.fixtures import lob_rows, SYMBOL
+
+
+def _result(size: int) -> dict:
+    data = lob_rows(size)
+    return {"symbol": SYMBOL, "data": data, "data_points": len(data)}
+
+
+@benchmark("response.validate", sizes=ROW_COUNTS)
+def validate(size: int):
+    from app.api.endpoints.crypto import SymbolDataResponse
+
+    result = _result(size)
+    return lambda: SymbolDataResponse(**result)
+
+
+@benchmark("response.serialize", sizes=ROW_COUNTS)
+def serialize(size: int):
+    """Validation and rendering, as done by GET /crypto/data/{symbol}"""
+    from fastapi.responses import JSONResponse
+    from app.api.endpoints.crypto import SymbolDataResponse
+
+    result = _result(size)
+    return lambda: JSONResponse(SymbolDataResponse(**result).model_dump())
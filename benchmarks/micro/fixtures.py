@@ -0,0 +1,20 @@
+"""Realistic LOB fixtures, fixed in time so runs are comparable"""
+from functools import lru_cache
+from typing import Any, Dict, List
+from benchmarks.fake_clickhouse import encode
+from benchmarks.lob_fixtures import COLUMNS, make_rows, to_clickhouse_json_row
+
+FIXED_NOW_MS = 1_735_689_600_000  # 2025-01-01T00:00:00Z
+SYMBOL = "BTCUSDT"
+
+
+@lru_cache(maxsize=None)
+def lob_rows(count: int) -> List[Dict[str, Any]]:
+    """Rows as the API returns them (decoded ClickHouse JSON)"""
+    return [to_clickhouse_json_row(row) for row in make_rows(SYMBOL, count, now_ms=FIXED_NOW_MS)]
+
+
+@lru_cache(maxsize=None)
+def clickhouse_json_body(count: int) -> bytes:
+    """FORMAT JSON response body of a `SELECT *` for `count` rows"""
+    return encode("JSON", COLUMNS, make_rows(SYMBOL, count, now_ms=FIXED_NOW_MS), elapsed=0.001)
@@ -0,0 +1,223 @@
+"""
+Runs registered micro-benchmarks and reports time and allocations per operation.
+
+Time per op is the median of several repeats of an auto-ranged loop.
+Allocations are measured separately with tracemalloc (which slows code down):
+peak bytes allocated during one op and bytes still held after it.
+"""
+import argparse
+import asyncio
+import gc
+import importlib
+import inspect
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Sequence
+from benchmarks.load import RESULTS_DIR, git_commit
+from benchmarks.micro import BENCHMARKS, ROW_COUNTS
+
+MODULES = (
+    "benchmarks.micro.bench_clickhouse",
+    "benchmarks.micro.bench_serialization",
+    "benchmarks.micro.bench_auth",
+    "benchmarks.micro.bench_middleware",
+)
+
+
+def _timer(op: Callable, loop: asyncio.AbstractEventLoop) -> Callable[[int], float]:
+    """Returns a function running `op` n times and returning the elapsed seconds"""
+    if inspect.iscoroutinefunction(op):
+        async def run(n: int) -> float:
+            started = time.perf_counter()
+            for _ in range(n):
+                await op()
+            return time.perf_counter() - started
+        return lambda n: loop.run_until_complete(run(n))
+
+    def run_sync(n: int) -> float:
+        started = time.perf_counter()
+        for _ in range(n):
+            op()
+        return time.perf_counter() - started
+    return run_sync
+
+
+def _call_once(op: Callable, loop: asyncio.AbstractEventLoop) -> None:
+    if inspect.iscoroutinefunction(op):
+        loop.run_until_complete(op())
+    else:
+        op()
+
+
+def measure_time(op: Callable, loop: asyncio.AbstractEventLoop, min_time: float, repeat: int) -> Dict[str, float]:
+    timer = _timer(op, loop)
+    timer(1)  # warm up caches and lazy imports
+
+    number = 1
+    while True:
+        elapsed = timer(number)
+        if elapsed >= min_time or number >= 1_000_000:
+            break
+        number *= 10 if elapsed < min_time / 10 else 2
+
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        per_op = [timer(number) / number for _ in range(repeat)]
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+    return {
+        "loops": number,
+        "median_ns": round(statistics.median(per_op) * 1e9, 1),
+        "min_ns": round(min(per_op) * 1e9, 1),
+        "stdev_ns": round(statistics.stdev(per_op) * 1e9, 1) if len(per_op) > 1 else 0.0,
+    }
+
+
+def measure_allocations(op: Callable, loop: asyncio.AbstractEventLoop, samples: int = 5) -> Dict[str, int]:
+    _call_once(op, loop)
+    peaks, retained = [], []
+    tracemalloc.start()
+    try:
+        for _ in range(samples):
+            gc.collect()
+            before, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            _call_once(op, loop)
+            after, peak = tracemalloc.get_traced_memory()
+            peaks.append(peak - before)
+            retained.append(after - before)
+    finally:
+        tracemalloc.stop()
+    return {"peak_bytes": int(statistics.median(peaks)), "retained_bytes": int(statistics.median(retained))}
+
+
+def run(
+    name_filter: Optional[str] = None,
+    sizes: Sequence[int] = ROW_COUNTS,
+    min_time: float = 0.2,
+    repeat: int = 5,
+    allocations: bool = True
+) -> Dict[str, Dict[str, Any]]:
+    for module in MODULES:
+        importlib.import_module(module)
+
+    loop = asyncio.new_event_loop()
+    results = {}
+    try:
+        for bench in BENCHMARKS:
+            if name_filter and name_filter not in bench.name:
+                continue
+            for size in ([s for s in bench.sizes if s in sizes] if bench.sizes else [None]):
+                key = bench.name if size is None else f"{bench.name}[{size}]"
+                op = bench.setup() if size is None else bench.setup(size)
+                result = measure_time(op, loop, min_time, repeat)
+                if allocations:
+                    result.update(measure_allocations(op, loop))
+                results[key] = result
+                print_result(key, result)
+    finally:
+        loop.close()
+    return results
+
+
+def print_header() -> None:
+    header = f"{'benchmark':<36} {'median':>12} {'min':>12} {'±stdev':>10} {'peak alloc':>12} {'retained':>10}"
+    print(header)
+    print("-" * len(header))
+
+
+def _format_ns(ns: float) -> str:
+    for unit, scale in (("s", 1e9), ("ms", 1e6), ("us", 1e3)):
+        if ns >= scale:
+            return f"{ns / scale:.2f} {unit}"
+    return f"{ns:.0f} ns"
+
+
+def _format_bytes(value: Optional[int]) -> str:
+    if value is None:
+        return "-"
+    for unit, scale in (("MB", 1 << 20), ("KB", 1 << 10)):
+        if abs(value) >= scale:
+            return f"{value / scale:.1f} {unit}"
+    return f"{value} B"
+
+
+def print_result(key: str, r: Dict[str, Any]) -> None:
+    print(
+        f"{key:<36} {_format_ns(r['median_ns']):>12} {_format_ns(r['min_ns']):>12} "
+        f"{_format_ns(r['stdev_ns']):>10} {_format_bytes(r.get('peak_bytes')):>12} "
+        f"{_format_bytes(r.get('retained_bytes')):>10}",
+        flush=True
+    )
+
+
+def compare(current: Dict[str, Any], baseline: Dict[str, Any], threshold: float) -> List[str]:
+    """
+    Returns human readable regressions: median time per op increase above threshold (fraction)
+    """
+    regressions = []
+    for key, result in current["results"].items():
+        base = baseline.get("results", {}).get(key)
+        if base and result["median_ns"] > base["median_ns"] * (1 + threshold):
+            regressions.append(
+                f"{key}: {_format_ns(base['median_ns'])} -> {_format_ns(result['median_ns'])}"
+            )
+    return regressions
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Micro-benchmarks of request hot paths")
+    parser.add_argument("-k", dest="name_filter", help="Only run benchmarks whose name contains this string")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(ROW_COUNTS), help="Fixture row counts")
+    parser.add_argument("--min-time", type=float, default=0.2, help="Minimal duration of one repeat in seconds")
+    parser.add_argument("--repeat", type=int, default=5, help="Number of timed repeats")
+    parser.add_argument("--no-alloc", action="store_true", help="Skip tracemalloc allocation measurement")
+    parser.add_argument("--output", help="Results JSON path (default: benchmarks/results/micro-<timestamp>.json)")
+    parser.add_argument("--compare", help="Previous results JSON to compare with")
+    parser.add_argument("--threshold", type=float, default=0.15, help="Regression threshold as a fraction")
+    parser.add_argument("--fail-on-regression", action="store_true", help="Exit with code 1 on regressions")
+    return parser
+
+
+def main():
+    args = build_parser().parse_args()
+
+    print_header()
+    results = run(args.name_filter, args.sizes, args.min_time, args.repeat, not args.no_alloc)
+    report = {
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+
+    output = args.output or os.path.join(
+        RESULTS_DIR, f"micro-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResults saved to {output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.threshold)
+        if regressions:
+            print("\nRegressions:")
+            for line in regressions:
+                print(f"  {line}")
+            if args.fail_on_regression:
+                sys.exit(1)
+        else:
+            print(f"\nNo regressions above {args.threshold:.0%} compared to {args.compare}")
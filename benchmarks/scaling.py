@@ -0,0 +1,100 @@
+"""
+Throughput scaling across worker processes.
+
+Runs the load benchmark (benchmarks.load) once per worker count and reports
+throughput relative to a single worker. Scaling efficiency is the speedup
+divided by the number of workers; runs with more workers than CPU cores are
+reported but not checked.
+
+    python -m benchmarks.scaling --worker-counts 1 2 4 --duration 15
+    python -m benchmarks.scaling --worker-counts 1 4 --min-efficiency 0.6
+"""
+import asyncio
+import json
+import os
+import sys
+from datetime import datetime
+from typing import Any, Dict, List
+from benchmarks.load import RESULTS_DIR, build_parser as build_load_parser, run_benchmark
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+def build_parser():
+    parser = build_load_parser()
+    parser.description = "Throughput scaling across API worker processes"
+    parser.add_argument("--worker-counts", type=int, nargs="+", default=[1, 2, 4], help="Worker counts to compare")
+    parser.add_argument(
+        "--min-efficiency", type=float, default=None,
+        help="Exit with code 1 if speedup / workers falls below this (only worker counts <= CPU cores)"
+    )
+    return parser
+
+
+def scaling_table(reports: Dict[int, Dict[str, Any]]) -> List[Dict[str, Any]]:
+    counts = sorted(reports)
+    base_rps = reports[counts[0]]["results"]["total"]["rps"] / counts[0]
+    rows = []
+    for workers in counts:
+        total = reports[workers]["results"]["total"]
+        speedup = total["rps"] / base_rps if base_rps else 0.0
+        rows.append({
+            "workers": workers,
+            "rps": total["rps"],
+            "p95_ms": total["p95_ms"],
+            "errors": total["errors"],
+            "rejected": total.get("rejected", 0),
+            "speedup": round(speedup, 2),
+            "efficiency": round(speedup / workers, 2),
+        })
+    return rows
+
+
+def main():
+    args = build_parser().parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    cpu_count = os.cpu_count() or 1
+
+    reports = {}
+    for workers in args.worker_counts:
+        args.workers = workers
+        logger.info(f"Running load benchmark with {workers} worker(s)")
+        reports[workers] = asyncio.run(run_benchmark(args))
+
+    rows = scaling_table(reports)
+    header = f"{'workers':>7} {'rps':>9} {'p95 ms':>9} {'errors':>7} {'rejected':>9} {'speedup':>8} {'efficiency':>10}"
+    print(header)
+    print("-" * len(header))
+    for row in rows:
+        note = "" if row["workers"] <= cpu_count else f"  (> {cpu_count} CPU cores)"
+        if row["rejected"]:
+            # Shed requests are cheap, their throughput says nothing about scaling
+            note += "  (requests rejected with 429/503)"
+        print(
+            f"{row['workers']:>7} {row['rps']:>9} {row['p95_ms']:>9} {row['errors']:>7} {row['rejected']:>9} "
+            f"{row['speedup']:>8} {row['efficiency']:>10}{note}"
+        )
+
+    output = args.output or os.path.join(
+        RESULTS_DIR, f"scaling-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump({"cpu_count": cpu_count, "scaling": rows, "reports": reports}, f, indent=2)
+    print(f"\nResults saved to {output}")
+
+    if args.min_efficiency is not None:
+        failed = [
+            row for row in rows
+            if row["workers"] <= cpu_count and row["efficiency"] < args.min_efficiency
+        ]
+        if failed:
+            for row in failed:
+                print(f"Scaling below {args.min_efficiency}: {row['workers']} workers, efficiency {row['efficiency']}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
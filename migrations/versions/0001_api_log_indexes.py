@@ -0,0 +1,31 @@
+"""api_logs composite indexes for keyset pagination
+
+Revision ID: 0001
+Revises:
+Create Date: 2025-10-18
+"""
+from alembic import op
+
+
+revision = "0001"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Rows written through server_default now() have no fractional seconds,
+    # while ORM writes do. Normalize them so (created_at, id) compares correctly.
+    op.execute(
+        "UPDATE api_logs SET created_at = created_at || '.000000' "
+        "WHERE length(created_at) = 19"
+    )
+    op.create_index("ix_api_logs_created_at_id", "api_logs", ["created_at", "id"], if_not_exists=True)
+    op.create_index("ix_api_logs_user_id_created_at_id", "api_logs", ["user_id", "created_at", "id"], if_not_exists=True)
+    op.create_index("ix_api_logs_endpoint_created_at_id", "api_logs", ["endpoint", "created_at", "id"], if_not_exists=True)
+
+
+def downgrade():
+    op.drop_index("ix_api_logs_endpoint_created_at_id", table_name="api_logs")
+    op.drop_index("ix_api_logs_user_id_created_at_id", table_name="api_logs")
+    op.drop_index("ix_api_logs_created_at_id", table_name="api_logs")
@@ -1,10 +1,182 @@
+"""
+Starts the API with uvicorn.
+
+    python run.py                       # single process with default settings (development)
+    python run.py --prod                # production server configured by SERVER_* settings
+    python run.py --prod --workers 4
+
+In production mode the workers use uvloop and httptools when installed, the
+listening socket backlog and keep-alive timeout come from settings and
+workers can be recycled after SERVER_LIMIT_MAX_REQUESTS requests: a worker
+stops accepting connections, finishes in-flight requests and the supervisor
+starts a fresh one. uvicorn's supervisor spawns the workers (the "spawn"
+start method, no fork): each imports the app afresh and builds its own
+ClickHouse session, db connections and caches, nothing is inherited from
+this process. Only the shared memory cache (SHARED_CACHE_ENABLED), the
+symbol index and the rate limit buckets are shared, through files created
+here and passed in the environment.
+
+Both modes apply db migrations before the server starts.
+"""
+import argparse
+import importlib.util
+import os
+import random
+import tempfile
+from typing import List
 import uvicorn
+from uvicorn.supervisors import Multiprocess
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+def resolve_loop(loop: str) -> str:
+    if loop == "auto":
+        return "uvloop" if importlib.util.find_spec("uvloop") else "asyncio"
+    return loop
+
+
+def resolve_http(http: str) -> str:
+    if http == "auto":
+        return "httptools" if importlib.util.find_spec("httptools") else "h11"
+    return http
+
+
+class RecyclingServer(uvicorn.Server):
+    """Worker server whose request limit gets a random jitter, drawn in the worker process"""
+    def __init__(self, config: uvicorn.Config, max_requests_jitter: int = 0):
+        super().__init__(config)
+        self.max_requests_jitter = max_requests_jitter
+
+    def run(self, sockets=None):
+        if self.config.limit_max_requests and self.max_requests_jitter > 0:
+            self.config.limit_max_requests += random.randint(0, self.max_requests_jitter)
+        return super().run(sockets=sockets)
+
+
+def prepare_metrics_dir(workers: int) -> None:
+    """
+    /metrics must aggregate all workers: use a shared dir and drop snapshots of a previous run
+    """
+    directory = os.environ.get("METRICS_MULTIPROCESS_DIR")
+    if not directory:
+        if workers < 2:
+            return
+        directory = tempfile.mkdtemp(prefix="lob-api-metrics-")
+        os.environ["METRICS_MULTIPROCESS_DIR"] = directory
+    os.makedirs(directory, exist_ok=True)
+    for filename in os.listdir(directory):
+        if filename.startswith("worker_") or filename == "archive.json":
+            os.remove(os.path.join(directory, filename))
+
+
+def prepare_shared_files() -> List[str]:
+    """
+    All workers of this server must map the same shared cache and symbol
+    index segments and rate limit bucket table. Returns the settings that
+    were set here.
+    """
+    from app.core.config import settings
+
+    directory = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+    created = []
+    for enabled, variable, name in (
+        (settings.SHARED_CACHE_ENABLED, "SHARED_CACHE_PATH", "cache"),
+        (settings.RATE_LIMIT_ENABLED, "RATE_LIMIT_STATE_PATH", "ratelimit"),
+        (settings.SYMBOL_INDEX_ENABLED, "SYMBOL_INDEX_PATH", "index"),
+    ):
+        if enabled and not os.environ.get(variable) and not getattr(settings, variable):
+            os.environ[variable] = os.path.join(directory, f"lob-api-{name}-{os.getpid()}")
+            created.append(variable)
+    return created
 
 
-if __name__ == "__main__":    
+def remove_shared_files(variables: List[str]) -> None:
+    for variable in variables:
+        path = os.environ[variable]
+        for filename in (path, f"{path}.lock"):
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+
+
+def apply_migrations() -> None:
+    from app.core.log_config import setup_logging
+    from app.db.migrations import run_migrations
+
+    setup_logging()
+    run_migrations()
+
+
+def run_production(args) -> None:
+    from app.core.config import settings
+
+    workers = args.workers if args.workers is not None else settings.SERVER_WORKERS
+    if workers <= 0:
+        workers = os.cpu_count() or 1
+    prepare_metrics_dir(workers)
+    created_shared_files = prepare_shared_files()
+
+    # Once, before the workers start, so they don't race creating tables
+    apply_migrations()
+
+    loop = resolve_loop(settings.SERVER_LOOP)
+    http = resolve_http(settings.SERVER_HTTP)
+    logger.info(f"Starting {workers} worker(s) with loop={loop} http={http}")
+
+    config = uvicorn.Config(
+        "app.main:app",
+        host=args.host or settings.SERVER_HOST,
+        port=args.port or settings.SERVER_PORT,
+        workers=workers,
+        loop=loop,
+        http=http,
+        backlog=settings.SERVER_BACKLOG,
+        timeout_keep_alive=settings.SERVER_KEEPALIVE_SECONDS,
+        limit_max_requests=settings.SERVER_LIMIT_MAX_REQUESTS,
+        timeout_graceful_shutdown=settings.SERVER_GRACEFUL_SHUTDOWN_SECONDS,
+        access_log=settings.SERVER_ACCESS_LOG,
+        log_level=args.log_level,
+        proxy_headers=True
+    )
+    server = RecyclingServer(config, settings.SERVER_LIMIT_MAX_REQUESTS_JITTER)
+    # Always run under the supervisor, it replaces workers that exit after
+    # limit_max_requests (uvicorn.run would just stop a single worker)
+    sock = config.bind_socket()
+    try:
+        Multiprocess(config, target=server.run, sockets=[sock]).run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        remove_shared_files(created_shared_files)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the LOB Data API")
+    parser.add_argument("--prod", action="store_true", help="Production server configured by SERVER_* settings")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes, 0 = one per CPU core")
+    parser.add_argument("--host", default=None)
+    parser.add_argument("--port", type=int, default=None)
+    parser.add_argument("--log-level", default="info")
+    args = parser.parse_args()
+
+    if args.prod:
+        run_production(args)
+        return
+
+    apply_migrations()
     uvicorn.run(
         "app.main:app",
-        host="0.0.0.0",
-        port=8000,
+        host=args.host or "0.0.0.0",
+        port=args.port or 8000,
+        workers=args.workers,
+        log_level=args.log_level,
         reload=False
     )
+
+
+if __name__ == "__main__":
+    main()
@@ -41,7 +41,7 @@ async def test_clickhouse():
                 data = await client.execute("""
                     SELECT symbol, best_bid, best_ask, event_time
                     FROM blob_rest_all_aggregated 
-                    WHERE symbol = {symbol}
+                    WHERE symbol = {symbol:String}
                     LIMIT 3
                 """, {'symbol': first_symbol})
                 logger.info(f"Data for {first_symbol}: {data}")